@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+
+# Several Bluetooth adapters (HCI controllers) used together
+#
+# Each adapter only supports a few simultaneous connections, so with a single adapter the harvest of a fleet
+# is limited by its connection limit. An adapter_pool scans with all the adapters, keeps the signal strength
+# (RSSI) of each device on each adapter, and assigns each connection to an adapter with spare capacity:
+#   - the adapter hearing the device best, unless another adapter hears it almost as well (within rssi_margin
+#     dB) with fewer connections: the connections are then balanced between them
+#   - adapters that never heard the device are only used when the others are busy or failed
+#   - an adapter that fails to connect to a device is not used for that device for retry_delay s, the next
+#     best adapter is tried instead (failover). An adapter failing failure_threshold times in a row (e.g. a
+#     dongle that was unplugged) is not used at all for retry_delay s
+#
+#   pool = adapters.adapter_pool(['hci0', 'hci1'], max_connections=3)
+#   device_list = await pool.search_devices(10)
+#   results = await fleet.harvest_fleet(device_list, datafile, logfile, max_concurrent=6, adapters=pool)
+#
+# Without adapters (e.g. in tests), search can list simulated devices instead (see simulator.search_function()).
+
+class adapter_pool:
+    # max_connections: per adapter, a number or a dictionnary adapter -> number.
+    # search(adapter, timeout) returns the devices heard by an adapter, in the format of search_devices()
+    def __init__(self, adapters, max_connections=3, rssi_margin=6, retry_delay=300, failure_threshold=3, search=None):
+        if not adapters:
+            raise ValueError('At least one adapter is needed')
+        self.adapters = {}
+        for adapter in adapters:
+            self.adapters[adapter] = {'max_connections': max_connections[adapter] if isinstance(max_connections, dict) else max_connections,
+                                      'connections': 0, 'consecutive_failures': 0, 'down_until': None}
+        self.rssi_margin = rssi_margin
+        self.retry_delay = retry_delay
+        self.failure_threshold = failure_threshold
+        self.search = search if search is not None else search_adapter
+        # address -> {adapter: RSSI}
+        self.rssi = {}
+        # (address, adapter) -> time until which the adapter is not used for the device
+        self.avoided = {}
+        self.changed = asyncio.Condition()
+
+    # Total number of simultaneous connections
+    def capacity(self):
+        return(sum(state['max_connections'] for state in self.adapters.values()))
+
+    def update_rssi(self, address, adapter, rssi):
+        if(rssi is not None) and (adapter in self.adapters):
+            self.rssi.setdefault(address, {})[adapter] = rssi
+        pass
+
+    def is_down(self, adapter, now=None):
+        now = time.time() if now is None else now
+        down_until = self.adapters[adapter]['down_until']
+        return(down_until is not None and now < down_until)
+
+    # Adapters that can be used for a device, best first. When all of them failed, they are all tried again
+    def candidates(self, address, now=None):
+        now = time.time() if now is None else now
+        adapters = [adapter for adapter in self.adapters
+                    if not self.is_down(adapter, now) and self.avoided.get((address, adapter), 0) <= now]
+        if not adapters:
+            adapters = [adapter for adapter in self.adapters if not self.is_down(adapter, now)] or list(self.adapters)
+        rssi = self.rssi.get(address, {})
+        return(sorted(adapters, key=lambda adapter: -rssi[adapter] if adapter in rssi else float('inf')))
+
+    # Adapter for a new connection to a device, None if all the candidates are busy
+    def choose(self, address, now=None):
+        rssi = self.rssi.get(address, {})
+        free = [adapter for adapter in self.candidates(address, now)
+                if self.adapters[adapter]['connections'] < self.adapters[adapter]['max_connections']]
+        if not free:
+            return(None)
+        heard = [adapter for adapter in free if adapter in rssi]
+        if not heard:
+            # Never heard by the free adapters: the least loaded one
+            return(min(free, key=self.load))
+        best_rssi = max(rssi[adapter] for adapter in heard)
+        close = [adapter for adapter in heard if rssi[adapter] >= best_rssi - self.rssi_margin]
+        return(min(close, key=lambda adapter: (self.load(adapter), -rssi[adapter])))
+
+    def load(self, adapter):
+        return(self.adapters[adapter]['connections'] / max(self.adapters[adapter]['max_connections'], 1))
+
+    # Wait until an adapter can connect to the device, and reserve a connection on it
+    async def acquire(self, address):
+        async with self.changed:
+            while True:
+                adapter = self.choose(address)
+                if adapter is not None:
+                    break
+                await self.changed.wait()
+            self.adapters[adapter]['connections'] += 1
+        return(adapter)
+
+    # failed: the device could not be reached through this adapter
+    async def release(self, address, adapter, failed=False):
+        now = time.time()
+        state = self.adapters[adapter]
+        if failed:
+            self.avoided[(address, adapter)] = now + self.retry_delay
+            state['consecutive_failures'] += 1
+            if(state['consecutive_failures'] >= self.failure_threshold) and not self.is_down(adapter, now):
+                state['down_until'] = now + self.retry_delay
+                logging.warning(f'Adapter {adapter} failed {state["consecutive_failures"]} times in a row, not used for {self.retry_delay}s')
+        else:
+            self.avoided.pop((address, adapter), None)
+            state['consecutive_failures'] = 0
+            state['down_until'] = None
+        async with self.changed:
+            state['connections'] -= 1
+            self.changed.notify_all()
+        pass
+
+    # Scan with all the adapters at the same time. Returns the devices as search_devices(), strongest signal
+    # first, with the adapter hearing each device best ('adapter') and the RSSI on each adapter ('rssi_by_adapter')
+    async def search_devices(self, timeout=5):
+        adapters = list(self.adapters)
+        results = await asyncio.gather(*[self.search(adapter, timeout) for adapter in adapters], return_exceptions=True)
+        devices = {}
+        for adapter, found in zip(adapters, results):
+            if isinstance(found, Exception):
+                logging.error(f'Scanning with adapter {adapter} failed: {found}')
+                self.adapters[adapter]['down_until'] = time.time() + self.retry_delay
+                continue
+            for device in found:
+                self.update_rssi(device['address'], adapter, device['rssi'])
+                best = devices.get(device['address'])
+                if(best is None) or ((device['rssi'] is not None) and (best['rssi'] is None or device['rssi'] > best['rssi'])):
+                    devices[device['address']] = dict(device, adapter=adapter)
+        for address, device in devices.items():
+            device['rssi_by_adapter'] = dict(self.rssi.get(address, {}))
+        return(sorted(devices.values(), key=lambda device: device['rssi'] if device['rssi'] is not None else -999, reverse=True))
+
+    # One device_listener (see scanner.py) per adapter, keeping the RSSI of the devices up to date while
+    # they are running. callback(entry, adapter) is also called with each registry entry
+    def listeners(self, ttl=600, callback=None):
+        from .scanner import device_listener
+        listeners = []
+        for adapter in self.adapters:
+            def update(entry, adapter=adapter):
+                self.update_rssi(entry['address'], adapter, entry['rssi'])
+                if callback is not None:
+                    callback(entry, adapter)
+            listeners.append(device_listener(ttl=ttl, callback=update, adapter=adapter))
+        return(listeners)
+
+    # State of each adapter: connections in use, maximum, and whether it is down
+    def status(self):
+        return({adapter: {'connections': state['connections'], 'max_connections': state['max_connections'],
+                          'down': self.is_down(adapter), 'consecutive_failures': state['consecutive_failures']}
+                for adapter, state in self.adapters.items()})
+
+# Scan with a Bluetooth adapter (e.g. 'hci0')
+async def search_adapter(adapter, timeout):
+    from .apogee_device import search_devices
+    return(await search_devices(timeout, silent=True, find_all=True, adapter=adapter))
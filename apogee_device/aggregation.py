@@ -0,0 +1,197 @@
+import datetime
+import json
+import math
+import os
+from .jsonfile import atomic_write_json
+# Datasets can also be structured arrays from decode_logs_array(), NumPy is not imported for them
+from .storage import is_array
+
+# Hourly and daily statistics of the downloaded data, updated at each download
+#
+# An aggregator keeps the count, sum, min and max of each sensor output, per device (serial) and time window
+# (e.g. each hour and each day). With ucache(address, aggregator=aggregator), every dataset written by
+# write_datafile() is added to it, so the statistics never need to be computed again from the data files,
+# and reading them takes the same time however much data has been collected.
+#
+# Records transferred again (e.g. download_routine(from_timestamp='all')) are only counted once: the
+# timestamps already added are kept, in a compact form (runs of regularly spaced timestamps). Late or
+# out-of-order records are added to the windows they belong to.
+#
+# The state is saved in directory/<serial>/<YYYY-MM>.json, one file per device and month, so that saving
+# only rewrites the months that changed. It is saved by save() or close(): download_routine() saves it once
+# per transfer, after writing the data (not after each batch of a checkpointed transfer).
+#
+#   aggregates = aggregation.aggregator('./aggregates')
+#   ucache = apogee_device.ucache(device_address, aggregator=aggregates)
+#   ...
+#   aggregates.summaries(serial_number, 'hour', start_time=1672531200)
+
+default_windows = {'hour': 3600, 'day': 86400}
+
+class aggregator:
+    # windows: name -> length in s. The lengths must divide a day. Windows start at midnight UTC, shifted by
+    # utc_offset s (e.g. 3600 for daily windows starting at midnight UTC+1)
+    def __init__(self, directory=None, windows=None, utc_offset=0, max_cached_months=24):
+        self.directory = directory
+        self.windows = dict(windows) if windows is not None else dict(default_windows)
+        for name, length in self.windows.items():
+            if(length <= 0) or (86400 % length != 0):
+                raise ValueError(f'The length of window {name} must divide a day')
+        self.base_window = min(self.windows.values())
+        self.utc_offset = utc_offset
+        self.max_cached_months = max_cached_months
+        # (serial, month) -> state, in the order they were used
+        self.months = {}
+        self.dirty = set()
+
+    def month_name(self, timestamp):
+        return(datetime.datetime.fromtimestamp(timestamp + self.utc_offset, tz=datetime.timezone.utc).strftime('%Y-%m'))
+
+    def bucket(self, timestamp, length):
+        return(timestamp - (timestamp + self.utc_offset) % length)
+
+    def file_path(self, serial, month):
+        return(os.path.join(self.directory, str(serial), month + '.json'))
+
+    # State of a device for a month: {'seen': {base bucket: set of offsets}, window name: {bucket: statistics}}
+    def month(self, serial, month):
+        key = (str(serial), month)
+        state = self.months.pop(key, None)
+        if state is None:
+            state = self.load(serial, month)
+        # Most recently used last
+        self.months[key] = state
+        # Without directory, everything stays in memory
+        if(self.directory is not None) and (len(self.months) > self.max_cached_months):
+            oldest = next(iter(self.months))
+            if oldest in self.dirty:
+                self.save_month(*oldest)
+            del self.months[oldest]
+        return(state)
+
+    def load(self, serial, month):
+        state = {'seen': {}}
+        for name in self.windows:
+            state[name] = {}
+        if self.directory is None:
+            return(state)
+        file_path = self.file_path(serial, month)
+        if not os.path.isfile(file_path):
+            return(state)
+        with open(file_path) as f:
+            saved = json.load(f)
+        for bucket, runs in saved['seen'].items():
+            state['seen'][int(bucket)] = set(offset for start, step, count in runs for offset in range(start, start + step * count, step))
+        for name in self.windows:
+            state[name] = {int(bucket): statistics for bucket, statistics in saved.get(name, {}).items()}
+        return(state)
+
+    # Add a dataset (list of lists, or structured array) of a device. Returns the number of records added,
+    # the records that were already added are left out
+    def add(self, serial, dataset):
+        if is_array(dataset):
+            rows = zip(dataset['timestamp'].tolist(), dataset['values'].tolist())
+        else:
+            rows = ((row[0], row[1:]) for row in dataset)
+        serial = str(serial)
+        nb_added = 0
+        state = None
+        state_month = None
+        for timestamp, values in rows:
+            timestamp = int(timestamp)
+            month = self.month_name(timestamp)
+            if(month != state_month):
+                state = self.month(serial, month)
+                state_month = month
+                self.dirty.add((serial, month))
+            base = self.bucket(timestamp, self.base_window)
+            seen = state['seen'].setdefault(base, set())
+            if(timestamp - base) in seen:
+                continue
+            seen.add(timestamp - base)
+            for name, length in self.windows.items():
+                bucket = self.bucket(timestamp, length)
+                statistics = state[name].get(bucket)
+                if statistics is None:
+                    statistics = {'count': [0] * len(values), 'sum': [0.0] * len(values),
+                                  'min': [None] * len(values), 'max': [None] * len(values)}
+                    state[name][bucket] = statistics
+                for i, value in enumerate(values):
+                    if(i >= len(statistics['count'])) or math.isnan(value):
+                        continue
+                    statistics['count'][i] += 1
+                    statistics['sum'][i] += value
+                    if(statistics['min'][i] is None) or (value < statistics['min'][i]):
+                        statistics['min'][i] = value
+                    if(statistics['max'][i] is None) or (value > statistics['max'][i]):
+                        statistics['max'][i] = value
+            nb_added += 1
+        return(nb_added)
+
+    # Statistics of the window containing timestamp: start time, then count, mean, min and max of each output.
+    # None if no record was added to it
+    def get(self, serial, window, timestamp):
+        length = self.windows[window]
+        bucket = self.bucket(int(timestamp), length)
+        statistics = self.month(serial, self.month_name(bucket))[window].get(bucket)
+        if statistics is None:
+            return(None)
+        return(summary(bucket, length, statistics))
+
+    # Statistics of the windows between start_time and end_time (included), oldest first
+    def summaries(self, serial, window, start_time, end_time=None):
+        length = self.windows[window]
+        end_time = end_time if end_time is not None else start_time
+        result = []
+        bucket = self.bucket(int(start_time), length)
+        while(bucket <= end_time):
+            statistics = self.month(serial, self.month_name(bucket))[window].get(bucket)
+            if statistics is not None:
+                result.append(summary(bucket, length, statistics))
+            bucket += length
+        return(result)
+
+    def save_month(self, serial, month):
+        state = self.months[(serial, month)]
+        saved = {'seen': {str(bucket): to_runs(offsets) for bucket, offsets in state['seen'].items()}}
+        for name in self.windows:
+            saved[name] = {str(bucket): statistics for bucket, statistics in state[name].items()}
+        os.makedirs(os.path.join(self.directory, serial), exist_ok=True)
+        file_path = self.file_path(serial, month)
+        atomic_write_json(file_path, saved)
+        self.dirty.discard((serial, month))
+        pass
+
+    # Save the months that changed
+    def save(self):
+        if self.directory is None:
+            return
+        for serial, month in list(self.dirty):
+            self.save_month(serial, month)
+        pass
+
+    def close(self):
+        self.save()
+        pass
+
+def summary(bucket, length, statistics):
+    return({'start_time': bucket, 'end_time': bucket + length,
+            'count': list(statistics['count']),
+            'mean': [total / count if count > 0 else None for total, count in zip(statistics['sum'], statistics['count'])],
+            'min': list(statistics['min']), 'max': list(statistics['max'])})
+
+# Sorted offsets as runs [first offset, step, number of offsets]: records logged at a regular interval take
+# a single run per window
+def to_runs(offsets):
+    runs = []
+    for offset in sorted(offsets):
+        if runs:
+            start, step, count = runs[-1]
+            if(count == 1):
+                runs[-1] = [start, offset - start, 2]
+                continue
+            if(offset == start + step * count):
+                runs[-1][2] += 1
+                continue
+        runs.append([offset, 1, 1])
+    return(runs)
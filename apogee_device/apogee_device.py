@@ -1,58 +1,167 @@
 import asyncio
 import logging
-from bleak import BleakClient, BleakScanner
 import datetime
 import struct
 import csv
 import os
 import time
+import collections
+from .instrumentation import instrumented_client
+from .watchdog import deadline_client
+from .storage import storage_backend, csv_backend
+from .live import live_buffer
+from .scanner import parse_advertisement
 
 # Check until device found or timeout
-async def search_devices(timeout=5, silent=False):
+# With find_all=True, scanning continues until the timeout to find all the devices in range
+# scanner_kwargs are passed to BleakScanner, e.g. adapter='hci1' to scan with another Bluetooth adapter
+async def search_devices(timeout=5, silent=False, find_all=False, **scanner_kwargs):
+    # Bleak is only imported when it is used, so that offline tools (e.g. the export command of cli.py) start quickly
+    from bleak import BleakScanner
     if not silent: print('Searching for devices:')
     start_time = time.time()
-    elapsed_time = start_time
     apogee_devices = []
-    async with BleakScanner() as scanner:
+    while True:
+        # Stop if the searching time is over
+        elapsed_time = time.time() - start_time
+        if not silent: print('  - Search time: ' + str(int(elapsed_time)) + 's')
+        if(elapsed_time >= timeout):
+            break
+        # discover() is a class method, the scanner (and its adapter) is given by scanner_kwargs.
+        # With find_all, a single scan lasts until the timeout, otherwise the results are checked every 5s
+        scan_time = timeout - elapsed_time if find_all else min(5, timeout - elapsed_time)
         try:
-            while True:
-                # Stop if the searching time is over
-                elapsed_time = time.time() - start_time
-                if not silent: print('  - Search time: ' + str(int(elapsed_time)) + 's')
-                if(elapsed_time > timeout):
-                    break
-                    
-                devices = await asyncio.wait_for(scanner.discover(), timeout=10)
-                for device in devices:
-                    if device.metadata["manufacturer_data"] and 0x0644 in device.metadata["manufacturer_data"]:
-                        # Prepare data to return to calling function
-                        manufacturer_data = [(k,v) for k,v in device.metadata['manufacturer_data'].items()][0]
-                        company_id      = manufacturer_data[0]
-                        advertised_data = manufacturer_data[1]
-                        apogee_devices.append({'address': device.address, 'name': device.name, 'rssi': device.rssi,
-                                               'company_id': company_id, 'advertised_data': advertised_data})
-                        break
-                else:
-                    continue
-                break
+            devices = await asyncio.wait_for(BleakScanner.discover(timeout=scan_time, return_adv=True, **scanner_kwargs),
+                                             timeout=scan_time + 10)
         except asyncio.TimeoutError:
-            print('  - Device not found, scanning timed out after ' + str(timeout) + 's')
-            print('    Try a long press (device should respond with blue blinking)')
+            logging.error('Scanning timed out')
+            break
+        for device, advertisement in devices.values():
+            if(0x0644 not in advertisement.manufacturer_data):
+                continue
+            # Prepare data to return to calling function
+            advertised_data = advertisement.manufacturer_data[0x0644]
+            apogee_devices.append({'address': device.address, 'name': device.name, 'rssi': advertisement.rssi,
+                                   'company_id': 0x0644, 'advertised_data': advertised_data,
+                                   'alias': parse_advertisement(advertised_data)['alias']})
+            if not find_all:
+                break
+        if find_all or apogee_devices:
+            break
+    if not apogee_devices and not silent:
+        print('  - Device not found, scanning timed out after ' + str(timeout) + 's')
+        print('    Try a long press (device should respond with blue blinking)')
         
     return(apogee_devices)
 
+# Based on Table 10 in the API manual. This dictionnary is incomplete but can be completed from the API manual
+sensor_list = {0: {'name': None, 'description': 'No sensor chosen', 'outputs': 0, 'params': None, 'units': None},
+               1: {'name': 'SP-110', 'description': 'Pyranometer', 'outputs': 1, 'params': 'S', 'units': 'W m-2'},
+               2: {'name': 'SP-510', 'description': 'Thermopile Pyranometer', 'outputs': 1, 'params': 'Sin', 'units': 'W m-2'},
+               3: {'name': 'SP-610', 'description': 'Thermopile Pyranometer (Downward)', 'outputs': 1, 'params': 'Sout', 'units': 'W m-2'},
+               4: {'name': 'SQ-110', 'description': 'Quantum (Electric)', 'outputs': 1, 'params': 'PPFD', 'units': 'μmol m-2 s-1'},
+               5: {'name': 'SQ-120', 'description': 'Quantum (Solar)', 'outputs': 1, 'params': 'PPFD_artificial', 'units': 'μmol m-2 s-1'},
+               6: {'name': 'SQ-500', 'description': 'Quantum (Full Spectrum)', 'outputs': 1, 'params': 'PPFD_full', 'units': 'μmol m-2 s-1'},
+               7: {'name': 'SL-510', 'description': 'Pyrgeometer', 'outputs': 1, 'params': 'Lin', 'units': 'W m-2, °C'},
+               8: {'name': 'SL-610', 'description': 'Pyrgeometer (Downward)', 'outputs': 1, 'params': 'Lout', 'units': 'W m-2, °C'},
+               9: {'name': 'SI-100', 'description': 'IR Sensor', 'outputs': 2, 'params': 'Ts', 'units': '°C, °C'},
+               10: {'name': 'SU-200', 'description': 'UV Sensor', 'outputs': 1, 'params': 'UV', 'units': 'W m-2'},
+               11: {'name': 'SE-100', 'description': 'Photometric', 'outputs': 1, 'params': 'Lux', 'units': 'lm m-2'},
+               12: {'name': 'S2-111', 'description': 'NDVI', 'outputs': 2, 'params': 'NDVI', 'units': 'W m-2, W m-2'},
+               13: {'name': 'S2-112', 'description': 'NDVI (Downward)', 'outputs': 2, 'params': 'NDVIout', 'units': 'W m-2, W m-2'},
+               20: {'name': 'SP-700', 'description': 'Albedometer', 'outputs': 2, 'params': 'Sin,Sout', 'units': 'W m-2, W m-2'},
+               26: {'name': '2 Differential', 'description': '2 Differential Measurements', 'outputs': 2, 'params': 'D1,D2', 'units': 'mV, mV'}}
+
+# Everything read by read_status_snapshot(), in one object
+status_snapshot = collections.namedtuple('status_snapshot', ['manufacturer_name', 'model_number', 'serial_number',
+                                                             'firmware_revision', 'hardware_revision', 'battery_level',
+                                                             'time', 'logging_status', 'sensor', 'nb_logs_available',
+                                                             'oldest_log_time', 'total_logs', 'last_transferred_time',
+                                                             'log_full_time', 'sampling_interval', 'logging_interval'])
+
+# Decode the raw data log entries (timestamp + 32-bit signed values) into a list of lists
+def decode_logs(received_data):
+    dataset = []
+    for row in received_data:
+        # Unpack the unsigned 32-bit integer
+        sampling_time = struct.unpack('<I', row[:4])[0]
+        # Calculate the number of remaining bytes
+        num_remaining_bytes = len(row) - 4
+        # Unpack the signed 32-bit integers
+        if num_remaining_bytes % 4 != 0:
+            raise ValueError('Invalid data length')
+        num_values = num_remaining_bytes // 4
+        raw_values = list(struct.unpack('<{}i'.format(num_values), row[4:]))
+        values = [x / 10000.0 for x in raw_values] # The original data is stored with an exponent -4
+        dataset.append([sampling_time] + values)
+    return(dataset)
+
+# Decode the raw data log entries in a single pass into a NumPy structured array
+# with the fields 'timestamp' (uint32) and 'values' (float64, one column per sensor output)
+def decode_logs_array(received_data, nb_outputs=None):
+    # NumPy is optional, it is only imported to decode data logs into arrays
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError('NumPy is required to decode data logs into arrays')
+    # All entries of a data log have the same length, it can be deduced from the first one
+    if(nb_outputs is None) or (nb_outputs == 0):
+        nb_outputs = (len(received_data[0]) - 4) // 4 if received_data else 1
+    raw_dtype = np.dtype([('timestamp', '<u4'), ('values', '<i4', (nb_outputs,))])
+    buffer = b''.join(received_data)
+    if(len(buffer) != len(received_data) * raw_dtype.itemsize):
+        raise ValueError('Invalid data length')
+    raw = np.frombuffer(buffer, dtype=raw_dtype)
+    
+    dataset = np.empty(len(raw), dtype=[('timestamp', '<u4'), ('values', '<f8', (nb_outputs,))])
+    dataset['timestamp'] = raw['timestamp']
+    np.divide(raw['values'], 10000.0, out=dataset['values']) # The original data is stored with an exponent -4
+    return(dataset)
+
 class ucache:
-    def __init__(self, address):
+    def __init__(self, address, use_numpy=False, metadata_cache=None, client=None, metrics=None, timeouts=None,
+                 pipeline=None, aggregator=None, adapter=None):
         self.address = address
-        self.client = BleakClient(address, timeout=5.0)
+        # Bluetooth adapter used for the connection (e.g. 'hci1', see adapters.py), None for the default one
+        self.adapter = adapter
+        # If True, current_dataset is a NumPy structured array instead of a list of lists
+        self.use_numpy = use_numpy
+        # Optional metadata_cache (see metadata_cache.py), to avoid reading information that does not change
+        self.metadata_cache = metadata_cache
+        # Any object with the methods of BleakClient can be used instead, e.g. a simulated_client (see simulator.py)
+        if client is None:
+            from bleak import BleakClient
+            client = BleakClient(address, timeout=5.0) if adapter is None else BleakClient(address, timeout=5.0, adapter=adapter)
+        self.client = client
+        # Optional metrics (see instrumentation.py): all GATT operations are then timed
+        self.metrics = metrics
+        if metrics is not None:
+            self.client = instrumented_client(self.client, metrics, address)
+        # Every operation has a deadline (see watchdog.py): timeouts overrides the maximum duration in s of
+        # some operations, e.g. {'read': 5}. A value of None removes the deadline
+        self.client = deadline_client(self.client, address, timeouts)
+        # Optional pipeline (see pipeline.py): decoding and writing then run outside of the event loop
+        self.pipeline = pipeline
+        # Optional aggregator (see aggregation.py), updated with every dataset written by write_datafile()
+        self.aggregator = aggregator
         self.disconnected = True
+        # If True, disconnect() leaves the connection open (set by session.session_pool, which closes it)
+        self.keep_connected = False
         self.device_info = {}
+        # GATT characteristics resolved from their UUID, valid for the current connection only
+        self.characteristics = {}
         self.current_dataset = []
+        self.nb_transferred = 0 # Number of entries of the last transfer
+        self.status = None # status_snapshot read by the last download_routine()
+        self.log_full_time = None # Log full time at the end of the last download_routine()
+        self.live = None # live_buffer of the live data, see start_live()
+        self.live_params = []
         self.base_apogee_service_uuid ='b3e0xxxx-2594-42a1-a5fe-4e660ff2868f'
         self.uuid_time     = '000a'
         self.uuid_logfull  = '000c'
         self.uuid_nb_logs  = '000d'
         self.uuid_lastransfer = '000e'
+        self.uuid_live     = '0002'
         self.uuid_sensor   = '0003'
         self.uuid_alias    = '0004'
         self.uuid_live_set = '0005'
@@ -61,16 +170,26 @@ class ucache:
         self.uuid_data     = '0013'
         self.uuid_advertise  = '0014'
 
+    # Run function(*args) in a stage of the pipeline ('decode' or 'write'), or directly without pipeline
+    async def offload(self, stage, function, *args):
+        if self.pipeline is None:
+            return(function(*args))
+        return(await self.pipeline.run(stage, function, *args))
+    
     async def connect(self):
+        # Already connected, e.g. a session reused from a session_pool
+        if not self.disconnected:
+            return
         try:
             await self.client.connect()
             self.disconnected = False
+            self.characteristics = {}
         except Exception as e:
             logging.error(f'Failed to connect to {self.address}: {e}')
             raise
         pass
             
-    async def read_info(self):
+    async def read_info(self, use_cache=True):
         dis_service = '0000180A-0000-1000-8000-00805f9b34fb'
         dis_characteristics = {
             'manufacturer_name': '00002A29-0000-1000-8000-00805f9b34fb',
@@ -81,17 +200,37 @@ class ucache:
         }
         if self.disconnected:
             raise Exception('Not connected to device')
+        
+        # With a metadata cache, only the serial number and firmware revision are read, to check the cached information
+        cached_info = None
+        if use_cache and (self.metadata_cache is not None):
+            cached_info = self.metadata_cache.get(self.address, 'device_info')
+        if cached_info is not None:
+            characteristics_to_read = ['serial_number', 'firmware_revision']
+        else:
+            characteristics_to_read = list(dis_characteristics)
+        
         try:
-            for characteristic in dis_characteristics:
+            for characteristic in characteristics_to_read:
                 uuid = dis_characteristics[characteristic]
                 value = await self.client.read_gatt_char(uuid)
                 value_str = value.decode('utf-8').strip() if value else ''
                 self.device_info.update({characteristic: value_str})
-            return self.device_info # All the hardware information remains stored in the class
+            if cached_info is not None:
+                if self.metadata_cache.check(self.address, self.device_info['serial_number'], self.device_info['firmware_revision']):
+                    self.device_info.update(cached_info)
+                    return self.device_info
+                # Another device or a new firmware: the cache is outdated, read everything
+                for characteristic in dis_characteristics:
+                    if characteristic not in characteristics_to_read:
+                        value = await self.client.read_gatt_char(dis_characteristics[characteristic])
+                        self.device_info.update({characteristic: value.decode('utf-8').strip() if value else ''})
         except Exception as e:
             logging.error(f'Failed to read information from {self.address}: {e}')
             raise
-        pass
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(self.address, 'device_info', dict(self.device_info))
+        return self.device_info # All the hardware information remains stored in the class
     
     async def read_battery_level(self):
         battery_service = '0000180F-0000-1000-8000-00805f9b34fb'
@@ -142,27 +281,14 @@ class ucache:
                 return(dt_difference)
         return(dt_difference)
     
-    async def read_installed_sensor(self):
+    async def read_installed_sensor(self, use_cache=True):
         service_uuid = self.uuid_sensor
         current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
         
-        # Based on Table 10 in the API manual. This dictionnary is incomplete but can be completed from the API manual
-        sensor_list = {0: {'name': None, 'description': 'No sensor chosen', 'outputs': 0, 'params': None, 'units': None},
-                       1: {'name': 'SP-110', 'description': 'Pyranometer', 'outputs': 1, 'params': 'S', 'units': 'W m-2'},
-                       2: {'name': 'SP-510', 'description': 'Thermopile Pyranometer', 'outputs': 1, 'params': 'Sin', 'units': 'W m-2'},
-                       3: {'name': 'SP-610', 'description': 'Thermopile Pyranometer (Downward)', 'outputs': 1, 'params': 'Sout', 'units': 'W m-2'},
-                       4: {'name': 'SQ-110', 'description': 'Quantum (Electric)', 'outputs': 1, 'params': 'PPFD', 'units': 'μmol m-2 s-1'},
-                       5: {'name': 'SQ-120', 'description': 'Quantum (Solar)', 'outputs': 1, 'params': 'PPFD_artificial', 'units': 'μmol m-2 s-1'},
-                       6: {'name': 'SQ-500', 'description': 'Quantum (Full Spectrum)', 'outputs': 1, 'params': 'PPFD_full', 'units': 'μmol m-2 s-1'},
-                       7: {'name': 'SL-510', 'description': 'Pyrgeometer', 'outputs': 1, 'params': 'Lin', 'units': 'W m-2, °C'},
-                       8: {'name': 'SL-610', 'description': 'Pyrgeometer (Downward)', 'outputs': 1, 'params': 'Lout', 'units': 'W m-2, °C'},
-                       9: {'name': 'SI-100', 'description': 'IR Sensor', 'outputs': 2, 'params': 'Ts', 'units': '°C, °C'},
-                       10: {'name': 'SU-200', 'description': 'UV Sensor', 'outputs': 1, 'params': 'UV', 'units': 'W m-2'},
-                       11: {'name': 'SE-100', 'description': 'Photometric', 'outputs': 1, 'params': 'Lux', 'units': 'lm m-2'},
-                       12: {'name': 'S2-111', 'description': 'NDVI', 'outputs': 2, 'params': 'NDVI', 'units': 'W m-2, W m-2'},
-                       13: {'name': 'S2-112', 'description': 'NDVI (Downward)', 'outputs': 2, 'params': 'NDVIout', 'units': 'W m-2, W m-2'},
-                       20: {'name': 'SP-700', 'description': 'Albedometer', 'outputs': 2, 'params': 'Sin,Sout', 'units': 'W m-2, W m-2'},
-                       26: {'name': '2 Differential', 'description': '2 Differential Measurements', 'outputs': 2, 'params': 'D1,D2', 'units': 'mV, mV'}}
+        if use_cache and (self.metadata_cache is not None):
+            cached_sensor = self.metadata_cache.get(self.address, 'sensor')
+            if cached_sensor is not None:
+                return(cached_sensor)
         
         try:
             sensor_id_raw = await self.client.read_gatt_char(current_service)
@@ -172,31 +298,40 @@ class ucache:
             raise
         
         current_sensor = sensor_list[sensor_id]
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(self.address, 'sensor', current_sensor)
         return(current_sensor)
     
-    async def read_logging_settings(self, sampling_interval_s, logging_interval_s, start_time=None):
+    async def read_logging_settings(self, use_cache=True):
         service_uuid = self.uuid_log_set
         current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
         
+        if use_cache and (self.metadata_cache is not None):
+            cached_settings = self.metadata_cache.get(self.address, 'logging_settings')
+            if cached_settings is not None:
+                return(cached_settings)
+        
         try:
             data_bytes = await self.client.read_gatt_char(current_service)
-            return(set_interval_s)
         except Exception as e:
-            logging.error(f'Failed to set logging settings at {self.address}: {e}')
+            logging.error(f'Failed to read logging settings at {self.address}: {e}')
             raise
         # Success, now convert data to dict
-        values = struct.unpack('<III', data)
-        keys = ['sampling_interval', 'logging_interval', 'starting_time'][:len(values)]
+        values = list(struct.unpack('<III', data_bytes))
+        keys = ['sampling_interval', 'logging_interval', 'starting_time']
         if(values[2] == 0): # Data logging is disabled, so start_time is 0 (replace with None)
             values[2] = None
-        return dict(zip(keys, values))
+        settings = dict(zip(keys, values))
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(self.address, 'logging_settings', settings)
+        return(settings)
     
     async def read_logging_status(self):
         service_uuid = self.uuid_logging
         current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
         try:
             logging_status_raw = await self.client.read_gatt_char(current_service)
-            logging_status = bool(struct.unpack('<B', logging_status_raw))
+            logging_status = bool(struct.unpack('<B', logging_status_raw)[0] & 0x01)
             return(logging_status)
         except Exception as e:
             logging.error(f'Failed to read logging status at {self.address}: {e}')
@@ -213,6 +348,10 @@ class ucache:
         except Exception as e:
             logging.error(f'Failed to set logging status at {self.address}: {e}')
             raise
+        finally:
+            # The start time of the logging settings changes
+            if self.metadata_cache is not None:
+                self.metadata_cache.invalidate(self.address, 'logging_settings')
         pass
     
     async def read_log_full_time(self):
@@ -270,23 +409,127 @@ class ucache:
             raise
         pass
     
-    async def transfer_data(self, silent=True):
+    # Look up the characteristic of a UUID once per connection, so that reads do not have to search the services again
+    def resolve_characteristic(self, uuid):
+        if uuid not in self.characteristics:
+            characteristic = None
+            try:
+                characteristic = self.client.services.get_characteristic(uuid)
+            except Exception:
+                pass
+            # If the services are not available, reading by UUID still works
+            self.characteristics[uuid] = characteristic if characteristic is not None else uuid
+        return(self.characteristics[uuid])
+    
+    # Read all the status information of the device in one pass. The reads are issued concurrently,
+    # so that the backend can pipeline them instead of waiting for each round trip
+    async def read_status_snapshot(self, concurrent=True):
+        dis_uuid = '0000xxxx-0000-1000-8000-00805f9b34fb'
+        uuids = {'manufacturer_name': dis_uuid.replace('xxxx', '2A29'),
+                 'model_number': dis_uuid.replace('xxxx', '2A24'),
+                 'serial_number': dis_uuid.replace('xxxx', '2A25'),
+                 'firmware_revision': dis_uuid.replace('xxxx', '2A26'),
+                 'hardware_revision': dis_uuid.replace('xxxx', '2A27'),
+                 'battery_level': dis_uuid.replace('xxxx', '2A19'),
+                 'time': self.base_apogee_service_uuid.replace('xxxx', self.uuid_time),
+                 'logging_status': self.base_apogee_service_uuid.replace('xxxx', self.uuid_logging),
+                 'sensor': self.base_apogee_service_uuid.replace('xxxx', self.uuid_sensor),
+                 'nb_logs': self.base_apogee_service_uuid.replace('xxxx', self.uuid_nb_logs),
+                 'last_transferred_time': self.base_apogee_service_uuid.replace('xxxx', self.uuid_lastransfer),
+                 'log_full_time': self.base_apogee_service_uuid.replace('xxxx', self.uuid_logfull),
+                 'logging_settings': self.base_apogee_service_uuid.replace('xxxx', self.uuid_log_set)}
+        if self.disconnected:
+            raise Exception('Not connected to device')
+        
+        # Cached metadata does not need to be read, only the serial number and firmware revision to check it
+        cached_info = None
+        cached_sensor = None
+        cached_settings = None
+        if self.metadata_cache is not None:
+            cached_info = self.metadata_cache.get(self.address, 'device_info')
+            cached_sensor = self.metadata_cache.get(self.address, 'sensor')
+            cached_settings = self.metadata_cache.get(self.address, 'logging_settings')
+        if cached_info is not None:
+            for characteristic in ['manufacturer_name', 'model_number', 'hardware_revision']:
+                del uuids[characteristic]
+        if cached_sensor is not None:
+            del uuids['sensor']
+        if cached_settings is not None:
+            del uuids['logging_settings']
+        
+        try:
+            characteristics = [self.resolve_characteristic(uuid) for uuid in uuids.values()]
+            if concurrent:
+                values = await asyncio.gather(*[self.client.read_gatt_char(characteristic) for characteristic in characteristics])
+            else:
+                values = [await self.client.read_gatt_char(characteristic) for characteristic in characteristics]
+        except Exception as e:
+            logging.error(f'Failed to read status from {self.address}: {e}')
+            raise
+        raw = dict(zip(uuids.keys(), values))
+        
+        # Device information
+        for characteristic in ['manufacturer_name', 'model_number', 'serial_number', 'firmware_revision', 'hardware_revision']:
+            if characteristic in raw:
+                value = raw[characteristic]
+                self.device_info.update({characteristic: value.decode('utf-8').strip() if value else ''})
+        if cached_info is not None:
+            if self.metadata_cache.check(self.address, self.device_info['serial_number'], self.device_info['firmware_revision']):
+                self.device_info.update({key: value for key, value in cached_info.items() if key not in raw})
+            else: # Another device or a new firmware, the cache entry was dropped
+                await self.read_info(use_cache=False)
+                cached_sensor = None
+                cached_settings = None
+        elif self.metadata_cache is not None:
+            self.metadata_cache.set(self.address, 'device_info', dict(self.device_info))
+        # Installed sensor
+        if cached_sensor is not None:
+            sensor = cached_sensor
+        elif 'sensor' in raw:
+            sensor = sensor_list[struct.unpack('<B', raw['sensor'])[0]]
+            if self.metadata_cache is not None:
+                self.metadata_cache.set(self.address, 'sensor', sensor)
+        else:
+            sensor = await self.read_installed_sensor(use_cache=False)
+        # Logging settings
+        if cached_settings is not None:
+            settings = cached_settings
+        elif 'logging_settings' in raw:
+            values = struct.unpack('<III', raw['logging_settings'])
+            settings = {'sampling_interval': values[0], 'logging_interval': values[1],
+                        'starting_time': values[2] if values[2] > 0 else None}
+            if self.metadata_cache is not None:
+                self.metadata_cache.set(self.address, 'logging_settings', settings)
+        else:
+            settings = await self.read_logging_settings(use_cache=False)
+        # Status. Timestamps of 0 mean that logging is disabled or that the log is empty
+        nb_logs = struct.unpack('<III', raw['nb_logs'])
+        last_transferred_time = struct.unpack('<I', raw['last_transferred_time'])[0]
+        log_full_time = struct.unpack('<I', raw['log_full_time'])[0]
+        return(status_snapshot(battery_level=struct.unpack('<B', raw['battery_level'])[0],
+                               time=struct.unpack('<I', raw['time'])[0],
+                               logging_status=bool(struct.unpack('<B', raw['logging_status'])[0] & 0x01),
+                               sensor=sensor,
+                               nb_logs_available=nb_logs[0],
+                               oldest_log_time=nb_logs[1] if nb_logs[1] > 0 else None,
+                               total_logs=nb_logs[2],
+                               last_transferred_time=last_transferred_time if last_transferred_time > 0 else None,
+                               log_full_time=log_full_time if log_full_time > 0 else None,
+                               sampling_interval=settings['sampling_interval'],
+                               logging_interval=settings['logging_interval'],
+                               **self.device_info))
+    
+    async def transfer_data(self, silent=True, timeout=None, idle_timeout=10):
+        # timeout: max. duration of the whole transfer in s (None: no limit)
+        # idle_timeout: max. time in s without any notification before the transfer is aborted
         service_uuid = self.uuid_data
         current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
         # Re-initialise dataset
         self.current_dataset = []
         
-        #global received_data
         received_data = []
-        async def notifications_callback(sender, data):
-            # Check if the data bytes are FF-FF-FF-FF
-            if data == b'\xFF\xFF\xFF\xFF':
-                # Stop listening to notifications
-                await self.client.stop_notify(current_service)
-            else:
-                # Append the data to the list
-                received_data.append(data)
-                
+        transfer_done = asyncio.Event()
+        
         def visualise_progress(percent_progress, previous):
             for dots in range(0, percent_progress-previous):
                 print('.', end='')
@@ -294,68 +537,249 @@ class ucache:
                 print('')
             pass
         
-        # Read data until everything has been received
+        # Number of logs the device announces, used for progress and to check the result
         nb_logs = await self.read_nb_logs_available()
-        percent_transferred = 0
-        previous_percent = 0
+        nb_expected = nb_logs[0]
+        if(nb_expected == 0):
+            return(self.current_dataset)
+        progress = {'previous_percent': 0}
+        end_received = {'value': False}
+        
+        def notifications_callback(sender, data):
+            # The data bytes FF-FF-FF-FF mark the end of the transfer
+            if data == b'\xFF\xFF\xFF\xFF':
+                end_received['value'] = True
+                transfer_done.set()
+                return
+            received_data.append(data)
+            # Notifications can be lost, the terminator too: the transfer is also over once all the logs are there
+            if(len(received_data) >= nb_expected):
+                transfer_done.set()
+            # Show transfer progress
+            if not silent:
+                percent_transferred = min(int(len(received_data) * 100 / nb_expected), 100)
+                visualise_progress(percent_transferred, progress['previous_percent'])
+                progress['previous_percent'] = percent_transferred
+        
+        async def wait_for_end_of_transfer():
+            # Wakes up only when the terminator arrives, or to check that data is still flowing
+            while not transfer_done.is_set():
+                nb_received = len(received_data)
+                try:
+                    await asyncio.wait_for(transfer_done.wait(), timeout=idle_timeout)
+                except asyncio.TimeoutError:
+                    if(len(received_data) == nb_received):
+                        raise
+        
+        # Subscribe once, the device then streams all entries followed by the terminator
         if not silent: print('    ', end='')
-        for i in range(1, nb_logs[0]):
-            if(len(received_data) == nb_logs[0]):
-                break
-            # Start listening to notifications
+        transfer_start_time = time.perf_counter()
+        timed_out = False
+        try:
+            await self.client.start_notify(current_service, notifications_callback)
+            await asyncio.wait_for(wait_for_end_of_transfer(), timeout=timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            logging.error(f'Data transfer from {self.address} timed out after {len(received_data)} of {nb_expected} logs')
+        finally:
+            # Notifications must be turned off and on again to receive more entries
             try:
-                await self.client.start_notify(current_service, notifications_callback)
-                # Wait until the last data packet is received
-                while not received_data:
-                    await asyncio.sleep(0.1)
-            except:
-                try:
-                    await self.client.stop_notify(current_service)
-                except:
-                    break
-            # Show transfer progress
-            percent_transferred = len(received_data) * 100 / nb_logs[0]
-            if not silent: visualise_progress(int(percent_transferred), previous_percent)
-            previous_percent = int(percent_transferred)
+                await self.client.stop_notify(current_service)
+            except Exception as e:
+                logging.error(f'Failed to stop notifications at {self.address}: {e}')
+        if not silent and (progress['previous_percent'] < 100): print('')
+        # The device moves its last transferred time as it sends the entries. Without the terminator, it may
+        # have gone past entries that were not received: it is set back to the last entry received
+        if not end_received['value'] and received_data:
+            try:
+                await self.write_last_transferred_time(struct.unpack('<I', received_data[-1][:4])[0])
+            except Exception:
+                pass # e.g. disconnected, the caller then resumes from what it stored
+        
+        if(not timed_out and len(received_data) < nb_expected):
+            logging.warning(f'Incomplete data transfer from {self.address}: received {len(received_data)} of {nb_expected} logs')
+        if self.metrics is not None:
+            transfer_duration = time.perf_counter() - transfer_start_time
+            nb_bytes = sum(len(data) for data in received_data)
+            self.metrics.record('transfer_seconds', transfer_duration, address=self.address)
+            self.metrics.record('transfer_records', len(received_data), address=self.address)
+            self.metrics.record('transfer_missing_records', max(nb_expected - len(received_data), 0), address=self.address)
+            if(transfer_duration > 0):
+                self.metrics.record('transfer_records_per_second', len(received_data) / transfer_duration, address=self.address)
+                self.metrics.record('transfer_bytes_per_second', nb_bytes / transfer_duration, address=self.address)
         
         # Interpret data
-        for row in received_data:
-            # Unpack the unsigned 32-bit integer
-            sampling_time = struct.unpack('<I', row[:4])[0]
-            # Calculate the number of remaining bytes
-            num_remaining_bytes = len(row) - 4
-            # Unpack the signed 32-bit integers
-            if num_remaining_bytes % 4 != 0:
-                raise ValueError('Invalid data length')
-            num_values = num_remaining_bytes // 4
-            raw_values = list(struct.unpack('<{}i'.format(num_values), row[4:]))
-            values = [x / 10000.0 for x in raw_values] # The original data is stored with an exponent -4
-            self.current_dataset.append([sampling_time] + values)
+        if self.use_numpy:
+            sensor = await self.read_installed_sensor()
+            self.current_dataset = await self.offload('decode', decode_logs_array, received_data, sensor['outputs'])
+        else:
+            self.current_dataset = await self.offload('decode', decode_logs, received_data)
         
+        self.nb_transferred = len(self.current_dataset)
+        if timed_out:
+            raise asyncio.TimeoutError(f'Data transfer from {self.address} timed out')
         return(self.current_dataset)
     
-    async def write_datafile(self, file_path):
-        # Get the header
-        sensor = await self.read_installed_sensor()
-        header_params = 'timestamp,' + sensor['params']
-        header_units = ',' + sensor['units']
-        header_params = header_params.split(',')
-        header_units = header_units.split(',')
+    # Stream the data log: yields decoded batches of up to batch_size records while the transfer is running.
+    # At most max_batches undecoded batches are buffered. When the consumer falls behind, notifications are
+    # paused, so memory use stays flat. The transfer is resumed from the last buffered timestamp once the consumer
+    # has asked for the batch after it, i.e. once it has handled (e.g. stored) all the buffered batches: the last
+    # transferred time is never moved past records that are not stored yet.
+    async def iter_records(self, batch_size=64, max_batches=16, timeout=None, idle_timeout=10):
+        service_uuid = self.uuid_data
+        current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
         
-        # Check if file already exists to determine whether to write header
-        write_header = not os.path.isfile(file_path)
-
-        # Open the file in write mode and create a CSV writer
-        with open(file_path, mode='a', newline='') as f:
-            writer = csv.writer(f)
-            # Write header if file is new
-            if write_header:
-                writer.writerow(header_params)
-                writer.writerow(header_units)
-            # Write data
-            for row in self.current_dataset:
-                row[0] = str(datetime.datetime.fromtimestamp(row[0]))
-                writer.writerow(row)
+        nb_logs = await self.read_nb_logs_available()
+        if(nb_logs[0] == 0):
+            return
+        nb_outputs = None
+        if self.use_numpy:
+            sensor = await self.read_installed_sensor()
+            nb_outputs = sensor['outputs']
+        
+        queue = asyncio.Queue()
+        state = {'batch': [], 'paused': False, 'last_timestamp': None}
+        
+        def notifications_callback(sender, data):
+            # Entries received while paused are dropped, they are transferred again after resuming
+            if state['paused']:
+                return
+            # The data bytes FF-FF-FF-FF mark the end of the transfer
+            if data == b'\xFF\xFF\xFF\xFF':
+                if state['batch']:
+                    queue.put_nowait(state['batch'])
+                    state['batch'] = []
+                queue.put_nowait(None)
+                return
+            state['batch'].append(data)
+            if(len(state['batch']) >= batch_size):
+                queue.put_nowait(state['batch'])
+                state['last_timestamp'] = struct.unpack('<I', data[:4])[0]
+                state['batch'] = []
+                if(queue.qsize() >= max_batches):
+                    state['paused'] = True
+        
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        notifying = False
+        try:
+            await self.client.start_notify(current_service, notifications_callback)
+            notifying = True
+            while True:
+                if state['paused']:
+                    # Stop the device from sending more entries until the consumer has caught up
+                    if notifying:
+                        await self.client.stop_notify(current_service)
+                        notifying = False
+                    # The loop is back here after each batch, once the consumer is done with it
+                    if queue.empty():
+                        await self.write_last_transferred_time(state['last_timestamp'])
+                        state['paused'] = False
+                        await self.client.start_notify(current_service, notifications_callback)
+                        notifying = True
+                wait_time = idle_timeout
+                if deadline is not None:
+                    wait_time = min(wait_time, max(deadline - loop.time(), 0))
+                try:
+                    batch = await asyncio.wait_for(queue.get(), timeout=wait_time)
+                except asyncio.TimeoutError:
+                    logging.error(f'Data transfer from {self.address} timed out')
+                    raise
+                if batch is None:
+                    break
+                if self.use_numpy:
+                    yield await self.offload('decode', decode_logs_array, batch, nb_outputs)
+                else:
+                    yield await self.offload('decode', decode_logs, batch)
+        finally:
+            # Notifications must be turned off and on again to receive more entries
+            if notifying:
+                try:
+                    await self.client.stop_notify(current_service)
+                except Exception as e:
+                    logging.error(f'Failed to stop notifications at {self.address}: {e}')
+    
+    # Transfer the data log batch by batch, writing each batch to the data file before going on.
+    # After each flushed batch, the timestamp of its last entry is saved in the checkpoint_store and, at the end,
+    # written to the device as the last transferred time. An interrupted transfer resumes from the checkpoint.
+    # Returns the number of entries written
+    # With resume=False, the transfer starts from the last transferred time of the device, e.g. when it was just set
+    async def checkpointed_transfer(self, datafile, checkpoint, batch_size=256, timeout=None, idle_timeout=10, resume=True):
+        # Resume from the last entry that was actually stored
+        stored_time = checkpoint.get(self.address) if resume else None
+        last_transferred_time = await self.read_last_transferred_time()
+        if stored_time is not None:
+            if(last_transferred_time != stored_time):
+                await self.write_last_transferred_time(stored_time)
+        else:
+            # The device moves its last transferred time while it sends the entries: if the link drops before the
+            # first batch is stored, the next transfer must start from here again (0: from the oldest entry)
+            checkpoint.set(self.address, last_transferred_time or 0)
+        # The sensor of a new data file is read now, there is no GATT operation while the entries stream in
+        sensor = None
+        if self.storage(datafile).needs_sensor(self.device_info.get('serial_number', self.address)):
+            sensor = await self.read_installed_sensor()
+        
+        self.current_dataset = []
+        self.nb_transferred = 0
+        last_stored_time = None
+        try:
+            async for batch in self.iter_records(batch_size=batch_size, timeout=timeout, idle_timeout=idle_timeout):
+                if(len(batch) == 0):
+                    continue
+                batch_last_time = int(batch['timestamp'][-1]) if self.use_numpy else batch[-1][0]
+                await self.write_datafile(datafile, batch, fsync=True, sensor=sensor)
+                checkpoint.set(self.address, batch_last_time)
+                last_stored_time = batch_last_time
+                self.nb_transferred += len(batch)
+        finally:
+            await self.save_aggregates()
+            # Only now that the data is stored, the device is told what has been transferred
+            if(last_stored_time is not None) and not self.disconnected:
+                try:
+                    await self.write_last_transferred_time(last_stored_time)
+                except Exception:
+                    pass # Not a problem, the checkpoint is used on the next transfer
+        return(self.nb_transferred)
+    
+    # Storage backend of a data file: a backend (see storage.py), or a CSV file path
+    def storage(self, file_path):
+        return(file_path if isinstance(file_path, storage_backend) else csv_backend(file_path))
+    
+    async def write_datafile(self, file_path, dataset=None, fsync=False, sensor=None):
+        # file_path is a CSV file, or a storage backend (see storage.py)
+        # By default the last downloaded dataset is written, but batches (e.g. from iter_records()) can be passed too
+        # With fsync=True, the data is on disk when the function returns
+        # sensor is the installed sensor if it is already known, otherwise it is read from the device when needed
+        if dataset is None:
+            dataset = self.current_dataset
+        if self.metrics is not None:
+            write_start_time = time.perf_counter()
+        
+        storage = self.storage(file_path)
+        serial = self.device_info.get('serial_number', self.address)
+        # Get the sensor (only needed for the header of a new file)
+        if not storage.needs_sensor(serial):
+            sensor = None
+        elif sensor is None:
+            sensor = await self.read_installed_sensor()
+        await self.offload('write', storage.write, serial, dataset, sensor, fsync)
+        if self.aggregator is not None:
+            await self.offload('write', self.aggregate, serial, dataset)
+        
+        if self.metrics is not None:
+            self.metrics.record('write_datafile_seconds', time.perf_counter() - write_start_time, address=self.address)
+            self.metrics.record('write_datafile_records', len(dataset), address=self.address)
+        pass
+    
+    # The statistics are only updated in memory, save_aggregates() writes them once the transfer is over
+    def aggregate(self, serial, dataset):
+        self.aggregator.add(serial, dataset)
+        pass
+    
+    async def save_aggregates(self):
+        if self.aggregator is not None:
+            await self.offload('write', self.aggregator.save)
         pass
     
     async def set_advertising_frequency(self, freq=0):
@@ -404,6 +828,9 @@ class ucache:
         except Exception as e:
             logging.error(f'Failed to set logging settings at {self.address}: {e}')
             raise
+        finally:
+            if self.metadata_cache is not None:
+                self.metadata_cache.invalidate(self.address, 'logging_settings')
         pass
         
     async def set_live_settings(self, avg_time_s):
@@ -411,7 +838,7 @@ class ucache:
         current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
         
         # Convert the value from seconds to units of 0.25 seconds
-        avg_time_units = avg_time_s / 0.25
+        avg_time_units = int(avg_time_s / 0.25) # Rounded down
         avg_time_units = min(max(avg_time_units, 0), 127)  # Clamp the value to the valid range
         avg_time_units_bytes = bytes([avg_time_units])
         # Convert back to the set interval (to inform the user)
@@ -424,6 +851,74 @@ class ucache:
             raise
         pass
         
+    # Live data: the device sends the values of its sensor outputs about every 0.5s, averaged over the
+    # time set with set_live_settings(). Each reading (reception time, values) is stored in a live_buffer
+    # (see live.py) of capacity readings, which is returned. callback(timestamp, values) is also called for
+    # each reading, if given. Keeping the connection open drains the battery, so stop_live() when done
+    async def start_live(self, capacity=7200, callback=None):
+        service_uuid = self.uuid_live
+        current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
+        
+        sensor = await self.read_installed_sensor()
+        nb_outputs = sensor['outputs']
+        if(nb_outputs == 0):
+            raise Exception(f'No sensor installed on {self.address}')
+        params = sensor['params'].split(',') if sensor['params'] else []
+        self.live_params = params if len(params) == nb_outputs else ['value_' + str(i + 1) for i in range(nb_outputs)]
+        # The buffer is kept between start_live() calls, so that streams can continue
+        if(self.live is None) or (self.live.capacity != capacity) or (self.live.nb_outputs != nb_outputs):
+            self.live = live_buffer(capacity, nb_outputs)
+        self.live.closed = False
+        live = self.live
+        unpack = struct.Struct('<{}i'.format(nb_outputs)).unpack_from
+        
+        def notifications_callback(sender, data):
+            timestamp = time.time()
+            if(len(data) >= 4 * nb_outputs):
+                raw_values = unpack(data)
+            else:
+                raw_values = struct.unpack('<{}i'.format(len(data) // 4), data[:len(data) // 4 * 4])
+            values = [x / 10000.0 for x in raw_values] # The original data is stored with an exponent -4
+            live.append(timestamp, values)
+            if callback is not None:
+                callback(timestamp, values)
+        
+        try:
+            await self.client.start_notify(current_service, notifications_callback)
+        except Exception as e:
+            logging.error(f'Failed to start live data at {self.address}: {e}')
+            raise
+        return(live)
+    
+    async def stop_live(self):
+        service_uuid = self.uuid_live
+        current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
+        if self.live is None:
+            return
+        try:
+            await self.client.stop_notify(current_service)
+        except Exception as e:
+            logging.error(f'Failed to stop live data at {self.address}: {e}')
+            raise
+        finally:
+            self.live.close()
+        pass
+    
+    # Latest live reading as a dictionnary (timestamp and one key per sensor output), None if there is none yet
+    def read_live(self):
+        reading = self.live.latest() if self.live is not None else None
+        if reading is None:
+            return(None)
+        return(dict(zip(['timestamp'] + self.live_params, (reading[0],) + reading[1])))
+    
+    # Async stream of the live readings as dictionnaries, like read_live(). Ends when stop_live() is called
+    async def stream_live(self, from_start=False):
+        if self.live is None:
+            raise Exception('Live data not started, use start_live()')
+        keys = ['timestamp'] + self.live_params
+        async for timestamp, values in self.live.stream(from_start):
+            yield dict(zip(keys, (timestamp,) + values))
+    
     async def set_alias(self, alias):
         service_uuid = self.uuid_alias
         current_service = self.base_apogee_service_uuid.replace('xxxx', service_uuid)
@@ -437,7 +932,11 @@ class ucache:
             raise
         pass
     
+    # file_path can also be a storage backend holding the operational log (e.g. storage.sqlite_backend)
     def write_logfile(self, file_path, data, header):
+        if isinstance(file_path, storage_backend):
+            file_path.write_log(dict(zip(header, data)))
+            return
         # Check if file already exists to determine whether to write header
         write_header = not os.path.isfile(file_path)
         
@@ -451,7 +950,13 @@ class ucache:
             writer.writerow(data)
         pass
     
-    async def disconnect(self):
+    # With keep_connected, the connection is only closed with force=True
+    async def disconnect(self, force=False):
+        if self.keep_connected and not force:
+            return
+        # Live data streams end with the connection
+        if self.live is not None:
+            self.live.close()
         if not self.disconnected:
             try:
                 await self.client.disconnect()
@@ -518,7 +1023,7 @@ class ucache:
         if not silent: print('  - Disconnecting')
         await self.disconnect()
         
-        if not silent: print('  - Writing log to ' + logfile)
+        if not silent: print('  - Writing log to ' + str(logfile))
         data = [str(datetime.datetime.fromtimestamp(time)),
                 device_info['model_number'],
                 device_info['serial_number'],
@@ -534,44 +1039,48 @@ class ucache:
                   'serial',
                   'battery_level',
                   'memory_full_time',
-                  'type'
+                  'type',
                   'sampling_interval',
                   'logging_interval',
                   'advertising_freq',
                   'time_difference']
-        self.write_logfile(logfile, data, header)
+        await self.offload('write', self.write_logfile, logfile, data, header)
         return
     
-    async def download_routine(self, datafile, logfile, from_timestamp=None, silent=True):
+    # Returns the outcome: 'connection failed', 'not logging', 'not enough logs' or 'downloaded'
+    # With a checkpoint_store, the data is written while it is transferred, and interrupted transfers are resumed
+    async def download_routine(self, datafile, logfile, from_timestamp=None, silent=True, checkpoint=None):
         if not silent: print('  - Connecting to device')
         try:
             await self.connect()
         except:
-            return
+            return('connection failed')
     
+        # All status information is read at once
         if not silent: print('  - Reading device information:')
-        device_info = await self.read_info()
+        status = await self.read_status_snapshot()
+        self.status = status
+        device_info = self.device_info
         if not silent: print('      Type:  ', device_info['manufacturer_name'], device_info['model_number'])
         if not silent: print('      Serial:', device_info['serial_number'])
         if not silent: print('      Firmware rev.:', device_info['firmware_revision'])
         if not silent: print('      Hardware rev.:', device_info['hardware_revision'])
     
         if not silent: print('  - Reading battery level:')
-        battery_level = await self.read_battery_level()
+        battery_level = status.battery_level
         if not silent: print('      Level: ' + str(battery_level) + '%')
     
         if not silent: print('  - Reading device time:')
-        time = await self.read_time()
+        time = status.time
         if not silent: print('      Device Time: ' + str(datetime.datetime.fromtimestamp(time)))
     
         # Check if device is logging
         # If false don't even bother downloading
         if not silent: print('  - Checking if device is logging: ', end='')
-        logging = await self.read_logging_status()
-        if(logging == False):
+        if(status.logging_status == False):
             if not silent: print('No. Abort')
             await self.disconnect()
-            return
+            return('not logging')
         if not silent: print('Yes')
     
         # To download data from a specific timestamp
@@ -586,22 +1095,46 @@ class ucache:
                 if not silent: print(datetime.datetime.fromtimestamp(transfer_time_unix))
             await self.write_last_transferred_time(transfer_time_unix)
             pass
+        # Otherwise, resume from the last entry that was stored
+        resumed = False
+        if(from_timestamp is None) and (checkpoint is not None) and (checkpoint.get(self.address) is not None):
+            if(checkpoint.get(self.address) != status.last_transferred_time):
+                if not silent: print('  - Resuming from checkpoint: ' + str(datetime.datetime.fromtimestamp(checkpoint.get(self.address))))
+                await self.write_last_transferred_time(checkpoint.get(self.address))
+                resumed = True
     
         # Read number of logs to be downloaded, and timestamp of last downloaded one
         if not silent: print('  - Checking number of logs:')
         min_logs = 5 # Minimum log number for downloads
-        nb_logs = await self.read_nb_logs_available()
-        last_transferred_time = await self.read_last_transferred_time()
+        if(from_timestamp is not None) or resumed: # Changed by the new transfer time
+            nb_logs = await self.read_nb_logs_available()
+            last_transferred_time = await self.read_last_transferred_time()
+        else:
+            nb_logs = [status.nb_logs_available, status.oldest_log_time, status.total_logs]
+            last_transferred_time = status.last_transferred_time
         if not silent: print('      ' + str(nb_logs[0]) + ' logs, last transferred log from ' + \
                              str(datetime.datetime.fromtimestamp(last_transferred_time)))
         if(nb_logs[0] < min_logs):
             if not silent: print('      Less than ' + str(min_logs) + ' logs available, do not download')
             await self.disconnect()
-            return
+            return('not enough logs')
     
         # Download data, is stored in self.current_dataset
         if not silent: print('  - Downloading data')
-        await self.transfer_data(silent=silent)
+        if checkpoint is not None:
+            if not silent: print('    Writing data to ' + str(datafile) + ' while downloading')
+            # Resuming from the checkpoint is done above, an explicit from_timestamp wins over it
+            await self.checkpointed_transfer(datafile, checkpoint, resume=False)
+        else:
+            try:
+                await self.transfer_data(silent=silent)
+            except asyncio.TimeoutError:
+                # The entries received before the timeout are stored, the next transfer starts after them
+                if(len(self.current_dataset) > 0):
+                    if not silent: print('  - Writing the ' + str(len(self.current_dataset)) + ' logs received to ' + str(datafile))
+                    await self.write_datafile(datafile)
+                    await self.save_aggregates()
+                raise
     
         # Fix time if necessary, comparing to computer time
         tolerance = 2 # If <2s difference between the computer and the device, no update done
@@ -613,19 +1146,26 @@ class ucache:
             if not silent: print('      Time was updated. Difference: ' + str(time_difference) + 's')
         
         if not silent: print('  - Checking when memory will be full')
+        # None when datalogging is disabled
         memory_full_time = await self.read_log_full_time()
-        if not silent: print('      Memory will be full on: ' + str(datetime.datetime.fromtimestamp(memory_full_time)))
+        self.log_full_time = memory_full_time
+        if memory_full_time is None:
+            if not silent: print('      Datalogging is disabled')
+        else:
+            if not silent: print('      Memory will be full on: ' + str(datetime.datetime.fromtimestamp(memory_full_time)))
     
         # Write data to file
-        if not silent: print('  - Writing data to ' + datafile)
-        await self.write_datafile('./data.csv')
+        if checkpoint is None:
+            if not silent: print('  - Writing data to ' + str(datafile))
+            await self.write_datafile(datafile)
+            await self.save_aggregates()
     
-        if not silent: print('  - Writing log to ' + logfile)
+        if not silent: print('  - Writing log to ' + str(logfile))
         data = [str(datetime.datetime.fromtimestamp(time)),
                 device_info['model_number'],
                 device_info['serial_number'],
                 battery_level,
-                str(datetime.datetime.fromtimestamp(memory_full_time)),
+                str(datetime.datetime.fromtimestamp(memory_full_time)) if memory_full_time is not None else '',
                 'data transfer',
                 '',
                 '',
@@ -636,15 +1176,16 @@ class ucache:
                   'serial',
                   'battery_level',
                   'memory_full_time',
-                  'type'
+                  'type',
                   'sampling_interval',
                   'logging_interval',
                   'advertising_freq',
                   'time_difference']
-        self.write_logfile(logfile, data, header)
+        await self.offload('write', self.write_logfile, logfile, data, header)
     
         if not silent: print('  - Disconnecting')
         await self.disconnect()
         
-        return
+        # The logs announced by the device may not come (e.g. lost notifications)
+        return('downloaded' if self.nb_transferred > 0 else 'not enough logs')
         
\ No newline at end of file
@@ -0,0 +1,98 @@
+import collections
+import csv
+import datetime
+import os
+from .storage import csv_backend, npy_backend, search_time, to_array
+
+# Reading months of harvested data without loading them
+#
+# The segments of an npy_backend are fixed-width binary records (uint32 timestamp, then the float64 values),
+# sorted by time. An archive_reader memory-maps them: opening the archive only lists the segment names,
+# the records of a time range are found by binary search on the timestamp column, and they are returned as
+# read-only NumPy views of the files. Only the pages holding the requested records are read from the disk,
+# so memory use is proportional to the slice, whatever the size of the archive.
+#
+# Existing CSV files (written by write_datafile()) can be converted once with import_csv().
+#
+#   archive.import_csv('./data_1234.csv', './archive')
+#   reader = archive.archive_reader('./archive')
+#   data = reader.read('1234', start_time=1672531200, end_time=1675209600)
+#   for view in reader.views('1234'): # One view per segment, nothing is copied
+#       ...
+
+class archive_reader(npy_backend):
+    # At most max_open segments stay memory-mapped, the least recently used are closed
+    def __init__(self, directory, partition='month', max_open=64):
+        super().__init__(directory, partition)
+        self.max_open = max_open
+        self.open_segments = collections.OrderedDict()
+
+    def load_segment(self, file_path):
+        array = self.open_segments.pop(file_path, None)
+        if array is None:
+            array = super().load_segment(file_path)
+        self.open_segments[file_path] = array
+        if(len(self.open_segments) > self.max_open):
+            self.open_segments.popitem(last=False)
+        return(array)
+
+    # Serial numbers of the devices in the archive
+    def devices(self):
+        if not os.path.isdir(self.directory):
+            return([])
+        return(sorted(name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name))))
+
+    # First and last timestamps stored for a device (from the segment names), None if there is no data
+    def time_range(self, serial):
+        segments = self.segments(serial)
+        if not segments:
+            return(None)
+        return(min(segment[0] for segment in segments), max(segment[1] for segment in segments))
+
+    # Number of records between start_time and end_time, without reading them
+    def count(self, serial, start_time=None, end_time=None):
+        return(sum(len(view) for view in self.views(serial, start_time, end_time)))
+
+    # Index of the first record at or after timestamp in each segment, e.g. to read the data in fixed chunks
+    def positions(self, serial, timestamp):
+        return([(file_path, search_time(self.load_segment(file_path), timestamp))
+                for first_time, last_time, file_path in self.segments(serial)])
+
+    # Nothing is written through a reader
+    def write(self, serial, dataset, sensor=None, fsync=False):
+        raise NotImplementedError('archive_reader is read only, use npy_backend to write')
+
+    def close(self):
+        self.open_segments.clear()
+        pass
+
+# Convert a CSV file written by write_datafile() to an archive (npy_backend layout), chunk_size rows at a
+# time. serial defaults to the name of the file (data_<serial>.csv). Records already in the archive are
+# left out, so a file can be imported again after new data was appended to it. Returns the number of rows read
+def import_csv(file_path, directory, serial=None, partition='month', chunk_size=100000):
+    if serial is None:
+        serial = os.path.splitext(os.path.basename(file_path))[0].split('_')[-1]
+    storage = npy_backend(directory, partition)
+    nb_rows = 0
+    with open(file_path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader) # Header: parameters
+        next(reader) # Header: units
+        sensor = csv_backend(file_path).read_sensor(serial)
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            # Rows of a different width than the first one (e.g. another sensor) cannot be in the same archive
+            if(len(row) - 1 != sensor['outputs']):
+                raise ValueError(f'{file_path}: {len(row) - 1} values in a row at {row[0]}, {sensor["outputs"]} expected')
+            timestamp = int(datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S').timestamp())
+            rows.append([timestamp] + [float(value) if value != '' else float('nan') for value in row[1:]])
+            if(len(rows) >= chunk_size):
+                storage.write(serial, to_array(rows, sensor['outputs']), sensor)
+                nb_rows += len(rows)
+                rows = []
+        if rows:
+            storage.write(serial, to_array(rows, sensor['outputs']), sensor)
+            nb_rows += len(rows)
+    return(nb_rows)
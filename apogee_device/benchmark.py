@@ -0,0 +1,150 @@
+import asyncio
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from . import apogee_device
+from . import simulator
+from .storage import numpy_module
+
+# Benchmarks of the transfer, decoding and file writing, against a simulated device (no Bluetooth needed)
+#
+# Each benchmark is run for several data log sizes and reports the number of records per second.
+# The results are printed (or written) as JSON, to compare them between versions:
+#   python -m apogee_device.benchmark --sizes 100 1000 10000 400000 --output results.json
+
+default_sizes = [100, 1000, 10000, 100000]
+
+def raw_logs(nb_logs, nb_outputs=1):
+    device = simulator.simulated_ucache(nb_logs=nb_logs, sensor_id=1 if nb_outputs == 1 else 20)
+    return([device.log_entry(index) for index in range(nb_logs)])
+
+# Notification ingestion and decoding: ucache.transfer_data() from a simulated device sending as fast as possible
+async def bench_transfer(nb_logs, use_numpy=False):
+    device = simulator.simulated_ucache(nb_logs=nb_logs)
+    ucache = apogee_device.ucache(device.address, client=device.client(), use_numpy=use_numpy)
+    await ucache.connect()
+    start_time = time.perf_counter()
+    await ucache.transfer_data()
+    duration = time.perf_counter() - start_time
+    await ucache.disconnect()
+    return(duration)
+
+# Notification ingestion and decoding in batches: ucache.iter_records()
+async def bench_iter_records(nb_logs, use_numpy=False):
+    device = simulator.simulated_ucache(nb_logs=nb_logs)
+    ucache = apogee_device.ucache(device.address, client=device.client(), use_numpy=use_numpy)
+    await ucache.connect()
+    start_time = time.perf_counter()
+    async for batch in ucache.iter_records(batch_size=256):
+        pass
+    duration = time.perf_counter() - start_time
+    await ucache.disconnect()
+    return(duration)
+
+async def bench_decode(nb_logs, use_numpy=False):
+    received_data = raw_logs(nb_logs, nb_outputs=2)
+    start_time = time.perf_counter()
+    if use_numpy:
+        apogee_device.decode_logs_array(received_data, 2)
+    else:
+        apogee_device.decode_logs(received_data)
+    return(time.perf_counter() - start_time)
+
+async def bench_write_datafile(nb_logs, use_numpy=False):
+    received_data = raw_logs(nb_logs)
+    device = simulator.simulated_ucache(nb_logs=0)
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    await ucache.connect()
+    if use_numpy:
+        dataset = apogee_device.decode_logs_array(received_data, 1)
+    else:
+        dataset = apogee_device.decode_logs(received_data)
+    with tempfile.TemporaryDirectory() as directory:
+        datafile = os.path.join(directory, 'data.csv')
+        # Write the header first, only the data rows are timed
+        await ucache.write_datafile(datafile, dataset[:0])
+        start_time = time.perf_counter()
+        await ucache.write_datafile(datafile, dataset)
+        duration = time.perf_counter() - start_time
+    await ucache.disconnect()
+    return(duration)
+
+# Complete download_routine(): status, transfer, time check, data file and log file
+async def bench_download_routine(nb_logs, use_numpy=False):
+    device = simulator.simulated_ucache(nb_logs=nb_logs)
+    ucache = apogee_device.ucache(device.address, client=device.client(), use_numpy=use_numpy)
+    with tempfile.TemporaryDirectory() as directory:
+        start_time = time.perf_counter()
+        await ucache.download_routine(os.path.join(directory, 'data.csv'), os.path.join(directory, 'logfile.csv'))
+        duration = time.perf_counter() - start_time
+    return(duration)
+
+benchmarks = {'transfer': bench_transfer,
+              'iter_records': bench_iter_records,
+              'decode': bench_decode,
+              'write_datafile': bench_write_datafile,
+              'download_routine': bench_download_routine}
+
+def environment():
+    try:
+        from importlib.metadata import version
+        package_version = version('pyucache')
+    except Exception:
+        package_version = None
+    np = numpy_module(required=False)
+    return({'package_version': package_version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'numpy': np.__version__ if np is not None else None,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+
+# Run the benchmarks, each one repeat times per size (the fastest run is kept)
+def run(names=None, sizes=None, repeat=3, numpy_modes=None, silent=True):
+    if names is None:
+        names = list(benchmarks)
+    if sizes is None:
+        sizes = default_sizes
+    if numpy_modes is None:
+        numpy_modes = [False, True] if numpy_module(required=False) is not None else [False]
+    results = []
+    for name in names:
+        for use_numpy in numpy_modes:
+            for nb_logs in sizes:
+                durations = [asyncio.run(benchmarks[name](nb_logs, use_numpy)) for i in range(repeat)]
+                result = {'benchmark': name, 'numpy': use_numpy, 'nb_logs': nb_logs, 'repeat': repeat,
+                          'best_s': min(durations), 'median_s': statistics.median(durations),
+                          'records_per_s': nb_logs / min(durations) if min(durations) > 0 else None}
+                results.append(result)
+                if not silent:
+                    print('  - ' + name + (' (numpy)' if use_numpy else '') + ', ' + str(nb_logs) + ' logs: ' +
+                          str(int(result['records_per_s'] or 0)) + ' records/s', file=sys.stderr)
+    return({'environment': environment(), 'results': results})
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark transfer, decoding and file writing against a simulated device')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(benchmarks), default=None, help='Benchmarks to run (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=int, default=default_sizes, help='Data log sizes (number of entries)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per benchmark and size')
+    parser.add_argument('--no-numpy', action='store_true', help='Only benchmark the pure Python decoding')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of printing them')
+    parser.add_argument('--silent', action='store_true', help='Do not print the progress')
+    return(parser.parse_args(argv))
+
+def main(args):
+    numpy_modes = [False] if args.no_numpy else None
+    report = run(args.benchmarks, args.sizes, args.repeat, numpy_modes, silent=args.silent)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return(report)
+
+if __name__ == '__main__':
+    main(parse_arguments())
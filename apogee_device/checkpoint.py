@@ -0,0 +1,41 @@
+import logging
+import json
+import os
+import time
+from .jsonfile import atomic_write_json
+
+# Local record of the last data log entry that has been durably stored, for each device address
+#
+# It is updated by ucache.checkpointed_transfer() each time a batch has been written and flushed to the
+# data file. If a transfer is interrupted, the next transfer resumes from the checkpoint instead of
+# from where the device stopped sending (which may be later than what was actually stored).
+
+class checkpoint_store:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.checkpoints = {}
+        if os.path.isfile(file_path):
+            try:
+                with open(file_path) as f:
+                    self.checkpoints = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Failed to load checkpoints from {file_path}: {e}')
+
+    # Timestamp of the last stored entry of a device, None if nothing has been stored yet
+    def get(self, address):
+        checkpoint = self.checkpoints.get(address)
+        if checkpoint is None:
+            return(None)
+        return(checkpoint['last_stored_time'])
+
+    def set(self, address, last_stored_time):
+        self.checkpoints[address] = {'last_stored_time': int(last_stored_time), 'updated': time.time()}
+        # Flushed to the disk, so that the checkpoint survives a crash
+        atomic_write_json(self.file_path, self.checkpoints, indent=2, fsync=True)
+        pass
+
+    def clear(self, address):
+        if address in self.checkpoints:
+            del self.checkpoints[address]
+            atomic_write_json(self.file_path, self.checkpoints, indent=2)
+        pass
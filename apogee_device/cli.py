@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import sys
+
+# Command line entry point (pyucache, see setup.py)
+#
+#   pyucache scan                                  List the devices in range
+#   pyucache harvest --config devices.json         Download all devices once (see fleet.py)
+#   pyucache daemon --config devices.json          Stay resident and harvest the devices when they are due
+#   pyucache export ./data --serial 1234 --start '2023-01-01 00:00' --output january.csv
+#   pyucache inspect ./pyucache.db                 Devices, number of records and time range of a data store
+#   pyucache plan ./schedule.json                  Harvests planned by the daemon
+#   pyucache benchmark                             See benchmark.py
+#
+# Each command only imports the modules it needs: the offline commands (export, inspect, plan) never import
+# Bleak, and NumPy, sqlite3 and the compression modules are only imported by the storage that uses them
+# (see storage.numpy_module()), so the commands start quickly on small gateways. The daemon keeps the scanner, the schedule, the metadata cache
+# and the storage open between harvests, instead of starting a new process for each run.
+#
+# Data stores (export, inspect) are CSV files written by write_datafile(), npy_backend or rotating_backend
+# directories, or sqlite_backend databases.
+
+time_formats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']
+
+# Unix timestamp from local time (one of time_formats) or from a unix timestamp
+def parse_time(value):
+    if value is None:
+        return(None)
+    if value.isdigit():
+        return(int(value))
+    for time_format in time_formats:
+        try:
+            return(int(datetime.datetime.strptime(value, time_format).timestamp()))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f'Invalid time: {value}')
+
+def format_time(timestamp):
+    return(str(datetime.datetime.fromtimestamp(int(timestamp))) if timestamp is not None else '-')
+
+# Storage backend of a data store: npy_backend directory, SQLite database or CSV file
+def open_store(path):
+    from . import storage
+    if os.path.isdir(path):
+        # Segments of a rotating_backend are CSV files, those of an npy_backend are in monthly or daily directories
+        for root, directories, file_names in os.walk(path):
+            if any('.csv' in file_name for file_name in file_names):
+                return(storage.rotating_backend(path))
+        from .archive import archive_reader
+        return(archive_reader(path))
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'No data store at {path}')
+    with open(path, 'rb') as f:
+        if f.read(16) == b'SQLite format 3\x00':
+            return(storage.sqlite_backend(path))
+    # The file can hold the rows of several devices, the per-device indexes cannot be used
+    return(storage.csv_backend(path, index=False))
+
+# serial -> (number of records, first timestamp, last timestamp)
+def store_devices(store, path):
+    from . import storage
+    if isinstance(store, storage.sqlite_backend):
+        return(store.devices())
+    if isinstance(store, storage.csv_backend):
+        # The serial is not stored in the file, the whole file is one device
+        timestamps = [int(row[0]) for row in store.read(None)]
+        serial = os.path.splitext(os.path.basename(path))[0]
+        if not timestamps:
+            return({serial: (0, None, None)})
+        return({serial: (len(timestamps), min(timestamps), max(timestamps))})
+    devices = {}
+    if isinstance(store, storage.rotating_backend):
+        for serial in store.devices():
+            records = store.read(serial)
+            timestamps = [row[0] for row in records] if isinstance(records, list) else records['timestamp']
+            devices[serial] = (len(timestamps), int(timestamps[0]) if len(timestamps) else None, int(timestamps[-1]) if len(timestamps) else None)
+        return(devices)
+    for serial in store.devices():
+        time_range = store.time_range(serial)
+        devices[serial] = (store.count(serial),) + (time_range if time_range is not None else (None, None))
+    return(devices)
+
+def scan(argv):
+    parser = argparse.ArgumentParser(prog='pyucache scan', description='List the Apogee μCache devices in range')
+    parser.add_argument('--scan-time', type=int, default=10, help='Scanning time in s')
+    args = parser.parse_args(argv)
+    from .apogee_device import search_devices
+    devices = asyncio.run(search_devices(args.scan_time, silent=True, find_all=True))
+    for device in devices:
+        print(device['address'] + '  ' + str(device['alias'] or device['name']) + '  ' + str(device['rssi']) + ' dBm')
+    print(str(len(devices)) + ' devices found')
+    return(0)
+
+def harvest(argv):
+    from . import fleet
+    results = asyncio.run(fleet.main(fleet.parse_arguments(argv, prog='pyucache harvest')))
+    return(0 if all(result['status'] != 'error' for result in results) else 1)
+
+def daemon(argv):
+    args = parse_daemon_arguments(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        asyncio.run(run_daemon(args))
+    except KeyboardInterrupt:
+        pass
+    return(0)
+
+def parse_daemon_arguments(argv=None):
+    from . import fleet
+    parser = argparse.ArgumentParser(prog='pyucache daemon',
+                                     description='Stay resident and harvest the Apogee μCache devices when they are due')
+    fleet.add_arguments(parser)
+    parser.add_argument('--schedule', default='./schedule.json', help='JSON file keeping the harvest schedule (see scheduler.py)')
+    parser.add_argument('--registry', default=None, help='JSON file keeping the devices heard by the scanner, if no config file is given')
+    parser.add_argument('--poll-interval', type=float, default=600, help='Maximum time in s between two checks of the schedule')
+    parser.add_argument('--max-interval', type=float, default=None, help='Maximum time in s between two visits of a device')
+    parser.add_argument('--log-level', default='INFO', help='Logging level')
+    return(parser.parse_args(argv))
+
+# Harvest the devices on the schedule until cancelled (SIGTERM or SIGINT). overrides replace keyword
+# arguments of fleet.harvest_fleet() from the command line, or add some (e.g. client_factory)
+async def run_daemon(args, **overrides):
+    import signal
+    from . import fleet, scheduler, scanner
+    kwargs = fleet.harvest_arguments(args)
+    kwargs.update(overrides)
+    from .storage import rotating_backend
+    if isinstance(kwargs['datafile'], rotating_backend):
+        # Closed segments are compressed in the background, between harvests
+        kwargs['datafile'].start()
+    planner = scheduler.harvest_scheduler(max_interval=args.max_interval, max_concurrent=kwargs['max_concurrent'],
+                                          file_path=args.schedule)
+    listeners = []
+    if kwargs.get('adapters') is not None:
+        # One scanner per adapter, which also keeps the signal of each device on each adapter up to date
+        listeners = kwargs['adapters'].listeners(ttl=86400)
+    elif not args.config:
+        listeners = [scanner.device_listener(scanner.device_registry(ttl=86400, file_path=args.registry))]
+    if args.config:
+        devices = fleet.load_device_list(args.config)
+    else:
+        # The scanners keep running between harvests: devices heard once are harvested from then on, even
+        # when they are not heard again (e.g. when they only advertise on a button press)
+        devices = lambda: sorted(set(planner.devices).union(*[listener.registry.devices for listener in listeners]))
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            loop.add_signal_handler(signal_number, task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass # Not supported on Windows, KeyboardInterrupt stops the daemon
+    logging.info('Harvest daemon started')
+    try:
+        for listener in listeners:
+            await listener.start()
+        harvest_kwargs = {key: value for key, value in kwargs.items() if key not in ['datafile', 'logfile', 'max_concurrent']}
+        await planner.run(devices, kwargs['datafile'], kwargs['logfile'], poll_interval=args.poll_interval, **harvest_kwargs)
+    except asyncio.CancelledError:
+        logging.info('Harvest daemon stopped')
+    finally:
+        for listener in listeners:
+            await listener.stop()
+        planner.save()
+        fleet.close_harvest_arguments(kwargs)
+    pass
+
+def export(argv):
+    parser = argparse.ArgumentParser(prog='pyucache export', description='Export the data of a device to a CSV file')
+    parser.add_argument('store', help='CSV data file, npy_backend or rotating_backend directory, or SQLite database')
+    parser.add_argument('--serial', default=None, help='Serial number of the device (default: the only device of the store)')
+    parser.add_argument('--start', type=parse_time, default=None, help="Start time ('%%Y-%%m-%%d %%H:%%M' or unix timestamp)")
+    parser.add_argument('--end', type=parse_time, default=None, help="End time ('%%Y-%%m-%%d %%H:%%M' or unix timestamp), included")
+    parser.add_argument('--output', default='-', help='Output CSV file (default: standard output)')
+    args = parser.parse_args(argv)
+    import csv
+    try:
+        store = open_store(args.store)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    serial = args.serial
+    if serial is None:
+        serials = list(store_devices(store, args.store))
+        if(len(serials) != 1):
+            parser.error('--serial is needed, the store holds ' + str(len(serials)) + ' devices: ' + ', '.join(serials))
+        serial = serials[0]
+    data = store.read(serial, args.start, args.end)
+    sensor = store.read_sensor(serial)
+    if(hasattr(data, 'dtype')):
+        rows = zip(data['timestamp'].tolist(), data['values'].tolist())
+    else:
+        rows = ((row[0], row[1:]) for row in data)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    try:
+        writer = csv.writer(output)
+        if sensor is not None and sensor.get('params'):
+            # Same layout as write_datafile()
+            writer.writerow(('timestamp,' + sensor['params']).split(','))
+            writer.writerow((',' + sensor['units']).split(','))
+        writer.writerows([format_time(timestamp)] + values for timestamp, values in rows)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        store.close()
+    return(0)
+
+def inspect(argv):
+    parser = argparse.ArgumentParser(prog='pyucache inspect', description='Show the devices and time range of a data store')
+    parser.add_argument('store', help='CSV data file, npy_backend or rotating_backend directory, or SQLite database')
+    args = parser.parse_args(argv)
+    try:
+        store = open_store(args.store)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+    try:
+        devices = store_devices(store, args.store)
+        print(str(args.store) + ': ' + type(store).__name__ + ', ' + str(len(devices)) + ' devices')
+        for serial, (nb_records, first_time, last_time) in devices.items():
+            sensor = store.read_sensor(serial)
+            params = sensor.get('params') if sensor else None
+            print('  - ' + str(serial) + ': ' + str(nb_records) + ' records from ' + format_time(first_time) +
+                  ' to ' + format_time(last_time) + (' (' + params + ')' if params else ''))
+    finally:
+        store.close()
+    return(0)
+
+def plan(argv):
+    parser = argparse.ArgumentParser(prog='pyucache plan', description='Show the harvests planned in a schedule file')
+    parser.add_argument('schedule', help='Schedule file of the daemon')
+    parser.add_argument('--horizon', type=float, default=24, help='Period to plan, in h')
+    parser.add_argument('--max-concurrent', type=int, default=3, help='Maximum number of simultaneous connections')
+    args = parser.parse_args(argv)
+    from . import scheduler
+    planner = scheduler.harvest_scheduler(max_concurrent=args.max_concurrent, file_path=args.schedule)
+    for address, device in sorted(planner.devices.items()):
+        print('  - ' + address + ': next visit ' + format_time(device['next_visit']) + ', memory full ' + format_time(device['log_full_time']))
+    scheduler.print_report(planner.plan(horizon=args.horizon * 3600))
+    return(0)
+
+def benchmark(argv):
+    from . import benchmark
+    benchmark.main(benchmark.parse_arguments(argv))
+    return(0)
+
+commands = {'scan': scan, 'harvest': harvest, 'daemon': daemon, 'export': export, 'inspect': inspect,
+            'plan': plan, 'benchmark': benchmark}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in commands:
+        print('usage: pyucache {' + ','.join(commands) + '} ...')
+        print('Run pyucache <command> --help for the options of a command')
+        return(0 if argv and argv[0] in ['-h', '--help'] else 2)
+    return(commands[argv[0]](argv[1:]))
+
+if __name__ == '__main__':
+    sys.exit(main())
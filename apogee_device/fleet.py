@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import argparse
+import json
+import time
+from .apogee_device import ucache, search_devices
+from .metadata_cache import metadata_cache
+from .checkpoint import checkpoint_store
+from .storage import sqlite_backend, rotating_backend
+from .watchdog import circuit_breaker
+from .pipeline import pipeline
+from .aggregation import aggregator
+from .adapters import adapter_pool
+from . import instrumentation
+
+# Download the data of many μCache devices at once
+#
+# A device list can come from search_devices() (list of dictionnaries with an 'address' key),
+# from a config file (see load_device_list()), or simply be a list of addresses.
+# The datafile and logfile names can contain '{address}' to write one file per device.
+# Both can also be a storage backend, e.g. a single storage.sqlite_backend shared by all devices.
+# client_factory(address) can provide the client of each device (e.g. simulator.client_factory()).
+# With a circuit_breaker (see watchdog.py), devices that keep failing are skipped for a while.
+# With a pipeline (see pipeline.py), shared by all devices, decoding and writing run outside of the event loop.
+# With an adapter_pool (see adapters.py), each device is connected through the best of several Bluetooth adapters.
+
+# Read a list of devices from a JSON file. The file contains either a list of addresses,
+# or a list of dictionnaries with at least an 'address' key, e.g.
+# [{"address": "F4:12:FA:5B:21:0C", "name": "Greenhouse"}, "D0:2B:55:13:A8:91"]
+def load_device_list(file_path):
+    with open(file_path) as f:
+        devices = json.load(f)
+    return([device if isinstance(device, dict) else {'address': device} for device in devices])
+
+# Download the data of a single device. Never raises, so that one device cannot stop the others
+async def harvest_device(address, datafile, logfile, from_timestamp=None, device_timeout=300,
+                         semaphore=None, use_numpy=False, cache=None, checkpoint=None, client_factory=None,
+                         metrics=None, timeouts=None, breaker=None, pipeline=None, aggregator=None, adapters=None, silent=True):
+    file_id = address.replace(':', '')
+    result = {'address': address, 'status': None, 'error': None, 'nb_logs': 0, 'adapter': None,
+              'start_time': None, 'duration': None, 'log_full_time': None, 'logging_interval': None}
+    # A device that failed repeatedly is not even waited for
+    if breaker is not None and not breaker.allow(address):
+        result['status'] = 'skipped'
+        result['error'] = 'failed repeatedly, skipped until ' + \
+                          time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(breaker.open_until(address)))
+        result['duration'] = 0
+        if not silent: print('  - ' + address + ': skipped')
+        return(result)
+    # Limit the number of simultaneous connections (the adapter only supports a few)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    async with semaphore:
+        result['start_time'] = time.time()
+        if not silent: print('  - ' + address + ': start')
+        # With several adapters (see adapters.py), a device that cannot be reached through one adapter is
+        # tried through the next best one
+        nb_attempts = len(adapters.adapters) if adapters is not None else 1
+        for attempt in range(nb_attempts):
+            adapter = await adapters.acquire(address) if adapters is not None else None
+            result['adapter'] = adapter
+            client = None
+            if client_factory is not None:
+                client = client_factory(address) if adapter is None else client_factory(address, adapter=adapter)
+            device = ucache(address, use_numpy=use_numpy, metadata_cache=cache, client=client, metrics=metrics, timeouts=timeouts,
+                            pipeline=pipeline, aggregator=aggregator, adapter=adapter)
+            try:
+                # A storage backend (see storage.py) already separates the devices
+                device_datafile = datafile.format(address=file_id) if isinstance(datafile, str) else datafile
+                device_logfile = logfile.format(address=file_id) if isinstance(logfile, str) else logfile
+                status = await asyncio.wait_for(device.download_routine(device_datafile,
+                                                                        device_logfile,
+                                                                        from_timestamp=from_timestamp,
+                                                                        checkpoint=checkpoint),
+                                                timeout=device_timeout)
+                result['status'] = status
+                result['nb_logs'] = device.nb_transferred
+                # Used by the scheduler (see scheduler.py) to plan the next visit
+                if device.status is not None:
+                    result['logging_interval'] = device.status.logging_interval
+                    result['log_full_time'] = device.status.log_full_time if status != 'downloaded' else device.log_full_time
+            except asyncio.TimeoutError as e:
+                result['status'] = 'timeout'
+                # Either a single operation (watchdog.operation_timeout) or the whole device timed out
+                result['error'] = str(e) or f'timed out after {device_timeout}s'
+                logging.error(f'Harvesting {address} failed: {result["error"]}')
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = str(e)
+                logging.error(f'Failed to harvest {address}: {e}')
+            finally:
+                # Make sure that the connection is freed for the next device
+                if not device.disconnected:
+                    try:
+                        await asyncio.wait_for(device.disconnect(), timeout=10)
+                    except Exception as e:
+                        logging.error(f'Failed to disconnect from {address}: {e}')
+                if adapters is not None:
+                    await adapters.release(address, adapter, failed=result['status'] == 'connection failed')
+            if(result['status'] != 'connection failed'):
+                break
+        result['duration'] = time.time() - result['start_time']
+        if breaker is not None:
+            # The device answered, even if there was nothing to download
+            if result['status'] in ['downloaded', 'not logging', 'not enough logs']:
+                breaker.record_success(address)
+            else:
+                breaker.record_failure(address, result['error'] or result['status'])
+        if metrics is not None:
+            metrics.record('harvest_seconds', result['duration'], address=address, status=result['status'])
+            # Once per device, the measurements of its transfer are written out (see instrumentation.jsonl_sink)
+            metrics.flush()
+        if not silent: print('  - ' + address + ': ' + result['status'] + ' (' + str(round(result['duration'], 1)) + 's)')
+    return(result)
+
+# Download the data of all devices, with at most max_concurrent connections at the same time.
+# Returns a summary: one dictionnary per device with its status, error, number of logs and duration
+async def harvest_fleet(devices, datafile, logfile, from_timestamp=None, max_concurrent=3,
+                        device_timeout=300, use_numpy=False, cache=None, checkpoint=None, client_factory=None,
+                        metrics=None, timeouts=None, breaker=None, pipeline=None, aggregator=None, adapters=None, silent=True):
+    addresses = [device['address'] if isinstance(device, dict) else device for device in devices]
+    semaphore = asyncio.Semaphore(max_concurrent)
+    if not silent: print('Harvesting ' + str(len(addresses)) + ' devices:')
+    results = await asyncio.gather(*[harvest_device(address, datafile, logfile, from_timestamp=from_timestamp,
+                                                    device_timeout=device_timeout, semaphore=semaphore,
+                                                    use_numpy=use_numpy, cache=cache, checkpoint=checkpoint,
+                                                    client_factory=client_factory, metrics=metrics,
+                                                    timeouts=timeouts, breaker=breaker, pipeline=pipeline,
+                                                    aggregator=aggregator, adapters=adapters, silent=silent)
+                                     for address in addresses])
+    return(list(results))
+
+def print_summary(results):
+    print('Summary:')
+    for result in results:
+        line = '  - ' + result['address'] + ': ' + str(result['status']) + ', ' + \
+               str(result['nb_logs']) + ' logs in ' + str(round(result['duration'], 1)) + 's'
+        if result['error']:
+            line += ' (' + result['error'] + ')'
+        print(line)
+    nb_ok = len([result for result in results if result['status'] == 'downloaded'])
+    print('  ' + str(nb_ok) + ' of ' + str(len(results)) + ' devices downloaded')
+    pass
+
+# Keyword arguments of harvest_fleet() from the command line arguments (also used by the daemon, see cli.py)
+def harvest_arguments(args):
+    metrics = None
+    if args.metrics_prom or args.metrics_jsonl:
+        sinks = []
+        if args.metrics_prom:
+            sinks.append(instrumentation.prometheus_sink(args.metrics_prom))
+        if args.metrics_jsonl:
+            sinks.append(instrumentation.jsonl_sink(args.metrics_jsonl))
+        metrics = instrumentation.metrics(sinks)
+    datafile, logfile = args.datafile, args.logfile
+    if args.sqlite:
+        # The data and the log go to the same database, which other processes can write to as well
+        datafile = logfile = sqlite_backend(args.sqlite)
+    elif args.segments:
+        # Daily segments per device, compressed once the day is over
+        datafile = logfile = rotating_backend(args.segments, codec=None if args.codec == 'none' else args.codec)
+    adapters = adapter_pool(args.adapters, args.connections_per_adapter) if args.adapters else None
+    max_concurrent = args.max_concurrent
+    if max_concurrent is None:
+        max_concurrent = adapters.capacity() if adapters is not None else 3
+    return({'datafile': datafile, 'logfile': logfile, 'from_timestamp': args.from_timestamp,
+            'max_concurrent': max_concurrent, 'device_timeout': args.device_timeout,
+            'use_numpy': args.numpy, 'silent': args.silent,
+            'cache': metadata_cache(args.metadata_cache) if args.metadata_cache else None,
+            'checkpoint': checkpoint_store(args.checkpoint) if args.checkpoint else None,
+            'metrics': metrics,
+            'timeouts': {'read': args.operation_timeout, 'write': args.operation_timeout,
+                         'start_notify': args.operation_timeout, 'stop_notify': args.operation_timeout},
+            'breaker': circuit_breaker(args.failure_threshold, file_path=args.circuit_breaker) if args.circuit_breaker else None,
+            'pipeline': pipeline(args.workers) if args.workers > 0 else None,
+            'aggregator': aggregator(args.aggregates) if args.aggregates else None,
+            'adapters': adapters})
+
+# Flush and close what harvest_arguments() opened
+def close_harvest_arguments(kwargs):
+    if kwargs['pipeline'] is not None:
+        kwargs['pipeline'].close()
+    if kwargs['metrics'] is not None:
+        kwargs['metrics'].flush()
+    if kwargs['aggregator'] is not None:
+        kwargs['aggregator'].close()
+    if isinstance(kwargs['datafile'], sqlite_backend):
+        kwargs['datafile'].close()
+    if isinstance(kwargs['datafile'], rotating_backend):
+        kwargs['datafile'].close()
+        kwargs['datafile'].compact()
+    pass
+
+async def main(args):
+    kwargs = harvest_arguments(args)
+    if kwargs['adapters'] is not None:
+        # Scanning with all the adapters also measures the signal of each device on each adapter
+        found = await kwargs['adapters'].search_devices(args.scan_time)
+        devices = load_device_list(args.config) if args.config else found
+    elif args.config:
+        devices = load_device_list(args.config)
+    else:
+        devices = await search_devices(args.scan_time, silent=args.silent, find_all=True)
+    try:
+        results = await harvest_fleet(devices, **kwargs)
+    finally:
+        close_harvest_arguments(kwargs)
+    print_summary(results)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(results, f, indent=2)
+    return(results)
+
+def parse_arguments(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Download the data of several Apogee μCache devices at once')
+    add_arguments(parser)
+    return(parser.parse_args(argv))
+
+def add_arguments(parser):
+    parser.add_argument('--config', help='JSON file containing the list of devices (default: scan for devices)')
+    parser.add_argument('--scan-time', type=int, default=10, help='Scanning time in s, if no config file is given')
+    parser.add_argument('--datafile', default='./data_{address}.csv', help='Data file, {address} is replaced by the device address')
+    parser.add_argument('--logfile', default='./logfile.csv', help='Log file, {address} is replaced by the device address')
+    parser.add_argument('--sqlite', default=None, help='Write the data and the log to this SQLite database instead of CSV files')
+    parser.add_argument('--segments', default=None, help='Write the data and the log to daily segments in this directory, compressed once the day is over')
+    parser.add_argument('--codec', default='gzip', choices=['gzip', 'bz2', 'lzma', 'none'], help='Compression of the closed segments')
+    parser.add_argument('--from-timestamp', default=None, help="Download from this time ('%%Y-%%m-%%d %%H:%%M'), or 'all'")
+    parser.add_argument('--adapters', nargs='+', default=None, help='Bluetooth adapters to use together (e.g. hci0 hci1), default: the default adapter')
+    parser.add_argument('--connections-per-adapter', type=int, default=3, help='Maximum number of simultaneous connections of each adapter')
+    parser.add_argument('--max-concurrent', type=int, default=None, help='Maximum number of simultaneous connections (default: 3, or the capacity of the adapters)')
+    parser.add_argument('--device-timeout', type=float, default=300, help='Maximum time in s spent on each device')
+    parser.add_argument('--operation-timeout', type=float, default=10, help='Maximum time in s of each read, write and notification request')
+    parser.add_argument('--circuit-breaker', default=None, help='JSON file keeping track of failing devices, which are then skipped for a while')
+    parser.add_argument('--failure-threshold', type=int, default=3, help='Number of failures within an hour after which a device is skipped')
+    parser.add_argument('--workers', type=int, default=2, help='Number of threads decoding the data outside of the event loop (0: decode in the event loop)')
+    parser.add_argument('--aggregates', default=None, help='Directory of the hourly and daily statistics, updated with the downloaded data')
+    parser.add_argument('--numpy', action='store_true', help='Decode the data logs with NumPy')
+    parser.add_argument('--metadata-cache', default=None, help='JSON file used to cache the device metadata')
+    parser.add_argument('--checkpoint', default=None, help='JSON file used to checkpoint and resume transfers')
+    parser.add_argument('--metrics-prom', default=None, help='Write the metrics to this Prometheus textfile')
+    parser.add_argument('--metrics-jsonl', default=None, help='Append the metrics to this JSON lines file')
+    parser.add_argument('--summary', default=None, help='Write the summary to this JSON file')
+    parser.add_argument('--silent', action='store_true', help='Only print the summary')
+    return(parser)
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_arguments()))
@@ -0,0 +1,226 @@
+import bisect
+import json
+import os
+import time
+
+# Timing of the GATT operations and transfer metrics
+#
+# A metrics object collects measurements (a metric name, a value and labels such as the device address) and
+# passes them to its sinks. ucache(address, metrics=metrics) wraps its client in an instrumented_client,
+# which times connect/disconnect and every GATT read, write and notification subscription, and measures the
+# time between notifications and their size. transfer_data() and write_datafile() add their own metrics.
+# Without metrics, nothing is wrapped and there is no overhead.
+#
+#   histogram = instrumentation.histogram_sink()
+#   metrics = instrumentation.metrics([histogram, instrumentation.jsonl_sink('./metrics.jsonl')])
+#   ucache = apogee_device.ucache(device_address, metrics=metrics)
+#   ...
+#   print(histogram.summary())
+
+# Bucket limits in s, for the metrics ending in '_seconds'
+default_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+class metrics:
+    def __init__(self, sinks=None):
+        self.sinks = sinks if sinks is not None else []
+
+    def record(self, name, value, **labels):
+        for sink in self.sinks:
+            sink.record(name, value, labels)
+        pass
+
+    # Time a block of code: with metrics.timer('gatt_read_seconds', address=...):
+    def timer(self, name, **labels):
+        return(metrics_timer(self, name, labels))
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+        pass
+
+class metrics_timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.labels = dict(self.labels, error=exc_type.__name__)
+        self.metrics.record(self.name, time.perf_counter() - self.start_time, **self.labels)
+        return(False)
+
+# In-memory aggregation: count, sum, min, max, last value and histogram buckets of each metric and labels
+class histogram_sink:
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets is not None else default_buckets
+        self.series = {}
+
+    def record(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self.series.get(key)
+        if series is None:
+            series = {'count': 0, 'sum': 0.0, 'min': value, 'max': value, 'last': value,
+                      'buckets': [0] * (len(self.buckets) + 1)}
+            self.series[key] = series
+        series['count'] += 1
+        series['sum'] += value
+        series['last'] = value
+        if(value < series['min']):
+            series['min'] = value
+        if(value > series['max']):
+            series['max'] = value
+        series['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+        pass
+
+    # Approximate quantile (0-1) of a metric from its buckets, over all labels matching the given ones
+    def quantile(self, name, q, **labels):
+        counts = [0] * (len(self.buckets) + 1)
+        for (series_name, series_labels), series in self.series.items():
+            if(series_name == name) and all(item in series_labels for item in labels.items()):
+                counts = [a + b for a, b in zip(counts, series['buckets'])]
+        total = sum(counts)
+        if(total == 0):
+            return(None)
+        cumulated = 0
+        for i, count in enumerate(counts):
+            cumulated += count
+            if(cumulated >= q * total):
+                return(self.buckets[i] if i < len(self.buckets) else float('inf'))
+        return(float('inf'))
+
+    # List of dictionnaries, one per metric and labels
+    def summary(self):
+        result = []
+        for (name, labels), series in sorted(self.series.items()):
+            result.append(dict(labels, metric=name, count=series['count'], sum=series['sum'],
+                               mean=series['sum'] / series['count'], min=series['min'], max=series['max']))
+        return(result)
+
+    def flush(self):
+        pass
+
+# One JSON line per measurement. Only the metrics listed in include are written, if given
+# (e.g. to leave out the per-notification metrics, which are numerous).
+# Measurements are kept in memory and written at once on flush(), or when max_buffered are waiting: record()
+# is called from the notification callbacks, in the event loop, where a file write for each would slow down
+# the transfers
+class jsonl_sink:
+    def __init__(self, file_path, include=None, max_buffered=10000):
+        self.file_path = file_path
+        self.include = set(include) if include is not None else None
+        self.max_buffered = max_buffered
+        self.buffer = []
+        self.file = open(file_path, 'a')
+
+    def record(self, name, value, labels):
+        if(self.include is not None) and (name not in self.include):
+            return
+        self.buffer.append((time.time(), name, value, labels))
+        if(len(self.buffer) >= self.max_buffered):
+            self.flush()
+        pass
+
+    def flush(self):
+        buffer, self.buffer = self.buffer, []
+        self.file.write(''.join(json.dumps(dict(labels, time=record_time, metric=name, value=value)) + '\n'
+                                for record_time, name, value, labels in buffer))
+        self.file.flush()
+        pass
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        pass
+
+# Prometheus textfile collector (node_exporter --collector.textfile.directory). The aggregated metrics are
+# written to file_path on flush(). Metrics ending in '_seconds' are histograms, the others are written
+# as a gauge with their last value, and their sum and count
+class prometheus_sink(histogram_sink):
+    def __init__(self, file_path, prefix='pyucache_', buckets=None):
+        histogram_sink.__init__(self, buckets)
+        self.file_path = file_path
+        self.prefix = prefix
+
+    def format_labels(self, labels, extra=None):
+        labels = list(labels) + ([extra] if extra is not None else [])
+        if not labels:
+            return('')
+        return('{' + ','.join(str(key) + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                              for key, value in labels) + '}')
+
+    def flush(self):
+        lines = []
+        names = sorted(set(name for name, labels in self.series))
+        for name in names:
+            metric = self.prefix + name
+            histogram = name.endswith('_seconds')
+            lines.append('# TYPE ' + metric + (' histogram' if histogram else ' gauge'))
+            for (series_name, labels), series in sorted(self.series.items()):
+                if(series_name != name):
+                    continue
+                if histogram:
+                    cumulated = 0
+                    for limit, count in zip(self.buckets + ['+Inf'], series['buckets']):
+                        cumulated += count
+                        lines.append(metric + '_bucket' + self.format_labels(labels, ('le', limit)) + ' ' + str(cumulated))
+                else:
+                    lines.append(metric + self.format_labels(labels) + ' ' + repr(float(series['last'])))
+                lines.append(metric + '_sum' + self.format_labels(labels) + ' ' + repr(float(series['sum'])))
+                lines.append(metric + '_count' + self.format_labels(labels) + ' ' + str(series['count']))
+        # The collector must never read a half written file
+        with open(self.file_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.file_path + '.tmp', self.file_path)
+        pass
+
+# Wraps a BleakClient (or simulated_client) to time every operation
+class instrumented_client:
+    def __init__(self, client, metrics, address):
+        self.client = client
+        self.metrics = metrics
+        self.address = address
+
+    # Everything else (is_connected, services...) comes from the wrapped client
+    def __getattr__(self, name):
+        return(getattr(self.client, name))
+
+    async def connect(self, **kwargs):
+        with self.metrics.timer('connect_seconds', address=self.address):
+            return(await self.client.connect(**kwargs))
+
+    async def disconnect(self):
+        with self.metrics.timer('disconnect_seconds', address=self.address):
+            return(await self.client.disconnect())
+
+    async def read_gatt_char(self, characteristic, **kwargs):
+        with self.metrics.timer('gatt_read_seconds', address=self.address, characteristic=str(characteristic)):
+            return(await self.client.read_gatt_char(characteristic, **kwargs))
+
+    async def write_gatt_char(self, characteristic, data, response=None):
+        with self.metrics.timer('gatt_write_seconds', address=self.address, characteristic=str(characteristic)):
+            if response is None:
+                return(await self.client.write_gatt_char(characteristic, data))
+            return(await self.client.write_gatt_char(characteristic, data, response))
+
+    async def start_notify(self, characteristic, callback, **kwargs):
+        labels = {'address': self.address, 'characteristic': str(characteristic)}
+        state = {'last_time': None}
+        record = self.metrics.record
+        def instrumented_callback(sender, data):
+            now = time.perf_counter()
+            if state['last_time'] is not None:
+                record('notification_interarrival_seconds', now - state['last_time'], **labels)
+            state['last_time'] = now
+            record('notification_bytes', len(data), **labels)
+            return(callback(sender, data))
+        with self.metrics.timer('gatt_start_notify_seconds', **labels):
+            return(await self.client.start_notify(characteristic, instrumented_callback, **kwargs))
+
+    async def stop_notify(self, characteristic):
+        with self.metrics.timer('gatt_stop_notify_seconds', address=self.address, characteristic=str(characteristic)):
+            return(await self.client.stop_notify(characteristic))
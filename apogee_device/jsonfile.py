@@ -0,0 +1,20 @@
+import json
+import os
+
+# State files (checkpoints, metadata cache, schedule, circuit breaker, device registry, aggregates)
+#
+# They are JSON files that are rewritten as a whole. atomic_write_json() writes to a temporary file first and
+# then renames it over the old one, so that a crash or a power loss never leaves a file half written: readers
+# see either the old content or the new one.
+#
+#   jsonfile.atomic_write_json('./checkpoints.json', checkpoints, indent=2, fsync=True)
+
+# With fsync=True, the new content is on disk when the function returns (not only in the OS cache)
+def atomic_write_json(file_path, obj, indent=None, fsync=False):
+    with open(file_path + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=indent)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(file_path + '.tmp', file_path)
+    pass
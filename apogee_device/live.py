@@ -0,0 +1,91 @@
+import array
+import asyncio
+
+# Fixed-size ring buffer of live data readings (see ucache.start_live())
+#
+# The storage is allocated once: capacity readings of one timestamp and nb_outputs values, in a flat array
+# of doubles. When it is full, the oldest readings are overwritten, so memory use does not grow however
+# long the live data is received. Readings can be read as the latest value, the last n values, or as an
+# async stream in which each consumer follows the buffer at its own pace.
+#
+#   buffer = await ucache.start_live(capacity=3600)
+#   async for timestamp, values in buffer.stream():
+#       ...
+
+class live_buffer:
+    def __init__(self, capacity=7200, nb_outputs=1):
+        if(capacity < 1):
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.nb_outputs = nb_outputs
+        self.width = nb_outputs + 1
+        self.data = array.array('d', bytes(8 * capacity * self.width))
+        # Number of readings appended since the start. The reading number i is in slot i % capacity
+        self.nb_appended = 0
+        # Futures of the streams waiting for the next reading
+        self.waiters = []
+        self.closed = False
+
+    def __len__(self):
+        return(min(self.nb_appended, self.capacity))
+
+    # Called for each reading, from the notification callback
+    def append(self, timestamp, values):
+        start = (self.nb_appended % self.capacity) * self.width
+        self.data[start] = timestamp
+        for i in range(self.nb_outputs):
+            self.data[start + 1 + i] = values[i] if i < len(values) else float('nan')
+        self.nb_appended += 1
+        if self.waiters:
+            self.wake_up()
+        pass
+
+    def wake_up(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        pass
+
+    # (timestamp, values) of the reading number i, which must still be in the buffer
+    def get(self, i):
+        start = (i % self.capacity) * self.width
+        return(self.data[start], tuple(self.data[start + 1:start + self.width]))
+
+    # Latest reading, None if nothing has been received yet
+    def latest(self):
+        if(self.nb_appended == 0):
+            return(None)
+        return(self.get(self.nb_appended - 1))
+
+    # Last n readings (all readings in the buffer by default), oldest first
+    def snapshot(self, n=None):
+        n = len(self) if n is None else min(n, len(self))
+        return([self.get(i) for i in range(self.nb_appended - n, self.nb_appended)])
+
+    # Async stream of the readings. By default it starts with the next reading; with from_start=True it
+    # starts with the oldest reading in the buffer. A consumer that is more than capacity readings behind
+    # skips the readings that were overwritten
+    async def stream(self, from_start=False):
+        position = self.nb_appended - len(self) if from_start else self.nb_appended
+        while True:
+            if(position == self.nb_appended):
+                if self.closed:
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                await waiter
+                continue
+            # Overwritten readings are skipped
+            oldest = self.nb_appended - len(self)
+            if(position < oldest):
+                position = oldest
+            reading = self.get(position)
+            position += 1
+            yield reading
+
+    # Ends the streams once they have read the remaining readings
+    def close(self):
+        self.closed = True
+        self.wake_up()
+        pass
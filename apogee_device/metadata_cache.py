@@ -0,0 +1,68 @@
+import logging
+import json
+import os
+import time
+from .jsonfile import atomic_write_json
+
+# On-disk cache of the device metadata that (almost) never changes
+#
+# For each device address, the cache keeps the serial number and firmware revision it belongs to,
+# as well as the device information ('device_info'), the installed sensor ('sensor') and the logging
+# settings ('logging_settings'). If the serial number or firmware revision of a device differ from the
+# cached ones, the whole entry is dropped. ucache drops the logging settings when they are changed.
+
+class metadata_cache:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.devices = {}
+        if os.path.isfile(file_path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.file_path) as f:
+                self.devices = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f'Failed to load metadata cache from {self.file_path}: {e}')
+            self.devices = {}
+        pass
+
+    def save(self):
+        atomic_write_json(self.file_path, self.devices, indent=2)
+        pass
+
+    # Returns the cached value of a key (or the whole entry if key is None), None if not cached
+    def get(self, address, key=None):
+        entry = self.devices.get(address)
+        if(entry is None) or (key is None):
+            return(entry)
+        return(entry.get(key))
+
+    def set(self, address, key, value):
+        entry = self.devices.setdefault(address, {})
+        entry[key] = value
+        entry['updated'] = time.time()
+        self.save()
+        pass
+
+    # Check that the cache entry still belongs to this device, drop it otherwise
+    def check(self, address, serial_number, firmware_revision):
+        entry = self.devices.get(address)
+        if entry is None:
+            return(False)
+        device_info = entry.get('device_info', {})
+        if(device_info.get('serial_number') == serial_number) and (device_info.get('firmware_revision') == firmware_revision):
+            return(True)
+        self.invalidate(address)
+        return(False)
+
+    # Drop a key of a device, or the whole entry if key is None
+    def invalidate(self, address, key=None):
+        if address not in self.devices:
+            return
+        if key is None:
+            del self.devices[address]
+        else:
+            self.devices[address].pop(key, None)
+        self.save()
+        pass
@@ -0,0 +1,56 @@
+import asyncio
+import concurrent.futures
+import functools
+
+# Decoding and storage outside of the event loop
+#
+# The notification callbacks only store the raw bytes, but decoding the data log and writing it to disk
+# are CPU and disk work. Run on the event loop, they delay the notifications of the other devices
+# connected by the same process. With ucache(address, pipeline=pipeline), they run in worker threads
+# instead (or processes, for decoding), and the event loop only handles the Bluetooth communication.
+#   - decode stage: max_workers threads (or processes with processes=True)
+#   - write stage: a single thread, so that writes are done in order and storage backends need not be
+#     thread safe
+# At most max_pending jobs are queued or running in each stage. Beyond that, the coroutine submitting a
+# job waits (backpressure), which does not block the event loop.
+#
+#   async with pipeline.pipeline(max_workers=2) as workers:
+#       results = await fleet.harvest_fleet(device_list, datafile, logfile, pipeline=workers)
+
+class pipeline:
+    def __init__(self, max_workers=2, max_pending=8, processes=False):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        # A process pool avoids the GIL, but the raw data has to be sent to the processes
+        if processes:
+            decode_executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            decode_executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='pyucache-decode')
+        write_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='pyucache-write')
+        self.stages = {'decode': (decode_executor, asyncio.Semaphore(max_pending)),
+                       'write': (write_executor, asyncio.Semaphore(max_pending))}
+
+    async def __aenter__(self):
+        return(self)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        return(False)
+
+    # Run function(*args, **kwargs) in a stage ('decode' or 'write') and return its result
+    async def run(self, stage, function, *args, **kwargs):
+        executor, semaphore = self.stages[stage]
+        async with semaphore:
+            return(await asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *args, **kwargs)))
+
+    async def decode(self, function, *args, **kwargs):
+        return(await self.run('decode', function, *args, **kwargs))
+
+    async def write(self, function, *args, **kwargs):
+        return(await self.run('write', function, *args, **kwargs))
+
+    # Waits for the running jobs to finish
+    def close(self):
+        for executor, semaphore in self.stages.values():
+            executor.shutdown(wait=True)
+        pass
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import json
+import os
+import time
+from .jsonfile import atomic_write_json
+
+# Continuous listening to advertisements of Apogee devices
+#
+# Instead of scanning from scratch each time (see search_devices()), a device_listener keeps scanning in the
+# background and stores every Apogee device it hears in a device_registry. Devices can then be looked up
+# immediately by address or alias. Entries expire after ttl seconds without advertisement.
+#
+# The advertisements carry little information (see parse_advertisement()), but when a device advertises
+# synchronized with data logging (set_advertising_frequency(n)), hearing it tells that it is alive and
+# logging, without connecting. An advertisement_telemetry follows this for many devices at once:
+#
+#   telemetry = scanner.advertisement_telemetry(collection_rates={device_address: 5})
+#   async with scanner.device_listener(callback=telemetry.update):
+#       async for event in telemetry.stream():
+#           print(event['address'], event['alias'], event['rssi'], event['estimated_new_logs'])
+
+apogee_company_id = 0x0644
+
+# Decode the manufacturer specific data of an advertisement (see "Advertising" in the API manual).
+# data is either the bytes following the company ID (as in Bleak's manufacturer_data), or the complete
+# field starting with the company ID 44-06. The advertising data only contains the company ID; the scan
+# response adds the alias. There is no measurement or status field: the battery level, time and data log
+# can only be read through a connection
+def parse_advertisement(data):
+    data = bytes(data) if data is not None else b''
+    if(data[:2] == apogee_company_id.to_bytes(2, 'little')):
+        data = data[2:]
+    alias = None
+    if data:
+        try:
+            alias = data.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    return({'company_id': apogee_company_id, 'packet': 'scan_response' if data else 'advertising', 'alias': alias})
+
+class device_registry:
+    def __init__(self, ttl=600, file_path=None):
+        self.ttl = ttl
+        self.file_path = file_path
+        self.devices = {}
+        # Optionally, the registry is kept on disk between runs
+        if file_path is not None and os.path.isfile(file_path):
+            self.load(file_path)
+
+    # Store an advertisement. advertised_data are the bytes following the company ID
+    def update(self, address, name, rssi, advertised_data, company_id=apogee_company_id, seen_time=None):
+        if seen_time is None:
+            seen_time = time.time()
+        entry = self.devices.get(address, {'address': address, 'alias': None, 'name': None, 'first_seen': seen_time})
+        # The scan response contains the alias, the advertising data itself only contains the company ID
+        if advertised_data:
+            alias = parse_advertisement(advertised_data)['alias']
+            if alias is not None:
+                entry['alias'] = alias
+            entry['advertised_data'] = bytes(advertised_data)
+        elif 'advertised_data' not in entry:
+            entry['advertised_data'] = b''
+        if name:
+            entry['name'] = name
+        entry.update({'rssi': rssi, 'company_id': company_id, 'last_seen': seen_time})
+        self.devices[address] = entry
+        return(entry)
+
+    # Remove the devices that have not been seen for more than ttl seconds
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        expired = [address for address, entry in self.devices.items() if now - entry['last_seen'] > self.ttl]
+        for address in expired:
+            del self.devices[address]
+        return(expired)
+
+    def get(self, address):
+        self.expire()
+        return(self.devices.get(address))
+
+    def find(self, alias):
+        self.expire()
+        for entry in self.devices.values():
+            if alias in (entry['alias'], entry['name']):
+                return(entry)
+        return(None)
+
+    # List of devices in the same format as search_devices(), strongest signal first
+    def list_devices(self):
+        self.expire()
+        entries = sorted(self.devices.values(), key=lambda entry: entry['rssi'] if entry['rssi'] is not None else -999, reverse=True)
+        return([{'address': entry['address'], 'name': entry['alias'] or entry['name'], 'rssi': entry['rssi'],
+                 'company_id': entry['company_id'], 'advertised_data': entry['advertised_data'],
+                 'last_seen': entry['last_seen']} for entry in entries])
+
+    def save(self, file_path=None):
+        if file_path is None:
+            file_path = self.file_path
+        devices = []
+        for entry in self.devices.values():
+            entry = dict(entry)
+            entry['advertised_data'] = entry['advertised_data'].hex()
+            devices.append(entry)
+        atomic_write_json(file_path, devices, indent=2)
+        pass
+
+    def load(self, file_path=None):
+        if file_path is None:
+            file_path = self.file_path
+        try:
+            with open(file_path) as f:
+                devices = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f'Failed to load device registry from {file_path}: {e}')
+            return
+        for entry in devices:
+            entry['advertised_data'] = bytes.fromhex(entry['advertised_data'])
+            self.devices[entry['address']] = entry
+        self.expire()
+        pass
+
+    def __len__(self):
+        self.expire()
+        return(len(self.devices))
+
+class device_listener:
+    def __init__(self, registry=None, ttl=600, callback=None, **scanner_kwargs):
+        self.registry = registry if registry is not None else device_registry(ttl=ttl)
+        # Optional function called with each updated registry entry
+        self.callback = callback
+        from bleak import BleakScanner
+        self.scanner = BleakScanner(detection_callback=self.detection_callback, **scanner_kwargs)
+        self.running = False
+        # Set each time an Apogee device is heard, to wake up wait_for_device()
+        self.device_seen = asyncio.Event()
+
+    def detection_callback(self, device, advertisement_data):
+        manufacturer_data = advertisement_data.manufacturer_data
+        if not manufacturer_data or apogee_company_id not in manufacturer_data:
+            return
+        rssi = getattr(advertisement_data, 'rssi', None)
+        if rssi is None:
+            rssi = device.rssi
+        name = device.name or advertisement_data.local_name
+        entry = self.registry.update(device.address, name, rssi, manufacturer_data[apogee_company_id])
+        self.device_seen.set()
+        if self.callback is not None:
+            try:
+                self.callback(entry)
+            except Exception as e:
+                logging.error(f'Device listener callback failed for {device.address}: {e}')
+        pass
+
+    async def start(self):
+        if not self.running:
+            await self.scanner.start()
+            self.running = True
+        pass
+
+    async def stop(self):
+        if self.running:
+            try:
+                await self.scanner.stop()
+            finally:
+                self.running = False
+                if self.registry.file_path is not None:
+                    self.registry.save()
+        pass
+
+    # Wait until a device (address or alias) is heard, or until the timeout. Returns its registry entry or None
+    async def wait_for_device(self, address=None, alias=None, timeout=30):
+        deadline = time.time() + timeout
+        while True:
+            entry = self.registry.get(address) if address is not None else self.registry.find(alias)
+            if entry is not None:
+                return(entry)
+            remaining = deadline - time.time()
+            if(remaining <= 0):
+                return(None)
+            self.device_seen.clear()
+            try:
+                await asyncio.wait_for(self.device_seen.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return(None)
+
+    async def __aenter__(self):
+        await self.start()
+        return(self)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+# Passive monitoring of devices from their advertisements
+#
+# A device advertising synchronized with data logging advertises for up to 10s each time n new entries are
+# logged (n is the collection rate, see set_advertising_frequency()). The advertisements heard close
+# together (less than burst_gap s apart) are grouped into bursts. From the bursts, for each device:
+#   - whether it is still logging: the next burst is expected one burst interval (learnt from the previous
+#     bursts, or n * logging interval) after the last one. A device is late when it is not heard by then
+#   - the number of entries logged since the last harvest (bursts * n), when its collection rate is known
+#   - its alias and signal strength (RSSI)
+# Each burst, and each device becoming late (see check()), is an event of stream().
+class advertisement_telemetry:
+    # collection_rates, logging_intervals: dictionnaries address -> value, for the devices where they are known
+    def __init__(self, burst_gap=5, collection_rates=None, logging_intervals=None, max_events=1000):
+        self.burst_gap = burst_gap
+        self.collection_rates = collection_rates if collection_rates is not None else {}
+        self.logging_intervals = logging_intervals if logging_intervals is not None else {}
+        self.devices = {}
+        # Events not read by stream() yet, the oldest ones are dropped when there are more than max_events
+        self.events = asyncio.Queue(max_events)
+
+    # Called with each registry entry (use it as device_listener callback). Returns the event of a new burst
+    def update(self, entry):
+        address = entry['address']
+        seen_time = entry['last_seen']
+        device = self.devices.get(address)
+        if device is None:
+            device = {'address': address, 'alias': None, 'rssi': None, 'first_seen': seen_time, 'last_seen': None,
+                      'burst_start': None, 'nb_bursts': 0, 'nb_bursts_since_harvest': 0, 'burst_interval': None,
+                      'late': False}
+            self.devices[address] = device
+        device['alias'] = entry.get('alias') or device['alias']
+        device['rssi'] = entry.get('rssi')
+        new_burst = (device['last_seen'] is None) or (seen_time - device['last_seen'] > self.burst_gap)
+        if new_burst and device['burst_start'] is not None:
+            # Smoothed interval between bursts
+            interval = seen_time - device['burst_start']
+            device['burst_interval'] = interval if device['burst_interval'] is None else \
+                                       0.8 * device['burst_interval'] + 0.2 * interval
+        device['last_seen'] = seen_time
+        if not new_burst:
+            return(None)
+        device['burst_start'] = seen_time
+        device['nb_bursts'] += 1
+        device['nb_bursts_since_harvest'] += 1
+        device['late'] = False
+        return(self.publish('burst', address, seen_time))
+
+    # Time between two bursts: learnt, or from the collection rate and logging interval
+    def expected_interval(self, address):
+        device = self.devices[address]
+        if device['burst_interval'] is not None:
+            return(device['burst_interval'])
+        if(self.collection_rates.get(address)) and (self.logging_intervals.get(address)):
+            return(self.collection_rates[address] * self.logging_intervals[address])
+        return(None)
+
+    # State of a device
+    def status(self, address, now=None):
+        now = time.time() if now is None else now
+        device = self.devices.get(address)
+        if device is None:
+            return(None)
+        interval = self.expected_interval(address)
+        next_burst = device['burst_start'] + interval if interval is not None else None
+        rate = self.collection_rates.get(address)
+        return({'address': address, 'alias': device['alias'], 'rssi': device['rssi'], 'last_seen': device['last_seen'],
+                'nb_bursts': device['nb_bursts'], 'burst_interval': interval, 'next_burst': next_burst,
+                # A burst can be missed (out of range, scanner busy), so a device is late after 1.5 intervals
+                'late': (next_burst is not None) and (now > device['burst_start'] + 1.5 * interval),
+                'estimated_new_logs': device['nb_bursts_since_harvest'] * rate if rate else None})
+
+    def snapshot(self, now=None):
+        return([self.status(address, now) for address in self.devices])
+
+    # Publish an event for the devices that became late. To be called from time to time
+    def check(self, now=None):
+        now = time.time() if now is None else now
+        late = []
+        for address, device in self.devices.items():
+            if not device['late'] and self.status(address, now)['late']:
+                device['late'] = True
+                late.append(self.publish('late', address, now))
+        return(late)
+
+    # After a harvest, the new entries are counted from zero again
+    def mark_harvested(self, address):
+        if address in self.devices:
+            self.devices[address]['nb_bursts_since_harvest'] = 0
+        pass
+
+    def publish(self, event_type, address, event_time):
+        event = dict(self.status(address, event_time), event=event_type, time=event_time)
+        if self.events.full():
+            self.events.get_nowait()
+        self.events.put_nowait(event)
+        return(event)
+
+    # Async stream of the events. check() is run every check_interval s, to detect late devices
+    async def stream(self, check_interval=60):
+        while True:
+            try:
+                yield await asyncio.wait_for(self.events.get(), timeout=check_interval)
+            except asyncio.TimeoutError:
+                self.check()
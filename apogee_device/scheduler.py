@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from . import fleet
+from .jsonfile import atomic_write_json
+
+# Planning of the harvests from the time each device's memory will be full
+#
+# Each μCache reports when its data log will start overwriting entries that were not transferred (log full
+# time) and its logging interval. Instead of visiting every device at fixed times, the harvest_scheduler
+# plans the next visit of each device just before its memory is full, minus a safety margin and the time
+# needed to transfer the entries logged until then. Devices are visited less often, and no data is lost.
+#
+# plan() also checks that the harvests fit in the available capacity (max_concurrent connections at the
+# same time): visits that cannot start before the memory of their device is full are reported.
+#
+#   scheduler = scheduler.harvest_scheduler(file_path='./schedule.json', max_concurrent=3)
+#   await scheduler.run(device_list, './data_{address}.csv', './logfile.csv')
+
+# Outcomes of download_routine() for which the device answered
+answered_statuses = ['downloaded', 'not logging', 'not enough logs']
+
+class harvest_scheduler:
+    # margin: fraction of the time between two visits kept as safety margin, at least min_margin s
+    # min_interval, max_interval: limits of the time between two visits of a device, in s
+    # retry_delay: time in s before a device that failed is tried again
+    # transfer_rate: records per s, until it is measured. connection_time: s spent connecting and reading the status
+    def __init__(self, margin=0.1, min_margin=3600, min_interval=600, max_interval=None, retry_delay=900,
+                 max_concurrent=3, transfer_rate=100, connection_time=20, file_path=None):
+        self.margin = margin
+        self.min_margin = min_margin
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.retry_delay = retry_delay
+        self.max_concurrent = max_concurrent
+        self.transfer_rate = transfer_rate
+        self.connection_time = connection_time
+        self.file_path = file_path
+        # address -> {'last_visit', 'log_full_time', 'logging_interval', 'transfer_rate', 'next_visit'}
+        self.devices = {}
+        if file_path is not None and os.path.isfile(file_path):
+            try:
+                with open(file_path) as f:
+                    self.devices = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Failed to load the schedule from {file_path}: {e}')
+
+    def device(self, address):
+        if address not in self.devices:
+            self.devices[address] = {'last_visit': None, 'log_full_time': None, 'logging_interval': None,
+                                     'transfer_rate': None, 'next_visit': None}
+        return(self.devices[address])
+
+    # Expected duration in s of a visit at visit_time: connection and transfer of the entries logged until then
+    def visit_duration(self, address, visit_time):
+        device = self.device(address)
+        transfer_rate = device['transfer_rate'] or self.transfer_rate
+        nb_logs = 0
+        if(device['logging_interval']) and (device['last_visit'] is not None):
+            nb_logs = max(visit_time - device['last_visit'], 0) / device['logging_interval']
+        return(self.connection_time + nb_logs / transfer_rate)
+
+    # Record the state of a device after a visit, and plan the next one
+    def update(self, address, log_full_time, logging_interval, nb_logs=0, transfer_duration=None, now=None):
+        now = time.time() if now is None else now
+        device = self.device(address)
+        device['last_visit'] = now
+        device['log_full_time'] = log_full_time
+        device['logging_interval'] = logging_interval
+        if(nb_logs > 0) and transfer_duration:
+            # Smoothed, a single slow transfer should not change the plan much
+            rate = nb_logs / transfer_duration
+            device['transfer_rate'] = rate if device['transfer_rate'] is None else 0.7 * device['transfer_rate'] + 0.3 * rate
+        device['next_visit'] = self.plan_visit(address, now)
+        return(device['next_visit'])
+
+    def plan_visit(self, address, now):
+        device = self.device(address)
+        if device['log_full_time'] is None:
+            # Logging is disabled: nothing to lose, the device is only checked from time to time
+            next_visit = now + (self.max_interval or 86400)
+        else:
+            margin = max(self.min_margin, self.margin * (device['log_full_time'] - now))
+            next_visit = device['log_full_time'] - margin
+            next_visit -= self.visit_duration(address, next_visit)
+        if self.max_interval is not None:
+            next_visit = min(next_visit, now + self.max_interval)
+        return(max(next_visit, now + self.min_interval))
+
+    # Update from a result of fleet.harvest_device()
+    def update_from_result(self, result, now=None):
+        now = time.time() if now is None else now
+        address = result['address']
+        if(result['status'] in answered_statuses) and result.get('logging_interval'):
+            transfer_duration = result['duration'] - self.connection_time if result['duration'] else None
+            return(self.update(address, result['log_full_time'], result['logging_interval'], result['nb_logs'],
+                               transfer_duration if transfer_duration and transfer_duration > 0 else None, now))
+        # Failed (or skipped): tried again soon, but never after its memory is full
+        device = self.device(address)
+        next_visit = now + self.retry_delay
+        if device['log_full_time'] is not None:
+            next_visit = min(next_visit, max(device['log_full_time'] - self.visit_duration(address, now), now))
+        device['next_visit'] = next_visit
+        return(next_visit)
+
+    def next_visit(self, address):
+        return(self.device(address)['next_visit'])
+
+    # Devices to visit now. Devices without any information are visited at once
+    def due(self, addresses=None, now=None):
+        now = time.time() if now is None else now
+        addresses = list(self.devices) if addresses is None else addresses
+        return([address for address in addresses
+                if(self.next_visit(address) is None) or (self.next_visit(address) <= now)])
+
+    # Check the visits planned within horizon s against the capacity: at most max_concurrent visits at the same
+    # time. Returns a report with the planned visits, the time the connections are busy, and the overruns
+    # (visits that cannot start before the memory of their device is full)
+    def plan(self, addresses=None, horizon=86400, now=None):
+        now = time.time() if now is None else now
+        addresses = list(self.devices) if addresses is None else addresses
+        visits = []
+        for address in addresses:
+            device = self.device(address)
+            next_visit = device['next_visit'] if device['next_visit'] is not None else now
+            # The time between two visits stays about the same, as long as the settings do not change
+            if(device['last_visit'] is not None) and (device['next_visit'] is not None):
+                period = max(device['next_visit'] - device['last_visit'], self.min_interval)
+            else:
+                period = None
+            fill_time = device['log_full_time']
+            visit_time = max(next_visit, now)
+            while visit_time < now + horizon:
+                duration = self.visit_duration(address, visit_time) if period is None else \
+                           self.connection_time + period / (device['logging_interval'] or period) / (device['transfer_rate'] or self.transfer_rate)
+                visits.append({'address': address, 'time': visit_time, 'duration': duration, 'deadline': fill_time})
+                if period is None:
+                    break
+                if fill_time is not None:
+                    fill_time += period
+                visit_time += period
+        # Visits start in the order they are due, on the first of the max_concurrent connections that is free
+        connections = [now] * self.max_concurrent
+        overruns = []
+        for visit in sorted(visits, key=lambda visit: visit['time']):
+            i = connections.index(min(connections))
+            visit['start'] = max(visit['time'], connections[i])
+            connections[i] = visit['start'] + visit['duration']
+            if(visit['deadline'] is not None) and (visit['start'] + visit['duration'] > visit['deadline']):
+                overruns.append({'address': visit['address'], 'start': visit['start'], 'log_full_time': visit['deadline'],
+                                 'late_by': visit['start'] + visit['duration'] - visit['deadline']})
+        busy_time = sum(visit['duration'] for visit in visits)
+        capacity = self.max_concurrent * horizon
+        report = {'horizon': horizon, 'nb_visits': len(visits), 'busy_time': busy_time, 'capacity': capacity,
+                  'utilisation': busy_time / capacity, 'over_capacity': bool(overruns) or busy_time > capacity,
+                  'overruns': overruns, 'visits': sorted(visits, key=lambda visit: visit['start'])}
+        if report['over_capacity']:
+            logging.warning(f'The harvests planned in the next {horizon}s exceed the capacity: utilisation ' +
+                            f'{round(100 * report["utilisation"])}%, {len(overruns)} visits would end after the memory of their device is full')
+        return(report)
+
+    def save(self):
+        if self.file_path is None:
+            return
+        atomic_write_json(self.file_path, self.devices, indent=2)
+        pass
+
+    # Harvest the devices when they are due, forever (or until cancelled). harvest_kwargs are passed to
+    # fleet.harvest_fleet(). The devices are checked at least every poll_interval s. devices can also be a
+    # function returning the current list of devices (e.g. the devices heard by a scanner.device_listener)
+    async def run(self, devices, datafile, logfile, poll_interval=3600, silent=True, **harvest_kwargs):
+        while True:
+            addresses = [device['address'] if isinstance(device, dict) else device
+                         for device in (devices() if callable(devices) else devices)]
+            due = self.due(addresses)
+            if due:
+                results = await fleet.harvest_fleet(due, datafile, logfile, max_concurrent=self.max_concurrent,
+                                                    silent=silent, **harvest_kwargs)
+                for result in results:
+                    self.update_from_result(result)
+                self.save()
+                if not silent:
+                    fleet.print_summary(results)
+                self.plan(addresses)
+            next_visits = [self.next_visit(address) for address in addresses if self.next_visit(address) is not None]
+            wait_time = min(next_visits) - time.time() if next_visits else poll_interval
+            await asyncio.sleep(min(max(wait_time, 1), poll_interval))
+
+def print_report(report):
+    print('Harvest plan for the next ' + str(round(report['horizon'] / 3600, 1)) + 'h:')
+    print('  ' + str(report['nb_visits']) + ' visits, connections busy ' + str(round(report['busy_time'] / 60, 1)) +
+          ' min (' + str(round(100 * report['utilisation'], 1)) + '% of the capacity)')
+    for overrun in report['overruns']:
+        print('  - ' + overrun['address'] + ': memory full at ' + time.strftime('%Y-%m-%d %H:%M', time.localtime(overrun['log_full_time'])) +
+              ', harvest would end ' + str(round(overrun['late_by'] / 60, 1)) + ' min too late')
+    pass
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import time
+from .apogee_device import ucache
+
+# Pool of connected ucache sessions, by device address
+#
+# Connecting to a device takes a few seconds. Instead of connecting and disconnecting in each routine, a
+# session_pool keeps the connection open after use, for idle_timeout seconds, so that running setup_routine()
+# right after info_routine(), or reading a device twice in the same cycle, reuses the connection.
+# A session is only used by one task at a time. Before it is reused, the connection is checked with a
+# short read (health check), and the device is connected again if the link was lost. Connections idle for
+# longer than idle_timeout are closed in the background, the least recently used idle connection is closed
+# when max_connections would be exceeded, and trim() closes the idle connections on demand (e.g. when
+# memory is short).
+#
+#   async with session.session_pool(idle_timeout=60) as pool:
+#       async with pool.session(device_address) as ucache:
+#           await ucache.info_routine()
+#       async with pool.session(device_address) as ucache: # Same connection
+#           await ucache.setup_routine(logfile)
+
+class session_pool:
+    # ucache_kwargs are passed to each ucache (use_numpy, metadata_cache, metrics).
+    # client_factory(address) can provide the client of each device (e.g. simulator.client_factory())
+    def __init__(self, idle_timeout=60, max_connections=3, health_check_timeout=5, client_factory=None, **ucache_kwargs):
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.health_check_timeout = health_check_timeout
+        self.client_factory = client_factory
+        self.ucache_kwargs = ucache_kwargs
+        # address -> {'device': ucache, 'in_use': bool, 'last_used': time}
+        self.sessions = {}
+        self.changed = asyncio.Condition()
+        self.eviction_task = None
+
+    def __len__(self):
+        return(len(self.sessions))
+
+    async def __aenter__(self):
+        self.start()
+        return(self)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+        return(False)
+
+    # Starts closing idle connections in the background
+    def start(self):
+        if self.eviction_task is None:
+            self.eviction_task = asyncio.ensure_future(self.evict_idle_loop())
+        pass
+
+    # async with pool.session(address) as ucache: the ucache is connected during the block
+    def session(self, address):
+        return(pooled_session(self, address))
+
+    async def acquire(self, address):
+        async with self.changed:
+            # Wait until the session is free, and a connection is available for a new device
+            while True:
+                session = self.sessions.get(address)
+                if session is not None:
+                    if not session['in_use']:
+                        break
+                elif(self.nb_connected() < self.max_connections) or self.least_recently_used() is not None:
+                    break
+                await self.changed.wait()
+            if session is None:
+                if(self.nb_connected() >= self.max_connections):
+                    await self.evict(self.least_recently_used())
+                client = self.client_factory(address) if self.client_factory is not None else None
+                session = {'device': ucache(address, client=client, **self.ucache_kwargs), 'in_use': True, 'last_used': None}
+                # The routines of the ucache leave the connection open, the pool closes it
+                session['device'].keep_connected = True
+                self.sessions[address] = session
+            session['in_use'] = True
+        device = session['device']
+        try:
+            if not device.disconnected and not await self.healthy(device):
+                logging.info(f'Connection to {address} lost, connecting again')
+                await self.close_connection(device)
+            if device.disconnected:
+                await device.connect()
+        except Exception:
+            await self.release(address, failed=True)
+            raise
+        return(device)
+
+    # After a failure, the state of the connection is unknown: it is closed rather than reused
+    async def release(self, address, failed=False):
+        session = self.sessions.get(address)
+        if session is None:
+            return
+        if failed:
+            await self.close_connection(session['device'])
+            del self.sessions[address]
+        else:
+            session['last_used'] = time.monotonic()
+        async with self.changed:
+            session['in_use'] = False
+            self.changed.notify_all()
+        pass
+
+    async def healthy(self, device):
+        if not getattr(device.client, 'is_connected', True):
+            device.disconnected = True
+            return(False)
+        try:
+            await asyncio.wait_for(device.read_battery_level(), timeout=self.health_check_timeout)
+            return(True)
+        except Exception:
+            return(False)
+
+    async def close_connection(self, device):
+        try:
+            await device.disconnect(force=True)
+        except Exception as e:
+            logging.error(f'Failed to disconnect from {device.address}: {e}')
+        pass
+
+    def nb_connected(self):
+        return(len([session for session in self.sessions.values() if not session['device'].disconnected or session['in_use']]))
+
+    # Address of the idle session that was used the longest time ago, None if all sessions are in use
+    def least_recently_used(self):
+        idle = [(session['last_used'], address) for address, session in self.sessions.items() if not session['in_use']]
+        return(min(idle)[1] if idle else None)
+
+    async def evict(self, address):
+        session = self.sessions.pop(address, None)
+        if session is not None:
+            await self.close_connection(session['device'])
+        pass
+
+    # Close the connections idle for more than max_idle_time seconds (all idle connections by default)
+    async def trim(self, max_idle_time=0):
+        now = time.monotonic()
+        for address, session in list(self.sessions.items()):
+            if not session['in_use'] and (now - session['last_used'] >= max_idle_time):
+                await self.evict(address)
+        async with self.changed:
+            self.changed.notify_all()
+        pass
+
+    async def evict_idle_loop(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 0.1))
+            try:
+                await self.trim(self.idle_timeout)
+            except Exception as e:
+                logging.error(f'Failed to close idle connections: {e}')
+
+    async def close(self):
+        if self.eviction_task is not None:
+            self.eviction_task.cancel()
+            try:
+                await self.eviction_task
+            except asyncio.CancelledError:
+                pass
+            self.eviction_task = None
+        for address in list(self.sessions):
+            await self.evict(address)
+        pass
+
+class pooled_session:
+    def __init__(self, pool, address):
+        self.pool = pool
+        self.address = address
+
+    async def __aenter__(self):
+        return(await self.pool.acquire(self.address))
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.pool.release(self.address, failed=exc_type is not None)
+        return(False)
@@ -0,0 +1,339 @@
+import asyncio
+import math
+import random
+import struct
+import time
+
+# In-process simulation of a μCache AT-100, to test and benchmark without hardware
+#
+# simulated_ucache holds the state of the device (time, alias, sensor, logging settings, data log...) and
+# implements the GATT profile described in the API manual. simulated_client has the same methods as the
+# BleakClient used by ucache, so it can be passed to ucache(address, client=...). Notification rate, GATT
+# latency, packet loss, disconnections and the size of the data log can be set, e.g.
+#
+#   device = simulator.simulated_ucache(nb_logs=50000, notification_rate=400, packet_loss=0.01)
+#   ucache = apogee_device.ucache(device.address, client=device.client())
+
+base_apogee_service_uuid = 'b3e0xxxx-2594-42a1-a5fe-4e660ff2868f'
+base_ble_uuid = '0000xxxx-0000-1000-8000-00805f9b34fb'
+end_of_transfer = b'\xFF\xFF\xFF\xFF'
+
+# Number of outputs of each sensor, Table 10 in the API manual
+sensor_outputs = {0: 1, 1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1, 8: 1, 9: 2, 10: 1, 11: 1, 12: 2, 13: 2, 14: 2,
+                  15: 2, 16: 2, 17: 2, 18: 1, 19: 1, 20: 2, 21: 1, 22: 1, 23: 4, 24: 4, 25: 4, 26: 2, 27: 1, 28: 1,
+                  35: 3, 36: 3}
+
+class simulated_ucache:
+    def __init__(self, address='00:00:00:00:00:01', alias='Simulated', serial_number='1000', sensor_id=1,
+                 nb_logs=1000, logging_interval=60, sampling_interval=10, first_log_time=None, log_capacity=400000,
+                 battery_level=90, notification_rate=None, latency=0.0, connect_time=0.0, packet_loss=0.0,
+                 disconnect_after=None, connect_failures=0, live_interval=0.5, rssi=-60, seed=None):
+        self.address = address
+        self.alias = alias
+        # Signal strength in dBm, or a dictionnary adapter -> RSSI with the adapters in range (see adapters.py)
+        self.rssi = rssi
+        self.device_info = {'manufacturer_name': 'Apogee Instruments', 'model_number': 'AT-100',
+                            'serial_number': serial_number, 'firmware_revision': '1.0.0', 'hardware_revision': 'A'}
+        self.battery_level = battery_level
+        self.sensor_id = sensor_id
+        self.live_averaging = 0
+        self.advertising_frequency = 0
+        # Device clock, as an offset to the computer clock
+        self.time_offset = 0
+        # Data log. Entry i has the timestamp first_log_time + i * logging_interval
+        self.sampling_interval = sampling_interval
+        self.logging_interval = logging_interval
+        self.log_capacity = log_capacity
+        self.nb_logs = nb_logs
+        if first_log_time is None:
+            first_log_time = (int(time.time()) // logging_interval - nb_logs) * logging_interval
+        self.first_log_time = first_log_time
+        self.logging_status = True
+        # As on a new device, the last transferred time is one interval before the first entry
+        self.last_transferred_time = first_log_time - logging_interval
+        # Link behaviour
+        self.notification_rate = notification_rate # Notifications per second, None is as fast as possible
+        self.latency = latency                     # Delay of each GATT read or write, in s
+        self.connect_time = connect_time           # Time needed to connect, in s
+        self.packet_loss = packet_loss             # Probability that a notification is lost
+        self.disconnect_after = disconnect_after   # The link drops after this many data log notifications
+        self.connect_failures = connect_failures   # Number of connection attempts that will fail
+        self.live_interval = live_interval
+        self.random = random.Random(seed)
+        self.connected_client = None
+        self.nb_notifications = 0
+
+    def client(self, **kwargs):
+        return(simulated_client(self, **kwargs))
+
+    def current_time(self):
+        return(int(time.time()) + self.time_offset)
+
+    # RSSI heard by an adapter, None if the device is out of its range
+    def adapter_rssi(self, adapter=None):
+        if isinstance(self.rssi, dict):
+            return(self.rssi.get(adapter))
+        return(self.rssi)
+
+    def nb_outputs(self):
+        return(sensor_outputs.get(self.sensor_id, 1))
+
+    # Add entries to the data log, as if the device had been logging for a while
+    def add_logs(self, nb_logs):
+        self.nb_logs += nb_logs
+        pass
+
+    def log_time(self, index):
+        return(self.first_log_time + index * self.logging_interval)
+
+    # Raw values of a data log entry (32-bit fixed point, exponent -4): a daily cycle and one offset per output
+    def log_values(self, index):
+        day_fraction = (self.log_time(index) % 86400) / 86400
+        return([int((500 + 400 * math.sin(2 * math.pi * day_fraction) + 10 * output) * 10000)
+                for output in range(self.nb_outputs())])
+
+    def log_entry(self, index):
+        values = self.log_values(index)
+        return(struct.pack('<I{}i'.format(len(values)), self.log_time(index), *values))
+
+    # Index of the first entry after the last transferred time
+    def first_untransferred_index(self):
+        if(self.nb_logs == 0):
+            return(0)
+        index = (self.last_transferred_time - self.first_log_time) // self.logging_interval + 1
+        return(min(max(index, 0), self.nb_logs))
+
+    def log_full_time(self):
+        if not self.logging_status:
+            return(0)
+        free_entries = self.log_capacity - (self.nb_logs - self.first_untransferred_index())
+        return(self.log_time(self.nb_logs - 1 if self.nb_logs else 0) + free_entries * self.logging_interval)
+
+    # Manufacturer specific data of the scan response: company ID 0x0644 followed by the alias
+    def manufacturer_data(self):
+        return({0x0644: self.alias.encode('utf-8')})
+
+    # GATT profile: value of each readable characteristic
+    def read(self, uuid):
+        uuid = uuid.lower()
+        if(uuid == base_ble_uuid.replace('xxxx', '2a29')):
+            return(self.device_info['manufacturer_name'].encode('utf-8'))
+        if(uuid == base_ble_uuid.replace('xxxx', '2a24')):
+            return(self.device_info['model_number'].encode('utf-8'))
+        if(uuid == base_ble_uuid.replace('xxxx', '2a25')):
+            return(self.device_info['serial_number'].encode('utf-8'))
+        if(uuid == base_ble_uuid.replace('xxxx', '2a26')):
+            return(self.device_info['firmware_revision'].encode('utf-8'))
+        if(uuid == base_ble_uuid.replace('xxxx', '2a27')):
+            return(self.device_info['hardware_revision'].encode('utf-8'))
+        if(uuid == base_ble_uuid.replace('xxxx', '2a19')):
+            return(struct.pack('<B', self.battery_level))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0003')):
+            return(struct.pack('<B', self.sensor_id))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0004')):
+            return(self.alias.encode('utf-8'))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0005')):
+            return(struct.pack('<B', self.live_averaging))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '000a')):
+            return(struct.pack('<I', self.current_time()))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '000c')):
+            return(struct.pack('<I', self.log_full_time()))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '000d')):
+            oldest_time = self.first_log_time if self.nb_logs else 0
+            return(struct.pack('<III', self.nb_logs - self.first_untransferred_index(), oldest_time, self.nb_logs))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '000e')):
+            return(struct.pack('<I', self.last_transferred_time if self.nb_logs else 0))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0010')):
+            return(struct.pack('<B', int(self.logging_status)))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0012')):
+            start_time = self.first_log_time if self.logging_status else 0
+            return(struct.pack('<III', self.sampling_interval, self.logging_interval, start_time))
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0014')):
+            return(struct.pack('<B', self.advertising_frequency))
+        raise Exception(f'Characteristic {uuid} not found')
+
+    def write(self, uuid, data):
+        uuid = uuid.lower()
+        data = bytes(data)
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0003')):
+            self.sensor_id = struct.unpack('<B', data)[0]
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '0004')):
+            self.alias = data[:16].decode('utf-8')
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '0005')):
+            self.live_averaging = min(struct.unpack('<B', data)[0], 127)
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '000a')):
+            self.time_offset = struct.unpack('<I', data)[0] - int(time.time())
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '000e')):
+            last_transferred_time = struct.unpack('<I', data)[0]
+            # 0 means from the oldest entry
+            if(last_transferred_time == 0):
+                last_transferred_time = self.first_log_time - self.logging_interval
+            self.last_transferred_time = last_transferred_time
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '0010')):
+            self.logging_status = bool(struct.unpack('<B', data)[0] & 0x01)
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '0012')):
+            values = struct.unpack('<{}I'.format(len(data) // 4), data)
+            sampling_interval, logging_interval = values[0], values[1]
+            # Validated as described in the API manual, invalid settings are ignored
+            if(sampling_interval == 0) or (logging_interval == 0) or (logging_interval < sampling_interval) or \
+              (logging_interval % sampling_interval != 0):
+                return
+            self.sampling_interval = sampling_interval
+            self.logging_interval = logging_interval
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '0014')):
+            self.advertising_frequency = struct.unpack('<B', data)[0]
+        else:
+            raise Exception(f'Characteristic {uuid} not found or not writable')
+        pass
+
+# Lookup of characteristics, as client.services in Bleak
+class simulated_services:
+    def get_characteristic(self, uuid):
+        return(uuid.lower())
+
+class simulated_client:
+    def __init__(self, device, timeout=5.0, disconnected_callback=None, adapter=None):
+        self.device = device
+        self.address = device.address
+        self.timeout = timeout
+        self.adapter = adapter
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.services = simulated_services()
+        self.notify_tasks = {}
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(self.device.connect_time)
+        if(self.device.adapter_rssi(self.adapter) is None):
+            raise Exception(f'Device with address {self.address} was not found')
+        if(self.device.connect_failures > 0):
+            self.device.connect_failures -= 1
+            raise Exception(f'Device with address {self.address} was not found')
+        if(self.device.connected_client is not None) and (self.device.connected_client is not self):
+            raise Exception(f'Device with address {self.address} is already connected')
+        self.device.connected_client = self
+        self.is_connected = True
+        return(True)
+
+    async def disconnect(self):
+        self.drop_connection(callback=False)
+        return(True)
+
+    # The link is lost (or closed): notifications stop and the device can be connected again
+    def drop_connection(self, callback=True):
+        for task in self.notify_tasks.values():
+            task.cancel()
+        self.notify_tasks = {}
+        was_connected = self.is_connected
+        self.is_connected = False
+        if self.device.connected_client is self:
+            self.device.connected_client = None
+        if callback and was_connected and (self.disconnected_callback is not None):
+            self.disconnected_callback(self)
+        pass
+
+    def check_connection(self):
+        if not self.is_connected:
+            raise Exception(f'Not connected to {self.address}')
+        pass
+
+    async def read_gatt_char(self, characteristic, **kwargs):
+        self.check_connection()
+        await asyncio.sleep(self.device.latency)
+        self.check_connection()
+        return(bytearray(self.device.read(str(characteristic))))
+
+    async def write_gatt_char(self, characteristic, data, response=None):
+        self.check_connection()
+        await asyncio.sleep(self.device.latency)
+        self.check_connection()
+        self.device.write(str(characteristic), data)
+        pass
+
+    async def start_notify(self, characteristic, callback, **kwargs):
+        self.check_connection()
+        await asyncio.sleep(self.device.latency)
+        uuid = str(characteristic).lower()
+        if(uuid in self.notify_tasks):
+            raise Exception(f'Notifications already started for {uuid}')
+        if(uuid == base_apogee_service_uuid.replace('xxxx', '0013')):
+            self.notify_tasks[uuid] = asyncio.ensure_future(self.stream_data_log(uuid, callback))
+        elif(uuid == base_apogee_service_uuid.replace('xxxx', '0002')):
+            self.notify_tasks[uuid] = asyncio.ensure_future(self.stream_live_data(uuid, callback))
+        else:
+            raise Exception(f'Characteristic {uuid} does not support notifications')
+        pass
+
+    async def stop_notify(self, characteristic):
+        self.check_connection()
+        task = self.notify_tasks.pop(str(characteristic).lower(), None)
+        if task is not None:
+            task.cancel()
+        await asyncio.sleep(self.device.latency)
+        pass
+
+    def notify(self, callback, data):
+        # Lost packets are sent by the device but never received
+        if(self.device.packet_loss > 0) and (self.device.random.random() < self.device.packet_loss):
+            return
+        result = callback(self, bytearray(data))
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(result)
+        pass
+
+    # Send every entry after the last transferred time, followed by FF-FF-FF-FF
+    async def stream_data_log(self, uuid, callback):
+        device = self.device
+        rate = device.notification_rate
+        # Notifications are sent in small bursts, to keep the simulation overhead low at high rates
+        burst = 1 if rate is None else max(1, int(rate / 100))
+        index = device.first_untransferred_index()
+        nb_sent = 0
+        while(index < device.nb_logs):
+            for i in range(burst):
+                if(index >= device.nb_logs):
+                    break
+                if(device.disconnect_after is not None) and (device.nb_notifications >= device.disconnect_after):
+                    device.disconnect_after = None
+                    self.notify_tasks.pop(uuid, None)
+                    self.drop_connection()
+                    return
+                self.notify(callback, device.log_entry(index))
+                device.last_transferred_time = device.log_time(index)
+                device.nb_notifications += 1
+                index += 1
+                nb_sent += 1
+            if rate is None:
+                if(nb_sent % 100 == 0):
+                    await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(burst / rate)
+        self.notify(callback, end_of_transfer)
+        self.notify_tasks.pop(uuid, None)
+        pass
+
+    # Live data: the values of the sensor, every live_interval seconds
+    async def stream_live_data(self, uuid, callback):
+        device = self.device
+        while True:
+            day_fraction = (device.current_time() % 86400) / 86400
+            values = [int((500 + 400 * math.sin(2 * math.pi * day_fraction) + 10 * output) * 10000)
+                      for output in range(device.nb_outputs())]
+            self.notify(callback, struct.pack('<{}i'.format(len(values)), *values))
+            await asyncio.sleep(device.live_interval)
+
+# Returns a function creating clients for several simulated devices, by address
+def client_factory(devices):
+    devices = {device.address: device for device in devices}
+    def create_client(address, **kwargs):
+        return(devices[address].client(**kwargs))
+    return(create_client)
+
+# Returns a function listing the simulated devices heard by an adapter, as search_devices() (see adapters.py)
+def search_function(devices):
+    async def search(adapter, timeout):
+        await asyncio.sleep(0)
+        return([{'address': device.address, 'name': device.alias, 'rssi': device.adapter_rssi(adapter),
+                 'company_id': 0x0644, 'advertised_data': device.alias.encode(), 'alias': device.alias}
+                for device in devices if device.adapter_rssi(adapter) is not None])
+    return(search)
@@ -0,0 +1,835 @@
+import asyncio
+import bisect
+import collections
+import csv
+import datetime
+import importlib
+import io
+import json
+import logging
+import operator
+import os
+import sys
+import threading
+import time
+from .timestamp_index import timestamp_index
+
+# Storage backends for the downloaded data
+#
+# A storage backend can be passed to ucache.write_datafile() and download_routine() instead of a file path.
+# Each backend implements write(serial, dataset, sensor) and read(serial, start_time, end_time):
+#   - csv_backend: the same CSV files as write_datafile(), one file per device serial. A sorted index of the
+#     stored timestamps (see timestamp_index.py) is kept next to each file, to drop records that are already
+#     stored and to read a time range without parsing the whole file
+#   - npy_backend: binary NumPy segments (raw uint32 timestamps and float64 values), partitioned by
+#     device serial and by month or day. Reading needs no text parsing, and returns a structured array.
+#     The segment names hold their time range, which is used to find the records that are already stored.
+#     Segments are memory-mapped, and a time range held by a single segment is returned without copying
+#     (see archive.py to analyse large archives)
+#   - sqlite_backend: a single SQLite database (WAL mode) holding the records of all devices and the
+#     operational log, that can be shared by several harvest processes
+#   - rotating_backend: CSV segments per device and day (or month), compressed once the day is over, and
+#     the operational log in daily segments as well. Writes only append to the segment of the current day
+#
+#   storage = storage.npy_backend('./data')
+#   await ucache.download_routine(storage, logfile)
+#   data = storage.read('1234', start_time=1672531200)
+
+class storage_backend:
+    # Store a dataset (list of lists, or structured array from decode_logs_array()) of the device with this serial.
+    # sensor is the installed sensor (see read_installed_sensor()), it can be None if needs_sensor() is False
+    def write(self, serial, dataset, sensor=None, fsync=False):
+        raise NotImplementedError
+
+    # Stored data of a device between start_time and end_time (unix timestamps, included), as a structured array
+    def read(self, serial, start_time=None, end_time=None):
+        raise NotImplementedError
+
+    # Whether write() needs the installed sensor for this device (e.g. to write a header)
+    def needs_sensor(self, serial):
+        return(False)
+
+    # Store one entry of the operational log (dictionnary, see setup_routine() and download_routine()).
+    # Only backends that hold the log implement it, otherwise ucache.write_logfile() needs a file path
+    def write_log(self, entry):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+# NumPy is optional, it is only needed for the binary storage and the arrays. It is imported when it is first
+# used, so that the commands that do not need it (see cli.py) start quickly. With required=False, None is
+# returned if it is not installed
+def numpy_module(required=True):
+    try:
+        import numpy
+    except ImportError:
+        if required:
+            raise ImportError('NumPy is required for binary storage')
+        return(None)
+    return(numpy)
+
+# Whether a dataset is a structured array. Arrays only exist if NumPy was imported, it is not imported here
+def is_array(dataset):
+    numpy = sys.modules.get('numpy')
+    return((numpy is not None) and isinstance(dataset, numpy.ndarray))
+
+# Convert a dataset to a structured array with the fields 'timestamp' (uint32) and 'values' (float64)
+def to_array(dataset, nb_outputs=None):
+    np = numpy_module()
+    if isinstance(dataset, np.ndarray):
+        return(dataset)
+    if(nb_outputs is None):
+        nb_outputs = len(dataset[0]) - 1 if len(dataset) > 0 else 1
+    array = np.empty(len(dataset), dtype=[('timestamp', '<u4'), ('values', '<f8', (nb_outputs,))])
+    if(len(dataset) > 0):
+        array['timestamp'] = [row[0] for row in dataset]
+        array['values'] = [row[1:] for row in dataset]
+    return(array)
+
+# Convert a structured array to a pandas DataFrame, with one column per sensor output
+def to_dataframe(array, sensor=None):
+    import pandas as pd
+    nb_outputs = array.dtype['values'].shape[0] if array.dtype['values'].shape else 1
+    names = sensor['params'].split(',') if sensor and sensor.get('params') else []
+    if(len(names) != nb_outputs):
+        names = ['value_' + str(i + 1) for i in range(nb_outputs)]
+    values = array['values'].reshape(len(array), nb_outputs)
+    dataframe = pd.DataFrame(values, columns=names)
+    dataframe.insert(0, 'timestamp', pd.to_datetime(array['timestamp'], unit='s'))
+    return(dataframe)
+
+# Position of timestamp in a sorted structured array, like np.searchsorted(). np.searchsorted() makes a
+# contiguous copy of the whole timestamp column of a memory-mapped array, the binary search only reads
+# the few records it compares to
+def search_time(array, timestamp, side='left'):
+    timestamps = array['timestamp']
+    if(side == 'left'):
+        return(bisect.bisect_left(timestamps, timestamp))
+    return(bisect.bisect_right(timestamps, timestamp))
+
+# Index file path -> timestamp_index, shared by all the csv_backends of the process, so that an index is only
+# loaded once (e.g. when write_datafile() is called for each batch of a transfer). The least recently used
+# indexes are dropped when they hold more than max_index_entries timestamps in total (12 bytes each)
+open_indexes = collections.OrderedDict()
+open_indexes_lock = threading.Lock()
+max_index_entries = 2000000
+
+class csv_backend(storage_backend):
+    # file_path can contain '{serial}', otherwise all devices are written to the same file.
+    # With index=False, no index file is kept: records are always appended and read() parses the whole file
+    def __init__(self, file_path='./data_{serial}.csv', index=True):
+        self.file_path = file_path
+        self.use_index = index
+
+    def __str__(self):
+        return(self.file_path)
+
+    def path(self, serial):
+        return(self.file_path.replace('{serial}', str(serial)))
+
+    def needs_sensor(self, serial):
+        return(not os.path.isfile(self.path(serial)))
+
+    # Sensor parameters and units, from the header of the file. Some sensors have more outputs than parameter
+    # names (e.g. SI-100: one name, two values), so the number of outputs is that of the first row
+    def read_sensor(self, serial):
+        file_path = self.path(serial)
+        if not os.path.isfile(file_path):
+            return(None)
+        with open(file_path, newline='') as f:
+            reader = csv.reader(f)
+            params = next(reader, ['timestamp'])[1:]
+            units = next(reader, [''])[1:]
+            first_row = next(reader, None)
+        outputs = len(first_row) - 1 if first_row else len(params)
+        return({'params': ','.join(params), 'units': ','.join(units), 'outputs': outputs})
+
+    # Whether each file only holds the records of one device
+    def per_device(self):
+        return('{serial}' in self.file_path)
+
+    # Index of the records of a device. With one file per device, it is <data file>.idx, updated with the rows
+    # that were written to the file without it. When the devices share a file, the rows do not tell which
+    # device they belong to: each device has its own index (<data file>.<serial>.idx) of the rows written for it
+    def index(self, serial):
+        file_path = self.path(serial)
+        index_path = file_path + '.idx' if self.per_device() else file_path + '.' + str(serial) + '.idx'
+        with open_indexes_lock:
+            index = open_indexes.pop(index_path, None)
+            if index is None:
+                index = timestamp_index(index_path)
+            open_indexes[index_path] = index
+            # The index in use is the most recent one, it is always kept
+            nb_entries = sum(len(cached) for cached in open_indexes.values())
+            while(nb_entries > max_index_entries) and (len(open_indexes) > 1):
+                nb_entries -= len(open_indexes.popitem(last=False)[1])
+        data_size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+        # The data file was replaced or truncated, the index is rebuilt
+        if(index.data_size > data_size):
+            index.clear()
+        if(index.data_size < data_size) and self.per_device():
+            self.scan(file_path, index)
+        return(index)
+
+    # Add the rows after the part of the file covered by the index
+    def scan(self, file_path, index):
+        with open(file_path, 'rb') as f:
+            if(index.data_size == 0):
+                f.readline() # Header: parameters
+                f.readline() # Header: units
+            else:
+                f.seek(index.data_size)
+            offset = f.tell()
+            for line in f:
+                # A partially written row (interrupted write) is left out
+                if not line.endswith(b'\n'):
+                    break
+                timestamp = line.split(b',', 1)[0].decode()
+                index.add(int(datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timestamp()), offset)
+                offset += len(line)
+        index.save(offset)
+        pass
+
+    def write(self, serial, dataset, sensor=None, fsync=False):
+        file_path = self.path(serial)
+        write_header = not os.path.isfile(file_path)
+        if is_array(dataset):
+            rows = zip(dataset['timestamp'].tolist(), dataset['values'].tolist())
+        else:
+            rows = ((row[0], row[1:]) for row in dataset)
+        index = self.index(serial) if self.use_index else None
+        if index is not None:
+            # Drop the records that are already stored (or repeated in the dataset)
+            rows = list(rows)
+            last_time = index.timestamps[-1] if len(index) > 0 else -1
+            timestamps = [row[0] for row in rows]
+            if(len(rows) > 0) and (timestamps[0] > last_time) and all(map(operator.lt, timestamps, timestamps[1:])):
+                pass # New records in chronological order, the common case
+            else:
+                seen = set()
+                new_rows = []
+                for timestamp, values in rows:
+                    if(timestamp in seen) or ((timestamp <= last_time) and index.contains(timestamp)):
+                        continue
+                    seen.add(timestamp)
+                    new_rows.append((timestamp, values))
+                rows = new_rows
+            if not rows and not write_header:
+                return
+        with open(file_path, mode='a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(('timestamp,' + sensor['params']).split(','))
+                writer.writerow((',' + sensor['units']).split(','))
+            if index is None:
+                writer.writerows([str(datetime.datetime.fromtimestamp(timestamp))] + values for timestamp, values in rows)
+            else:
+                # The rows only contain ASCII characters, so the offset of each row is the length of the
+                # rows before it
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows([str(datetime.datetime.fromtimestamp(timestamp))] + values for timestamp, values in rows)
+                lines = buffer.getvalue().split('\r\n')[:-1]
+                offset = f.tell()
+                f.write(buffer.getvalue())
+                offsets = []
+                for line in lines:
+                    offsets.append(offset)
+                    offset += len(line) + 2
+                index.extend([row[0] for row in rows], offsets)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if index is not None:
+            index.save(offset, fsync)
+        pass
+
+    def read(self, serial, start_time=None, end_time=None):
+        if self.use_index:
+            return(self.read_indexed(serial, start_time, end_time))
+        rows = []
+        with open(self.path(serial), newline='') as f:
+            reader = csv.reader(f)
+            next(reader) # Header: parameters
+            next(reader) # Header: units
+            for row in reader:
+                timestamp = int(datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S').timestamp())
+                if((start_time is None) or (timestamp >= start_time)) and ((end_time is None) or (timestamp <= end_time)):
+                    rows.append([timestamp] + [float(value) for value in row[1:]])
+        return(to_array(rows))
+
+    # Only the rows in the time range are read, their positions are found in the index
+    def read_indexed(self, serial, start_time=None, end_time=None):
+        rows = []
+        position = None
+        with open(self.path(serial), 'rb') as f:
+            for timestamp, offset in self.index(serial).lookup(start_time, end_time):
+                # Rows written in chronological order follow each other, no need to seek
+                if(offset != position):
+                    f.seek(offset)
+                line = f.readline()
+                position = offset + len(line)
+                rows.append([timestamp] + [float(value) for value in line.rstrip(b'\r\n').split(b',')[1:]])
+        return(to_array(rows))
+
+class npy_backend(storage_backend):
+    # Files are stored as directory/<serial>/<partition>/<first timestamp>-<last timestamp>.npy,
+    # where partition is the month (YYYY-MM) or the day (YYYY-MM-DD) of the data, in UTC
+    def __init__(self, directory, partition='month'):
+        numpy_module()
+        if partition not in ['month', 'day']:
+            raise ValueError('partition must be month or day')
+        self.directory = directory
+        self.partition = partition
+
+    def __str__(self):
+        return(self.directory)
+
+    def partition_name(self, timestamp):
+        date = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        return(date.strftime('%Y-%m') if self.partition == 'month' else date.strftime('%Y-%m-%d'))
+
+    # Start and end (excluded) timestamps of a partition
+    def partition_range(self, name):
+        if(self.partition == 'month'):
+            start = datetime.datetime.strptime(name, '%Y-%m').replace(tzinfo=datetime.timezone.utc)
+            end = (start + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            start = datetime.datetime.strptime(name, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+            end = start + datetime.timedelta(days=1)
+        return(int(start.timestamp()), int(end.timestamp()))
+
+    def needs_sensor(self, serial):
+        return(not os.path.isfile(os.path.join(self.directory, str(serial), 'sensor.json')))
+
+    def write(self, serial, dataset, sensor=None, fsync=False):
+        np = numpy_module()
+        array = to_array(dataset)
+        if(len(array) == 0):
+            return
+        device_directory = os.path.join(self.directory, str(serial))
+        os.makedirs(device_directory, exist_ok=True)
+        if sensor is not None and self.needs_sensor(serial):
+            with open(os.path.join(device_directory, 'sensor.json'), 'w') as f:
+                json.dump(sensor, f)
+        # Sort by time, drop the records that are already stored, then split into partitions
+        if np.any(np.diff(array['timestamp'].astype('i8')) < 0):
+            array = array[np.argsort(array['timestamp'], kind='stable')]
+        array = self.drop_stored(serial, array)
+        if(len(array) == 0):
+            return
+        first_partition = self.partition_name(int(array['timestamp'][0]))
+        if(first_partition == self.partition_name(int(array['timestamp'][-1]))):
+            self.write_segment(device_directory, first_partition, array, fsync)
+        else:
+            names = [self.partition_name(int(timestamp)) for timestamp in array['timestamp']]
+            boundaries = [0] + [i for i in range(1, len(names)) if names[i] != names[i - 1]] + [len(names)]
+            for start, end in zip(boundaries[:-1], boundaries[1:]):
+                self.write_segment(device_directory, names[start], array[start:end], fsync)
+        pass
+
+    # Records of a sorted array that are not repeated and not stored yet. Only the segments overlapping the
+    # time range of the array are read
+    def drop_stored(self, serial, array):
+        np = numpy_module()
+        timestamps = array['timestamp']
+        keep = np.ones(len(array), dtype=bool)
+        keep[1:] = timestamps[1:] != timestamps[:-1]
+        for first_time, last_time, file_path in self.segments(serial, int(timestamps[0]), int(timestamps[-1])):
+            stored = self.load_segment(file_path)['timestamp']
+            keep &= ~np.isin(timestamps, stored)
+        return(array[keep] if not keep.all() else array)
+
+    def write_segment(self, device_directory, partition, array, fsync=False):
+        partition_directory = os.path.join(device_directory, partition)
+        os.makedirs(partition_directory, exist_ok=True)
+        name = str(int(array['timestamp'][0])) + '-' + str(int(array['timestamp'][-1]))
+        file_path = os.path.join(partition_directory, name + '.npy')
+        index = 1
+        while os.path.exists(file_path):
+            file_path = os.path.join(partition_directory, name + '.' + str(index) + '.npy')
+            index += 1
+        # Write to a temporary file first, so that readers never see half written segments
+        with open(file_path + '.tmp', 'wb') as f:
+            numpy_module().save(f, array, allow_pickle=False)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(file_path + '.tmp', file_path)
+        return(file_path)
+
+    # Segment files of a device, with their first and last timestamps, sorted by time
+    def segments(self, serial, start_time=None, end_time=None):
+        device_directory = os.path.join(self.directory, str(serial))
+        if not os.path.isdir(device_directory):
+            return([])
+        segments = []
+        for partition in sorted(os.listdir(device_directory)):
+            partition_directory = os.path.join(device_directory, partition)
+            if not os.path.isdir(partition_directory):
+                continue
+            partition_start, partition_end = self.partition_range(partition)
+            if((end_time is not None) and (partition_start > end_time)) or ((start_time is not None) and (partition_end <= start_time)):
+                continue
+            for file_name in os.listdir(partition_directory):
+                if not file_name.endswith('.npy'):
+                    continue
+                first_time, last_time = [int(value) for value in file_name.split('.')[0].split('-')]
+                if((end_time is not None) and (first_time > end_time)) or ((start_time is not None) and (last_time < start_time)):
+                    continue
+                segments.append((first_time, last_time, os.path.join(partition_directory, file_name)))
+        return(sorted(segments))
+
+    # Memory-mapped segment: only the pages that are used are read from the disk
+    def load_segment(self, file_path):
+        return(numpy_module().load(file_path, mmap_mode='r', allow_pickle=False))
+
+    # Records of each segment between start_time and end_time, as read-only views of the memory-mapped
+    # segments (nothing is copied), in the order of the segments
+    def views(self, serial, start_time=None, end_time=None):
+        views = []
+        for first_time, last_time, file_path in self.segments(serial, start_time, end_time):
+            array = self.load_segment(file_path)
+            first = search_time(array, start_time, 'left') if start_time is not None else 0
+            last = search_time(array, end_time, 'right') if end_time is not None else len(array)
+            if(last > first):
+                views.append(array[first:last])
+        return(views)
+
+    # When a single segment holds the time range, the result is a read-only view of it
+    def read(self, serial, start_time=None, end_time=None):
+        np = numpy_module()
+        arrays = self.views(serial, start_time, end_time)
+        if not arrays:
+            return(np.empty(0, dtype=[('timestamp', '<u4'), ('values', '<f8', (self.nb_outputs(serial),))]))
+        if(len(arrays) == 1):
+            return(arrays[0])
+        array = np.concatenate(arrays)
+        if np.any(np.diff(array['timestamp'].astype('i8')) < 0):
+            array = array[np.argsort(array['timestamp'], kind='stable')]
+        return(array)
+
+    def read_sensor(self, serial):
+        file_path = os.path.join(self.directory, str(serial), 'sensor.json')
+        if not os.path.isfile(file_path):
+            return(None)
+        with open(file_path) as f:
+            return(json.load(f))
+
+    def nb_outputs(self, serial):
+        sensor = self.read_sensor(serial)
+        return(sensor['outputs'] if sensor and sensor.get('outputs') else 1)
+
+class sqlite_backend(storage_backend):
+    # Columns of the operational log, in the order of the log file written by ucache.write_logfile()
+    log_columns = ['timestamp', 'model', 'serial', 'battery_level', 'memory_full_time', 'type',
+                   'sampling_interval', 'logging_interval', 'advertising_freq', 'time_difference']
+    # A μCache sensor has at most 4 outputs
+    max_outputs = 4
+
+    # Records are keyed on (serial, timestamp): writing the same entries again replaces them instead of
+    # adding duplicates. Each write() is split into transactions of at most batch_size records, so that
+    # concurrent writers (other processes using the same file) never wait long for the write lock.
+    # They wait up to busy_timeout s for it before failing
+    def __init__(self, file_path, batch_size=10000, busy_timeout=30):
+        self.file_path = file_path
+        self.batch_size = batch_size
+        import sqlite3
+        # The connection can be shared with worker threads, the lock serialises its use
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, timeout=busy_timeout, isolation_level=None,
+                                          check_same_thread=False)
+        # WAL mode: readers do not block the writer and the writer does not block readers.
+        # NORMAL is durable in WAL mode except on power loss, write(fsync=True) syncs every transaction
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        value_columns = ', '.join('value_' + str(i + 1) + ' REAL' for i in range(self.max_outputs))
+        with self.transaction():
+            self.connection.execute('CREATE TABLE IF NOT EXISTS records (serial TEXT NOT NULL, timestamp INTEGER NOT NULL, ' +
+                                    value_columns + ', PRIMARY KEY (serial, timestamp)) WITHOUT ROWID')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sensors (serial TEXT PRIMARY KEY, sensor TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS operations (id INTEGER PRIMARY KEY AUTOINCREMENT, ' +
+                                    ', '.join(column + ' TEXT' for column in self.log_columns) + ')')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS operations_serial ON operations (serial, timestamp)')
+            # Devices whose sensor is stored, so that needs_sensor() (called in the event loop) never waits for the
+            # lock while a worker thread writes. A device added by another process only has its sensor read again
+            self.sensor_serials = set(row[0] for row in self.connection.execute('SELECT serial FROM sensors'))
+
+    def __str__(self):
+        return(self.file_path)
+
+    # BEGIN IMMEDIATE takes the write lock at the start of the transaction. With the default deferred
+    # transactions, two processes could both start reading and then fail to upgrade to writing
+    def transaction(self, fsync=False):
+        return(sqlite_transaction(self, fsync))
+
+    def needs_sensor(self, serial):
+        return(str(serial) not in self.sensor_serials)
+
+    def write(self, serial, dataset, sensor=None, fsync=False):
+        serial = str(serial)
+        if is_array(dataset):
+            rows = zip(dataset['timestamp'].tolist(), dataset['values'].tolist())
+        else:
+            rows = ((row[0], list(row[1:])) for row in dataset)
+        padding = [None] * self.max_outputs
+        records = [(serial, int(timestamp)) + tuple((values + padding)[:self.max_outputs]) for timestamp, values in rows]
+        columns = ['value_' + str(i + 1) for i in range(self.max_outputs)]
+        query = ('INSERT INTO records (serial, timestamp, ' + ', '.join(columns) + ') VALUES (' +
+                 ', '.join(['?'] * (len(columns) + 2)) + ') ON CONFLICT (serial, timestamp) DO UPDATE SET ' +
+                 ', '.join(column + ' = excluded.' + column for column in columns))
+        if sensor is not None:
+            with self.transaction(fsync):
+                self.connection.execute('INSERT OR IGNORE INTO sensors (serial, sensor) VALUES (?, ?)',
+                                        (serial, json.dumps(sensor)))
+            self.sensor_serials.add(serial)
+        for start in range(0, len(records), self.batch_size):
+            with self.transaction(fsync):
+                self.connection.executemany(query, records[start:start + self.batch_size])
+        pass
+
+    def read(self, serial, start_time=None, end_time=None):
+        nb_outputs = self.nb_outputs(serial)
+        query = 'SELECT timestamp, ' + ', '.join('value_' + str(i + 1) for i in range(nb_outputs)) + \
+                ' FROM records WHERE serial = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp'
+        parameters = (str(serial), start_time if start_time is not None else 0,
+                      end_time if end_time is not None else 2**32 - 1)
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        # Without NumPy, the records are returned as a list of lists, like decode_logs()
+        if numpy_module(required=False) is None:
+            return([list(row) for row in rows])
+        return(to_array(rows, nb_outputs))
+
+    def read_sensor(self, serial):
+        with self.lock:
+            row = self.connection.execute('SELECT sensor FROM sensors WHERE serial = ?', (str(serial),)).fetchone()
+        return(json.loads(row[0]) if row is not None else None)
+
+    def nb_outputs(self, serial):
+        sensor = self.read_sensor(serial)
+        return(min(sensor['outputs'], self.max_outputs) if sensor and sensor.get('outputs') else 1)
+
+    # Number of records, first and last timestamps of each device: serial -> (count, first, last)
+    def devices(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT serial, COUNT(*), MIN(timestamp), MAX(timestamp) FROM records ' +
+                                           'GROUP BY serial ORDER BY serial').fetchall()
+        return({row[0]: tuple(row[1:]) for row in rows})
+
+    def write_log(self, entry):
+        columns = [column for column in self.log_columns if column in entry]
+        with self.transaction():
+            self.connection.execute('INSERT INTO operations (' + ', '.join(columns) + ') VALUES (' +
+                                    ', '.join(['?'] * len(columns)) + ')',
+                                    [None if entry[column] is None else str(entry[column]) for column in columns])
+        pass
+
+    # Operational log entries (dictionnaries), oldest first, optionally of a single device
+    def read_log(self, serial=None):
+        query = 'SELECT ' + ', '.join(self.log_columns) + ' FROM operations'
+        parameters = ()
+        if serial is not None:
+            query += ' WHERE serial = ?'
+            parameters = (str(serial),)
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY id', parameters).fetchall()
+        return([dict(zip(self.log_columns, row)) for row in rows])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        pass
+
+class sqlite_transaction:
+    def __init__(self, backend, fsync=False):
+        self.backend = backend
+        self.fsync = fsync
+
+    def __enter__(self):
+        self.backend.lock.acquire()
+        connection = self.backend.connection
+        try:
+            if self.fsync:
+                connection.execute('PRAGMA synchronous=FULL')
+            connection.execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.backend.lock.release()
+            raise
+        return(connection)
+
+    def __exit__(self, exc_type, exc, tb):
+        connection = self.backend.connection
+        try:
+            connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+            if self.fsync:
+                connection.execute('PRAGMA synchronous=NORMAL')
+        finally:
+            self.backend.lock.release()
+        return(False)
+
+# Compression of the closed segments of a rotating_backend: codec -> (file extension, open function)
+codecs = {'gzip': ('.gz', 'gzip'), 'bz2': ('.bz2', 'bz2'), 'lzma': ('.xz', 'lzma'), None: ('', None)}
+
+# open() of the module of a codec, only imported when it is used
+def codec_open(module_name):
+    if module_name is None:
+        return(open)
+    return(importlib.import_module(module_name).open)
+
+class rotating_backend(storage_backend):
+    # Files are directory/<serial>/<period>.part.csv while the period (day or month, in local time like the
+    # rows) receives records, and directory/<serial>/<period>.csv.gz (depending on the codec) once it is closed.
+    # The operational log is written the same way to directory/log/. Each write only appends to the file of its
+    # period, records that are already stored are dropped. A period is closed close_delay s after its end:
+    # compact() then merges its files into a single compressed segment, sorted by time and without duplicates.
+    # Records arriving after that (e.g. a late download) go to a new .part.csv file, merged at the next compact()
+    def __init__(self, directory, period='day', codec='gzip', close_delay=3600, max_cached_periods=64):
+        if period not in ['day', 'month']:
+            raise ValueError('period must be day or month')
+        if codec not in codecs:
+            raise ValueError('codec must be one of ' + ', '.join(str(codec) for codec in codecs))
+        self.directory = directory
+        self.period = period
+        self.codec = codec
+        self.close_delay = close_delay
+        self.max_cached_periods = max_cached_periods
+        # (serial, period) -> timestamps stored, for the periods written recently
+        self.stored = collections.OrderedDict()
+        # Writes (possibly from the write thread of a pipeline) and compaction do not run at the same time
+        self.lock = threading.RLock()
+        self.compaction_task = None
+
+    def __str__(self):
+        return(self.directory)
+
+    def period_name(self, timestamp):
+        date = datetime.datetime.fromtimestamp(timestamp)
+        return(date.strftime('%Y-%m-%d') if self.period == 'day' else date.strftime('%Y-%m'))
+
+    # Start and end (excluded) timestamps of a period
+    def period_range(self, name):
+        if(self.period == 'day'):
+            start = datetime.datetime.strptime(name, '%Y-%m-%d')
+            end = start + datetime.timedelta(days=1)
+        else:
+            start = datetime.datetime.strptime(name, '%Y-%m')
+            end = (start + datetime.timedelta(days=32)).replace(day=1)
+        return(int(start.timestamp()), int(end.timestamp()))
+
+    def part_path(self, directory, period):
+        return(os.path.join(directory, period + '.part.csv'))
+
+    def closed_path(self, directory, period):
+        return(os.path.join(directory, period + '.csv' + codecs[self.codec][0]))
+
+    # Files of each period in a directory, closed segment first: period -> [file paths]
+    def period_files(self, directory):
+        periods = {}
+        if not os.path.isdir(directory):
+            return(periods)
+        for file_name in sorted(os.listdir(directory)):
+            if '.csv' not in file_name or file_name.endswith('.tmp'):
+                continue
+            periods.setdefault(file_name.split('.')[0], []).append(os.path.join(directory, file_name))
+        for file_paths in periods.values():
+            file_paths.sort(key=lambda file_path: file_path.endswith('.part.csv'))
+        return(periods)
+
+    # Rows of a segment (list of strings), after the header lines
+    def read_segment(self, file_path, nb_header_lines):
+        extension = os.path.splitext(file_path)[1]
+        opener = codec_open(next((module_name for codec_extension, module_name in codecs.values() if codec_extension == extension), None))
+        with opener(file_path, 'rt', newline='') as f:
+            reader = csv.reader(f)
+            header = [next(reader, []) for i in range(nb_header_lines)]
+            return(header, [row for row in reader if row])
+
+    def needs_sensor(self, serial):
+        return(not os.path.isfile(os.path.join(self.directory, str(serial), 'sensor.json')))
+
+    def read_sensor(self, serial):
+        file_path = os.path.join(self.directory, str(serial), 'sensor.json')
+        if not os.path.isfile(file_path):
+            return(None)
+        with open(file_path) as f:
+            return(json.load(f))
+
+    def nb_outputs(self, serial):
+        sensor = self.read_sensor(serial)
+        return(sensor['outputs'] if sensor and sensor.get('outputs') else 1)
+
+    # Timestamps stored for a device in a period, read once and then kept up to date by write()
+    def stored_timestamps(self, serial, period):
+        key = (str(serial), period)
+        timestamps = self.stored.pop(key, None)
+        if timestamps is None:
+            timestamps = set()
+            for file_path in self.period_files(os.path.join(self.directory, str(serial))).get(period, []):
+                timestamps.update(parse_timestamp(row[0]) for row in self.read_segment(file_path, 2)[1])
+        self.stored[key] = timestamps
+        if(len(self.stored) > self.max_cached_periods):
+            self.stored.popitem(last=False)
+        return(timestamps)
+
+    def write(self, serial, dataset, sensor=None, fsync=False):
+        if is_array(dataset):
+            rows = zip(dataset['timestamp'].tolist(), dataset['values'].tolist())
+        else:
+            rows = ((row[0], list(row[1:])) for row in dataset)
+        device_directory = os.path.join(self.directory, str(serial))
+        with self.lock:
+            os.makedirs(device_directory, exist_ok=True)
+            if sensor is not None and self.needs_sensor(serial):
+                with open(os.path.join(device_directory, 'sensor.json'), 'w') as f:
+                    json.dump(sensor, f)
+            # Group the new records by period
+            periods = {}
+            period, period_end, stored = None, None, None
+            for timestamp, values in rows:
+                if(period is None) or not (period_start <= timestamp < period_end):
+                    period = self.period_name(timestamp)
+                    period_start, period_end = self.period_range(period)
+                    stored = self.stored_timestamps(serial, period)
+                if timestamp in stored:
+                    continue
+                stored.add(timestamp)
+                periods.setdefault(period, []).append([str(datetime.datetime.fromtimestamp(timestamp))] + values)
+            for period, period_rows in periods.items():
+                self.append(self.part_path(device_directory, period), self.data_header(serial, len(period_rows[0]) - 1),
+                            period_rows, fsync)
+        pass
+
+    # Header lines of the data files, as written by write_datafile()
+    def data_header(self, serial, nb_outputs):
+        sensor = self.read_sensor(serial)
+        if sensor and sensor.get('params'):
+            return([('timestamp,' + sensor['params']).split(','), (',' + sensor['units']).split(',')])
+        return([['timestamp'] + ['value_' + str(i + 1) for i in range(nb_outputs)], [''] * (nb_outputs + 1)])
+
+    def append(self, file_path, header, rows, fsync=False):
+        write_header = not os.path.isfile(file_path)
+        with open(file_path, mode='a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerows(header)
+            writer.writerows(rows)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        pass
+
+    # Serial numbers of the devices in the directory
+    def devices(self):
+        if not os.path.isdir(self.directory):
+            return([])
+        return(sorted(name for name in os.listdir(self.directory)
+                      if(name != 'log') and os.path.isdir(os.path.join(self.directory, name))))
+
+    # Stored data of a device between start_time and end_time, sorted and without duplicates. Structured
+    # array, or list of lists without NumPy
+    def read(self, serial, start_time=None, end_time=None):
+        records = {}
+        with self.lock:
+            for period, file_paths in sorted(self.period_files(os.path.join(self.directory, str(serial))).items()):
+                period_start, period_end = self.period_range(period)
+                if((end_time is not None) and (period_start > end_time)) or ((start_time is not None) and (period_end <= start_time)):
+                    continue
+                for file_path in file_paths:
+                    for row in self.read_segment(file_path, 2)[1]:
+                        timestamp = parse_timestamp(row[0])
+                        if((start_time is None) or (timestamp >= start_time)) and ((end_time is None) or (timestamp <= end_time)):
+                            records.setdefault(timestamp, [float(value) for value in row[1:]])
+        rows = [[timestamp] + records[timestamp] for timestamp in sorted(records)]
+        if numpy_module(required=False) is None:
+            return(rows)
+        return(to_array(rows, len(rows[0]) - 1 if rows else self.nb_outputs(serial)))
+
+    def write_log(self, entry):
+        log_directory = os.path.join(self.directory, 'log')
+        with self.lock:
+            os.makedirs(log_directory, exist_ok=True)
+            row = ['' if entry.get(column) is None else entry[column] for column in sqlite_backend.log_columns]
+            self.append(self.part_path(log_directory, self.period_name(time.time())), [sqlite_backend.log_columns], [row])
+        pass
+
+    # Operational log entries (dictionnaries), oldest first, optionally of a single device
+    def read_log(self, serial=None):
+        entries = []
+        with self.lock:
+            for period, file_paths in sorted(self.period_files(os.path.join(self.directory, 'log')).items()):
+                for file_path in file_paths:
+                    header, rows = self.read_segment(file_path, 1)
+                    entries.extend(dict(zip(header[0], row)) for row in rows)
+        return([entry for entry in entries if(serial is None) or (entry.get('serial') == str(serial))])
+
+    # Merge the files of the periods that ended more than close_delay s ago into one compressed segment
+    # each. Returns the number of periods merged
+    def compact(self, now=None):
+        now = time.time() if now is None else now
+        nb_merged = 0
+        if not os.path.isdir(self.directory):
+            return(nb_merged)
+        for name in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, name)
+            if not os.path.isdir(directory):
+                continue
+            for period, file_paths in self.period_files(directory).items():
+                if not any(file_path.endswith('.part.csv') for file_path in file_paths):
+                    continue
+                if(self.period_range(period)[1] + self.close_delay > now):
+                    continue
+                with self.lock:
+                    self.merge(directory, period, name == 'log')
+                nb_merged += 1
+        return(nb_merged)
+
+    # Records are sorted by time, and only kept once. Log entries keep their order, repeated lines are dropped
+    def merge(self, directory, period, log=False):
+        nb_header_lines = 1 if log else 2
+        header = None
+        rows = {}
+        for file_path in self.period_files(directory).get(period, []):
+            segment_header, segment_rows = self.read_segment(file_path, nb_header_lines)
+            header = header or segment_header
+            for row in segment_rows:
+                key = tuple(row) if log else parse_timestamp(row[0])
+                rows.setdefault(key, row)
+        rows = list(rows.values()) if log else [rows[key] for key in sorted(rows)]
+        closed_path = self.closed_path(directory, period)
+        # Written to a temporary file first, so that the segment is never left half written
+        with codec_open(codecs[self.codec][1])(closed_path + '.tmp', 'wt', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerows(header)
+            writer.writerows(rows)
+        os.replace(closed_path + '.tmp', closed_path)
+        for file_path in self.period_files(directory).get(period, []):
+            if(file_path != closed_path):
+                os.remove(file_path)
+        pass
+
+    # Compacts every interval s in the background (in a worker thread, the event loop is not blocked)
+    async def compaction_loop(self, interval=3600):
+        while True:
+            try:
+                nb_merged = await asyncio.get_running_loop().run_in_executor(None, self.compact)
+                if nb_merged:
+                    logging.info(f'Compacted {nb_merged} periods in {self.directory}')
+            except Exception as e:
+                logging.error(f'Failed to compact {self.directory}: {e}')
+            await asyncio.sleep(interval)
+
+    def start(self, interval=3600):
+        if self.compaction_task is None:
+            self.compaction_task = asyncio.ensure_future(self.compaction_loop(interval))
+        pass
+
+    def close(self):
+        if self.compaction_task is not None:
+            self.compaction_task.cancel()
+            self.compaction_task = None
+        pass
+
+# Unix timestamp of a timestamp column of the CSV files (local time, as written by write_datafile())
+def parse_timestamp(value):
+    return(int(datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()))
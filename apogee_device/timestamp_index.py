@@ -0,0 +1,126 @@
+import array
+import bisect
+import operator
+import os
+import struct
+
+# Sorted index of the timestamps stored in a data file, with the position (byte offset) of their row
+#
+# It is used by storage.csv_backend to drop records that are already stored before writing them, and to
+# read a time range without parsing the whole file. The index is kept in a file next to the data file
+# (<data file>.idx) and, like the data file, it is only appended to: a header with the size of the data
+# file covered by the index, followed by one entry (uint32 timestamp, uint64 offset) per row.
+# If the data file is larger than the size in the header (rows written by another program, or a crash
+# between writing the data and the index), only the end of the data file needs to be read again.
+
+magic = b'PYUCIDX1'
+header_format = '<8sQ'
+entry_format = '<IQ'
+
+class timestamp_index:
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        # Sorted timestamps, and the offset of the row of each timestamp
+        self.timestamps = array.array('I')
+        self.offsets = array.array('Q')
+        # Size of the data file covered by the index
+        self.data_size = 0
+        # Entries not saved yet
+        self.pending = []
+        if file_path is not None and os.path.isfile(file_path):
+            self.load()
+
+    def __len__(self):
+        return(len(self.timestamps))
+
+    def load(self):
+        with open(self.file_path, 'rb') as f:
+            content = f.read()
+        header_size = struct.calcsize(header_format)
+        if(len(content) < header_size) or (content[:len(magic)] != magic):
+            return
+        self.data_size = struct.unpack_from(header_format, content)[1]
+        entry_size = struct.calcsize(entry_format)
+        nb_entries = (len(content) - header_size) // entry_size
+        # All the entries are unpacked at once, timestamps and offsets alternate
+        fields = struct.unpack_from('<' + entry_format[1:] * nb_entries, content, header_size)
+        timestamps = array.array('I', fields[0::2])
+        offsets = array.array('Q', fields[1::2])
+        # Entries written after the header was last updated are for rows beyond data_size, they are left out.
+        # After such a crash, the same entries are appended again once the data file is read again
+        if(nb_entries > 0) and ((max(offsets) >= self.data_size) or not all(map(operator.lt, timestamps, timestamps[1:]))):
+            entries = sorted(set(entry for entry in zip(timestamps, offsets) if entry[1] < self.data_size))
+            timestamps = array.array('I', [entry[0] for entry in entries])
+            offsets = array.array('Q', [entry[1] for entry in entries])
+        self.timestamps = timestamps
+        self.offsets = offsets
+        pass
+
+    def contains(self, timestamp):
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        return((i < len(self.timestamps)) and (self.timestamps[i] == timestamp))
+
+    def add(self, timestamp, offset):
+        # Data is usually written in chronological order, so appending is the common case
+        if(len(self.timestamps) == 0) or (timestamp > self.timestamps[-1]):
+            i = len(self.timestamps)
+        else:
+            i = bisect.bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(i, timestamp)
+        self.offsets.insert(i, offset)
+        self.pending.append((timestamp, offset))
+        pass
+
+    # Add the rows of a write, faster than add() when they are in chronological order after the indexed ones
+    def extend(self, timestamps, offsets):
+        timestamps = array.array('I', timestamps)
+        in_order = all(map(operator.lt, timestamps, timestamps[1:]))
+        if in_order and ((len(self.timestamps) == 0) or (len(timestamps) == 0) or (timestamps[0] > self.timestamps[-1])):
+            self.timestamps.extend(timestamps)
+            self.offsets.extend(offsets)
+            self.pending.extend(zip(timestamps, offsets))
+        else:
+            for timestamp, offset in zip(timestamps, offsets):
+                self.add(timestamp, offset)
+        pass
+
+    # Positions (first, last excluded) of the timestamps between start_time and end_time (included)
+    def range(self, start_time=None, end_time=None):
+        first = bisect.bisect_left(self.timestamps, start_time) if start_time is not None else 0
+        last = bisect.bisect_right(self.timestamps, end_time) if end_time is not None else len(self.timestamps)
+        return(first, max(first, last))
+
+    # (timestamp, offset) of the rows between start_time and end_time, sorted by time
+    def lookup(self, start_time=None, end_time=None):
+        first, last = self.range(start_time, end_time)
+        return(list(zip(self.timestamps[first:last], self.offsets[first:last])))
+
+    # Append the new entries to the index file, then update the size of the data file they cover
+    def save(self, data_size, fsync=False):
+        self.data_size = data_size
+        if self.file_path is None:
+            self.pending = []
+            return
+        mode = 'r+b' if os.path.isfile(self.file_path) else 'w+b'
+        with open(self.file_path, mode) as f:
+            if(mode == 'w+b'):
+                f.write(struct.pack(header_format, magic, 0))
+            f.seek(0, os.SEEK_END)
+            f.write(b''.join(struct.pack(entry_format, timestamp, offset) for timestamp, offset in self.pending))
+            f.flush()
+            f.seek(0)
+            f.write(struct.pack(header_format, magic, data_size))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self.pending = []
+        pass
+
+    def clear(self):
+        self.timestamps = array.array('I')
+        self.offsets = array.array('Q')
+        self.data_size = 0
+        self.pending = []
+        if self.file_path is not None and os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+        pass
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from .jsonfile import atomic_write_json
+
+# Deadlines for the Bluetooth operations, and a circuit breaker for misbehaving devices
+#
+# A device that stops answering can leave a GATT operation waiting forever. ucache wraps its client in a
+# deadline_client, which gives every operation (connect, disconnect, read, write, start/stop notifications)
+# a maximum duration, and raises an operation_timeout when it is exceeded.
+#
+# In a periodic fleet run, a device that keeps failing costs its whole timeout at every run. A
+# circuit_breaker counts the recent failures of each device: after failure_threshold failures within
+# window seconds, the device is skipped (the circuit is open) for a backoff time, which doubles each time
+# the device fails again, up to max_backoff. After the backoff, one attempt is allowed (half-open): a
+# success closes the circuit, a failure opens it again.
+#
+#   breaker = watchdog.circuit_breaker(file_path='./breaker.json')
+#   results = await fleet.harvest_fleet(device_list, datafile, logfile, breaker=breaker)
+
+# Maximum duration of each operation in s. None means no limit
+default_timeouts = {'connect': 30, 'disconnect': 10, 'read': 10, 'write': 10, 'start_notify': 10, 'stop_notify': 10}
+
+class operation_timeout(asyncio.TimeoutError):
+    pass
+
+# Wraps a BleakClient (or simulated_client), like instrumentation.instrumented_client
+class deadline_client:
+    # timeouts override default_timeouts for some operations
+    def __init__(self, client, address, timeouts=None):
+        self.client = client
+        self.address = address
+        self.timeouts = dict(default_timeouts)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+
+    # Everything else (is_connected, services...) comes from the wrapped client
+    def __getattr__(self, name):
+        return(getattr(self.client, name))
+
+    async def with_deadline(self, operation, coroutine, characteristic=None):
+        timeout = self.timeouts.get(operation)
+        if timeout is None:
+            return(await coroutine)
+        try:
+            return(await asyncio.wait_for(coroutine, timeout=timeout))
+        except asyncio.TimeoutError:
+            target = self.address if characteristic is None else str(characteristic) + ' at ' + self.address
+            raise operation_timeout(f'{operation} of {target} timed out after {timeout}s') from None
+
+    async def connect(self, **kwargs):
+        return(await self.with_deadline('connect', self.client.connect(**kwargs)))
+
+    async def disconnect(self):
+        return(await self.with_deadline('disconnect', self.client.disconnect()))
+
+    async def read_gatt_char(self, characteristic, **kwargs):
+        return(await self.with_deadline('read', self.client.read_gatt_char(characteristic, **kwargs), characteristic))
+
+    async def write_gatt_char(self, characteristic, data, response=None):
+        if response is None:
+            return(await self.with_deadline('write', self.client.write_gatt_char(characteristic, data), characteristic))
+        return(await self.with_deadline('write', self.client.write_gatt_char(characteristic, data, response), characteristic))
+
+    async def start_notify(self, characteristic, callback, **kwargs):
+        return(await self.with_deadline('start_notify', self.client.start_notify(characteristic, callback, **kwargs), characteristic))
+
+    async def stop_notify(self, characteristic):
+        return(await self.with_deadline('stop_notify', self.client.stop_notify(characteristic), characteristic))
+
+class circuit_breaker:
+    # The state can be saved to file_path, so that it is kept between periodic runs
+    def __init__(self, failure_threshold=3, window=3600, backoff=600, max_backoff=86400, file_path=None):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.file_path = file_path
+        # address -> {'failures': [times], 'open_until': time or None, 'nb_opened': int, 'last_error': str}
+        self.devices = {}
+        if file_path is not None and os.path.isfile(file_path):
+            try:
+                with open(file_path) as f:
+                    self.devices = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Failed to load the circuit breaker state from {file_path}: {e}')
+
+    def device(self, address):
+        if address not in self.devices:
+            self.devices[address] = {'failures': [], 'open_until': None, 'nb_opened': 0, 'last_error': None}
+        return(self.devices[address])
+
+    # 'closed' (normal), 'open' (skipped until open_until) or 'half-open' (one attempt allowed)
+    def state(self, address, now=None):
+        now = time.time() if now is None else now
+        device = self.devices.get(address)
+        if device is None or device['open_until'] is None:
+            return('closed')
+        return('open' if now < device['open_until'] else 'half-open')
+
+    # Whether the device should be tried now
+    def allow(self, address, now=None):
+        return(self.state(address, now) != 'open')
+
+    def record_success(self, address):
+        if address in self.devices:
+            del self.devices[address]
+            self.save()
+        pass
+
+    def record_failure(self, address, error=None, now=None):
+        now = time.time() if now is None else now
+        device = self.device(address)
+        device['last_error'] = None if error is None else str(error)
+        device['failures'] = [failure for failure in device['failures'] if failure > now - self.window] + [now]
+        # A failure in the half-open state opens the circuit again at once, for longer
+        if(device['open_until'] is not None) or (len(device['failures']) >= self.failure_threshold):
+            device['open_until'] = now + min(self.backoff * 2 ** device['nb_opened'], self.max_backoff)
+            device['nb_opened'] += 1
+            logging.warning(f'{address} failed {len(device["failures"])} times, skipped until ' +
+                            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(device['open_until'])))
+        self.save()
+        pass
+
+    # Time until which the device is skipped, None if it is not
+    def open_until(self, address):
+        device = self.devices.get(address)
+        return(None if device is None else device['open_until'])
+
+    def save(self):
+        if self.file_path is None:
+            return
+        atomic_write_json(self.file_path, self.devices, indent=2)
+        pass
@@ -5,7 +5,10 @@ setup(
     version='0.1',
     author='Jonathan Muller',
     description='My Python library',
-    packages=['pyucache'],
+    packages=['apogee_device'],
+    entry_points={
+        'console_scripts': ['pyucache=apogee_device.cli:main'],
+    },
     classifiers=[
         'Development Status :: 3 - Beta',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
@@ -18,4 +21,7 @@ setup(
         'struct',
         'bleak',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
 )
\ No newline at end of file
@@ -0,0 +1,122 @@
+import asyncio
+import csv
+import pytest
+from apogee_device import apogee_device, simulator
+from apogee_device.checkpoint import checkpoint_store
+
+# Data log transfers against a simulated μCache (see simulator.py): lost notifications, checkpoints and
+# interrupted links must never lose or duplicate records
+
+end_of_transfer = b'\xFF\xFF\xFF\xFF'
+
+def stored_timestamps(file_path):
+    with open(file_path, newline='') as f:
+        rows = list(csv.reader(f))[2:] # Header: parameters and units
+    return([row[0] for row in rows])
+
+# Notifications after the first nb_received ones, and the terminator if lose_end, never arrive
+@pytest.fixture
+def lossy_link(monkeypatch):
+    def configure(nb_received=None, lose_end=True):
+        notify = simulator.simulated_client.notify
+        state = {'nb_sent': 0}
+        def lossy_notify(self, callback, data):
+            if bytes(data) == end_of_transfer:
+                if lose_end:
+                    return
+            else:
+                state['nb_sent'] += 1
+                if(nb_received is not None) and (state['nb_sent'] > nb_received):
+                    return
+            return(notify(self, callback, data))
+        monkeypatch.setattr(simulator.simulated_client, 'notify', lossy_notify)
+    return(configure)
+
+def test_lost_terminator(tmp_path, lossy_link):
+    lossy_link(lose_end=True)
+    device = simulator.simulated_ucache(nb_logs=300)
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    datafile = str(tmp_path / 'data.csv')
+    # The transfer ends once all the announced logs are received, without waiting for the terminator
+    status = asyncio.run(asyncio.wait_for(ucache.download_routine(datafile, str(tmp_path / 'log.csv')), timeout=5))
+    assert status == 'downloaded'
+    assert len(stored_timestamps(datafile)) == 300
+
+def test_lost_entries_rewind_device(lossy_link):
+    lossy_link(nb_received=250, lose_end=True)
+    device = simulator.simulated_ucache(nb_logs=300, first_log_time=1700000000)
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    async def transfer():
+        await ucache.connect()
+        await ucache.transfer_data(idle_timeout=0.2)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(transfer())
+    assert len(ucache.current_dataset) == 250
+    # The entries that were sent but not received are sent again by the next transfer
+    assert device.first_untransferred_index() == 250
+
+def test_timeout_writes_received_entries(tmp_path, lossy_link, monkeypatch):
+    lossy_link(nb_received=250, lose_end=True)
+    device = simulator.simulated_ucache(nb_logs=300)
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    transfer_data = ucache.transfer_data
+    monkeypatch.setattr(ucache, 'transfer_data', lambda silent=True: transfer_data(silent=silent, idle_timeout=0.2))
+    datafile = str(tmp_path / 'data.csv')
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(ucache.download_routine(datafile, str(tmp_path / 'log.csv')))
+    assert len(stored_timestamps(datafile)) == 250
+
+def test_checkpoint_and_from_timestamp(tmp_path):
+    device = simulator.simulated_ucache(nb_logs=300)
+    checkpoint = checkpoint_store(str(tmp_path / 'checkpoints.json'))
+    datafile, logfile = str(tmp_path / 'data.csv'), str(tmp_path / 'log.csv')
+    results = []
+    for from_timestamp in [None, 'all']:
+        ucache = apogee_device.ucache(device.address, client=device.client())
+        status = asyncio.run(ucache.download_routine(datafile, logfile, from_timestamp=from_timestamp, checkpoint=checkpoint))
+        results.append((status, ucache.nb_transferred))
+    # The explicit start time wins over the checkpoint, and the records transferred again are not duplicated
+    assert results == [('downloaded', 300), ('downloaded', 300)]
+    assert len(set(stored_timestamps(datafile))) == len(stored_timestamps(datafile)) == 300
+
+def test_disconnect_mid_transfer(tmp_path):
+    device = simulator.simulated_ucache(nb_logs=1000, disconnect_after=600)
+    checkpoint = checkpoint_store(str(tmp_path / 'checkpoints.json'))
+    datafile, logfile = str(tmp_path / 'data.csv'), str(tmp_path / 'log.csv')
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    async def interrupted_transfer():
+        await ucache.connect()
+        await ucache.read_info()
+        await ucache.checkpointed_transfer(datafile, checkpoint, idle_timeout=0.2)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(interrupted_transfer())
+    # Only whole batches are stored, the device went further than the checkpoint
+    assert checkpoint.get(device.address) == device.log_time(511)
+    assert device.first_untransferred_index() == 600
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    assert asyncio.run(ucache.download_routine(datafile, logfile, checkpoint=checkpoint)) == 'downloaded'
+    timestamps = stored_timestamps(datafile)
+    assert len(set(timestamps)) == len(timestamps) == 1000
+
+def test_iter_records_pointer_follows_consumer():
+    device = simulator.simulated_ucache(nb_logs=3000, first_log_time=1700000000)
+    ucache = apogee_device.ucache(device.address, client=device.client())
+    write_last_transferred_time = ucache.write_last_transferred_time
+    stored = []
+    ahead = []
+    async def checked_write(timestamp):
+        if not stored or timestamp > stored[-1]:
+            ahead.append(timestamp)
+        await write_last_transferred_time(timestamp)
+    ucache.write_last_transferred_time = checked_write
+    async def consume():
+        await ucache.connect()
+        nb_records = 0
+        # A slow consumer: the transfer is paused and resumed several times
+        async for batch in ucache.iter_records(batch_size=64, max_batches=4):
+            await asyncio.sleep(0.005)
+            stored.append(batch[-1][0])
+            nb_records += len(batch)
+        return(nb_records)
+    assert asyncio.run(consume()) == 3000
+    assert ahead == []